@@ -1,6 +1,7 @@
 import logging
 import os
 import re
+import subprocess
 
 try:
     # Python >= 3.8
@@ -31,7 +32,6 @@ from typing import TypedDict, List, Dict
 class FileFp(TypedDict):
     filename: str
     method_checksums: List[int] = None
-    mtime: float = None  # optimization helper, not really a part of the data structure fundamentally
     fsha: int = None  # optimization helper, not really a part of the data structure fundamentally
     fingerprint_id: int = None  # optimization helper,
 
@@ -139,3 +139,55 @@ def git_current_head(path=None):
     except FileNotFoundError:
         pass
     return None
+
+
+GIT_DIFF_NAMES = ("diff", "--name-only", "-z", "--no-renames", "--relative")
+
+
+def run_git(directory, *args):
+    """stdout of a git command run in directory, None when it fails"""
+    try:
+        result = subprocess.run(
+            ["git", *args], cwd=directory, capture_output=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout
+
+
+def split_git_paths(output):
+    return {os.fsdecode(path) for path in output.split(b"\0") if path}
+
+
+def git_head_commit(directory):
+    output = run_git(directory, "rev-parse", "--verify", "--quiet", "HEAD")
+    return output.decode().strip() if output else None
+
+
+def git_changed_files(directory, since_commit, head_commit):
+    """Files under directory (relative to it) changed from since_commit to
+    head_commit, and (second item) files that differ from head_commit in the
+    index or the work tree, including untracked ones. since_commit can be None,
+    the first item is then None. None when git fails."""
+    committed = None
+    if since_commit:
+        output = run_git(
+            directory,
+            *GIT_DIFF_NAMES,
+            since_commit,
+            head_commit,
+            "--",
+        )
+        if output is None:
+            return None  # e.g. since_commit was garbage collected
+        committed = split_git_paths(output)
+    dirty = run_git(
+        directory,
+        *GIT_DIFF_NAMES,
+        head_commit,
+        "--",
+    )
+    untracked = run_git(directory, "ls-files", "-z", "--others", "--exclude-standard")
+    if dirty is None or untracked is None:
+        return None
+    return committed, split_git_paths(dirty) | split_git_paths(untracked)
@@ -1,16 +1,32 @@
+import hashlib
 import json
 import os
 import sqlite3
 
-from collections import namedtuple
-from functools import lru_cache
-
-from testmon.process_code import blob_to_checksums, checksums_to_blob
+from array import array
+from collections import defaultdict, namedtuple
+from itertools import groupby
+
+from testmon.process_code import (
+    bitmap_misses,
+    bitmap_to_checksums,
+    blob_to_checksums,
+    blob_to_spans,
+    checksums_to_bitmap,
+    checksums_to_blob,
+    present_blocks,
+    spans_to_blob,
+)
 
 from testmon.common import TestExecutions
 
 
-DATA_VERSION = 14
+DATA_VERSION = 24
+
+# parsed modules kept in the DB, the least recently used ones are evicted
+PARSED_MODULE_CACHE_SIZE = 20000
+
+SQLITE_MAX_VARIABLES = 900
 
 ChangedFileData = namedtuple(
     "ChangedFileData", "filename name method_checksums id failed"
@@ -21,13 +37,27 @@ class TestmonDbException(Exception):
     pass
 
 
+def dependency_set_sha(fingerprint_ids):
+    """Identifies a dependency set by its (unordered) fingerprint ids"""
+    return hashlib.sha1(array("q", sorted(fingerprint_ids)).tobytes()).hexdigest()
+
+
 def connect(datafile, readonly=False):
     return sqlite3.connect(
         f"file:{datafile}{'?mode=ro' if readonly else ''}", uri=True, timeout=60
     )
 
 
+def bitmap_misses_sql(bitmap, present):
+    """bitmap_misses() as an SQL function, present is a bitmap blob or NULL when
+    nothing is (the file is gone)"""
+    return present is None or bitmap_misses(bitmap, present)
+
+
 def connection_options(connection):
+    connection.create_function(
+        "bitmap_misses", 2, bitmap_misses_sql, deterministic=True
+    )
     connection.execute("PRAGMA journal_mode = WAL")
     connection.execute("PRAGMA synchronous = OFF")
     connection.execute("PRAGMA foreign_keys = TRUE ")
@@ -61,10 +91,13 @@ def check_data_version(connection, datafile, data_version):
 
 class DB:  # pylint: disable=too-many-public-methods
     def __init__(self, datafile, readonly=False):
+        self.datafile = datafile
         self._readonly = readonly
         file_exists = os.path.exists(datafile)
 
         connection = connect(datafile, readonly)
+        if file_exists and not readonly:
+            self._migrate(connection)
         connection, old_format = check_data_version(
             connection, datafile, self.version_compatibility()
         )
@@ -81,6 +114,147 @@ class DB:  # pylint: disable=too-many-public-methods
     def version_compatibility(self):
         return DATA_VERSION
 
+    def _migrate(self, connection):
+        """Convert data of the previous released version in place. Foreign keys
+        are off (connection options aren't set yet), so recreating tables
+        doesn't cascade. Data of other versions, or which fails to convert, is
+        discarded by check_data_version()."""
+        if self.version_compatibility() != DATA_VERSION:
+            return
+        stored_data_version = connection.execute("PRAGMA user_version").fetchone()[0]
+        migration = self._migrations().get(stored_data_version)
+        if migration is None:
+            return
+        try:
+            migration(connection)
+        except sqlite3.DatabaseError:
+            connection.rollback()
+            return
+        connection.execute("VACUUM")
+
+    def _migrations(self):
+        """{released version: step converting its data to DATA_VERSION}"""
+        return {14: self._migrate_from_14}
+
+    def _migrate_from_14(self, connection):
+        """Version 14 stored names in every row and fingerprints as arrays of
+        checksums linked to each test execution. Fingerprints of a file at one
+        fsha become bitmaps over its block table (those which only differed in
+        duplicate checksums become one) and tests with the same fingerprints
+        share a dependency set. Fingerprints no test depends on are dropped.
+        suite_execution_file_fsha referred to suite executions, which only
+        exist on a server, it's filled per environment."""
+        fk_column = self._test_execution_fk_column()
+        connection.executescript(
+            """
+            PRAGMA legacy_alter_table = ON;
+            BEGIN;
+            DROP INDEX test_execution_fk_name;
+            ALTER TABLE test_execution RENAME TO legacy_test_execution;
+            ALTER TABLE file_fp RENAME TO legacy_file_fp;
+            DROP TABLE suite_execution_file_fsha;
+            """
+            + self._create_test_execution_statement()
+            + self._create_interned_names_statement()
+            + self._create_file_fp_statement()
+            + self._create_file_block_statement()
+            + self._create_environment_file_statement()
+            + self._create_file_stat_statement()
+            + self._create_parsed_module_statement()
+            + self._create_dependency_set_statement()
+            + self._create_suite_execution_file_fsha_statement()
+            + f"""
+            INSERT INTO interned_test_name (test_name)
+                SELECT DISTINCT test_name FROM legacy_test_execution;
+            INSERT INTO interned_filename (filename)
+                SELECT DISTINCT filename FROM legacy_file_fp
+                WHERE id IN (SELECT fingerprint_id FROM test_execution_file_fp);
+            INSERT INTO test_execution
+                SELECT te.id, te.{fk_column}, tn.id, te.duration, te.failed, te.forced, NULL
+                FROM legacy_test_execution te, interned_test_name tn
+                WHERE tn.test_name = te.test_name;
+            """
+        )
+        rows = connection.execute(
+            """SELECT f.id, fn.id, f.fsha, f.method_checksums
+               FROM legacy_file_fp f, interned_filename fn
+               WHERE fn.filename = f.filename
+               ORDER BY fn.id, f.fsha, f.id"""
+        ).fetchall()
+        kept_fingerprint_ids = {}
+        for (filename_id, fsha), file_rows in groupby(rows, key=lambda row: row[1:3]):
+            fingerprints = [(row[0], blob_to_checksums(row[3])) for row in file_rows]
+            block_table = list(
+                dict.fromkeys(
+                    checksum for _, checksums in fingerprints for checksum in checksums
+                )
+            )
+            connection.execute(
+                "INSERT INTO file_block VALUES (?, ?, ?)",
+                (filename_id, fsha, checksums_to_blob(block_table)),
+            )
+            block_positions = {
+                checksum: position for position, checksum in enumerate(block_table)
+            }
+            bitmap_ids = {}
+            for fingerprint_id, checksums in fingerprints:
+                bitmap = checksums_to_bitmap(checksums, block_positions)
+                if bitmap not in bitmap_ids:
+                    bitmap_ids[bitmap] = fingerprint_id
+                    connection.execute(
+                        "INSERT INTO file_fp VALUES (?, ?, ?, ?)",
+                        (fingerprint_id, filename_id, bitmap, fsha),
+                    )
+                kept_fingerprint_ids[fingerprint_id] = bitmap_ids[bitmap]
+
+        rows = connection.execute(
+            """SELECT te.id, te_ffp.fingerprint_id
+               FROM test_execution te
+               LEFT JOIN test_execution_file_fp te_ffp ON te_ffp.test_execution_id = te.id
+               ORDER BY te.id"""
+        ).fetchall()
+        tests_shas = {}
+        dependency_sets = {}
+        for te_id, te_rows in groupby(rows, key=lambda row: row[0]):
+            fingerprint_ids = {
+                kept_fingerprint_ids[row[1]]
+                for row in te_rows
+                if row[1] in kept_fingerprint_ids
+            }
+            fingerprints_sha = dependency_set_sha(fingerprint_ids)
+            tests_shas[te_id] = fingerprints_sha
+            dependency_sets[fingerprints_sha] = fingerprint_ids
+        dependency_set_ids = self.fetch_or_create_dependency_sets(
+            connection, dependency_sets
+        )
+        connection.executemany(
+            "UPDATE test_execution SET dependency_set_id = ? WHERE id = ?",
+            (
+                (dependency_set_ids[fingerprints_sha], te_id)
+                for te_id, fingerprints_sha in tests_shas.items()
+            ),
+        )
+
+        for statement in (
+            f"""INSERT INTO suite_execution_file_fsha
+                SELECT DISTINCT te.{fk_column}, f.filename_id, f.fsha
+                FROM test_execution te, dependency_set_file_fp dsf, file_fp f
+                WHERE dsf.dependency_set_id = te.dependency_set_id
+                    AND f.id = dsf.fingerprint_id""",
+            f"""INSERT INTO environment_file
+                SELECT DISTINCT te.{fk_column}, f.filename_id
+                FROM test_execution te, dependency_set_file_fp dsf, file_fp f
+                WHERE dsf.dependency_set_id = te.dependency_set_id
+                    AND f.id = dsf.fingerprint_id""",
+            "DROP TABLE test_execution_file_fp",
+            "DROP TABLE legacy_file_fp",
+            "DROP TABLE legacy_test_execution",
+            f"PRAGMA user_version = {DATA_VERSION}",
+        ):
+            connection.execute(statement)
+        connection.commit()
+        connection.execute("PRAGMA legacy_alter_table = OFF")
+
     def __enter__(self):
         self.con = self.con.__enter__()
         return self
@@ -94,25 +268,143 @@ class DB:  # pylint: disable=too-many-public-methods
     def _test_execution_fk_table(self) -> str:
         return "environment"
 
+    def fetch_file_stats(self):
+        return {
+            row["filename"]: dict(row)
+            for row in self.con.execute(
+                "SELECT filename, mtime, fsize, inode, fsha FROM file_stat"
+            )
+        }
+
     def update_mtimes(self, new_mtimes):
+        if self._readonly:
+            return
         with self.con as con:
             con.executemany(
-                "UPDATE file_fp SET mtime=?, fsha=? WHERE id = ?", new_mtimes
+                "INSERT OR REPLACE INTO file_stat VALUES (?, ?, ?, ?, ?)", new_mtimes
+            )
+
+    def delete_file_stats(self, filenames):
+        if self._readonly:
+            return
+        with self.con as con:
+            con.executemany(
+                "DELETE FROM file_stat WHERE filename = ?",
+                ((filename,) for filename in filenames),
             )
 
     def finish_execution(
         self, exec_id, duration=None, select=True
     ):  # pylint: disable=unused-argument
         self.update_saving_stats(exec_id, select)
-        self.fetch_or_create_file_fp.cache_clear()
         with self.con as con:
+            self.vacuum_dependency_sets(con)
             self.vacuum_file_fp(con)
+            self.vacuum_suite_files_fshas(con, exec_id)
+            self.vacuum_environment_file(con, exec_id)
+            self.evict_parsed_modules(con)
+
+    def vacuum_dependency_sets(self, con):
+        """Remove dependency sets no test execution refers to any more, their
+        links cascade. Only the sets tests left since the previous vacuum
+        (collected by triggers) are checked."""
+        con.execute(
+            """ DELETE FROM dependency_set
+                WHERE id IN (
+                    SELECT c.dependency_set_id FROM dependency_set_candidate c
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM test_execution te
+                        WHERE te.dependency_set_id = c.dependency_set_id)) """
+        )
+        con.execute("DELETE FROM dependency_set_candidate")
 
     def vacuum_file_fp(self, con):
+        """Remove fingerprints which lost their last link. Only the ones unlinked
+        since the previous vacuum (collected by a trigger) are checked."""
         con.execute(
             """ DELETE FROM file_fp
-                WHERE id NOT IN (
-                    SELECT DISTINCT fingerprint_id FROM test_execution_file_fp) """
+                WHERE id IN (
+                    SELECT c.fingerprint_id FROM file_fp_candidate c
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM dependency_set_file_fp dsf
+                        WHERE dsf.fingerprint_id = c.fingerprint_id)) """
+        )
+        con.execute("DELETE FROM file_fp_candidate")
+
+    def vacuum_suite_files_fshas(self, con, exec_id):
+        """Remove (filename, fsha) no test of the environment depends on any more"""
+        con.execute(
+            f""" DELETE FROM suite_execution_file_fsha AS sefs
+                WHERE sefs.{self._test_execution_fk_column()} = :exec_id AND NOT EXISTS (
+                    SELECT 1
+                    -- in this order, not all the tests of the environment per row
+                    FROM file_fp f
+                    CROSS JOIN dependency_set_file_fp dsf
+                    CROSS JOIN test_execution te
+                    WHERE
+                        f.filename_id = sefs.filename_id AND
+                        f.fsha IS sefs.fsha AND
+                        dsf.fingerprint_id = f.id AND
+                        te.dependency_set_id = dsf.dependency_set_id AND
+                        te.{self._test_execution_fk_column()} = :exec_id) """,
+            {"exec_id": exec_id},
+        )
+
+    def vacuum_environment_file(self, con, exec_id):
+        con.execute(
+            f""" DELETE FROM environment_file
+                WHERE {self._test_execution_fk_column()} = :exec_id AND filename_id NOT IN (
+                    SELECT filename_id FROM suite_execution_file_fsha
+                    WHERE {self._test_execution_fk_column()} = :exec_id) """,
+            {"exec_id": exec_id},
+        )
+
+    def fetch_parsed_modules(self, keys):
+        """{(fsha, kind): (block spans, method checksums)} of modules parsed at
+        previous runs. kind identifies how the module was parsed."""
+        keys = list(keys)
+        parsed_modules = {}
+        for start in range(0, len(keys), SQLITE_MAX_VARIABLES // 2):
+            chunk = keys[start : start + SQLITE_MAX_VARIABLES // 2]
+            in_clause = ", ".join("(?, ?)" for _ in chunk)
+            for row in self.con.execute(
+                f"""SELECT fsha, kind, spans, method_checksums FROM parsed_module
+                    WHERE (fsha, kind) IN (VALUES {in_clause})""",
+                [value for key in chunk for value in key],
+            ):
+                parsed_modules[(row["fsha"], row["kind"])] = (
+                    blob_to_spans(row["spans"]),
+                    blob_to_checksums(row["method_checksums"]),
+                )
+        if parsed_modules and not self._readonly:
+            with self.con as con:
+                con.executemany(
+                    """UPDATE parsed_module SET last_used = strftime('%s', 'now')
+                       WHERE fsha = ? AND kind = ?""",
+                    parsed_modules.keys(),
+                )
+        return parsed_modules
+
+    def insert_parsed_modules(self, parsed_modules):
+        """parsed_modules: iterable of (fsha, kind, block spans, method checksums)"""
+        if self._readonly:
+            return
+        with self.con as con:
+            con.executemany(
+                """INSERT OR REPLACE INTO parsed_module
+                   VALUES (?, ?, ?, ?, strftime('%s', 'now'))""",
+                (
+                    (fsha, kind, spans_to_blob(spans), checksums_to_blob(checksums))
+                    for fsha, kind, spans, checksums in parsed_modules
+                ),
+            )
+
+    def evict_parsed_modules(self, con):
+        con.execute(
+            """ DELETE FROM parsed_module WHERE rowid IN (
+                    SELECT rowid FROM parsed_module
+                    ORDER BY last_used DESC LIMIT -1 OFFSET ?) """,
+            (PARSED_MODULE_CACHE_SIZE,),
         )
 
     def fetch_current_run_stats(self, exec_id):
@@ -192,112 +484,292 @@ class DB:  # pylint: disable=too-many-public-methods
             total_all_tests,
         )
 
-    @lru_cache(1000)
-    def fetch_or_create_file_fp(
-        self, filename, fsha, method_checksums
-    ):  # pylint: disable=R0801
-        cursor = self.con.cursor()
-        try:
-            cursor.execute(
+    def fetch_or_create_file_fps(self, con, fingerprints):
+        """{(filename, fsha, bitmap): id} of file_fp rows, the missing ones are
+        inserted. fingerprints mustn't contain duplicates, their filenames have
+        to be interned."""
+        con.execute("DELETE FROM batch_file_fp")
+        con.executemany("INSERT INTO batch_file_fp VALUES (?, ?, ?)", fingerprints)
+        # fsha IS NULL for placeholders, the unique constraint doesn't cover them
+        con.execute(
+            """
+            INSERT INTO file_fp (filename_id, method_checksums, fsha)
+            SELECT n.id, b.method_checksums, b.fsha
+            FROM batch_file_fp b CROSS JOIN interned_filename n
+            WHERE
+                n.filename = b.filename AND
+                NOT EXISTS (
+                    SELECT 1 FROM file_fp f
+                    WHERE
+                        f.filename_id = n.id AND
+                        f.fsha IS b.fsha AND
+                        f.method_checksums = b.method_checksums)
+            """
+        )
+        return {
+            (row[0], row[1], row[2]): row[3]
+            for row in con.execute(
+                """
+                SELECT b.filename, b.fsha, b.method_checksums, f.id
+                FROM batch_file_fp b
+                CROSS JOIN interned_filename n
+                CROSS JOIN file_fp f
+                WHERE
+                    n.filename = b.filename AND
+                    f.filename_id = n.id AND
+                    f.fsha IS b.fsha AND
+                    f.method_checksums = b.method_checksums
                 """
-                INSERT INTO file_fp
-                (filename, method_checksums, fsha)
-                VALUES (?, ?, ?)
-                """,
-                (filename, method_checksums, fsha),
             )
+        }
 
-            fingerprint_id = cursor.lastrowid
-        except sqlite3.IntegrityError:  # rather fetching existing fingerprint
-            fingerprint_id, *_ = cursor.execute(
-                """
-                SELECT
-                    id
-                FROM
-                    file_fp
-                WHERE
-                    filename = ? AND method_checksums = ?
-                """,
-                (filename, method_checksums),
+    def fetch_or_extend_block_tables(self, con, files_checksums):
+        """{(filename, fsha): {checksum: position}} of the block tables of the
+        files. Checksums missing from a table are appended, the positions
+        stored bitmaps refer to don't change."""
+        con.executemany(
+            "INSERT OR IGNORE INTO interned_filename (filename) VALUES (?)",
+            {(filename,) for filename, _ in files_checksums},
+        )
+        files_block_positions = {}
+        for (filename, fsha), checksums in files_checksums.items():
+            filename_id, blob = con.execute(
+                """SELECT fn.id, fb.method_checksums
+                   FROM interned_filename fn
+                   LEFT JOIN file_block fb ON fb.filename_id = fn.id AND fb.fsha IS ?
+                   WHERE fn.filename = ?""",
+                (fsha, filename),
             ).fetchone()
-
-        return fingerprint_id
+            block_table = [] if blob is None else list(blob_to_checksums(blob))
+            block_positions = {
+                checksum: position for position, checksum in enumerate(block_table)
+            }
+            stored_blocks = len(block_table)
+            for checksum in checksums:
+                if checksum not in block_positions:
+                    block_positions[checksum] = len(block_table)
+                    block_table.append(checksum)
+            if blob is None:
+                con.execute(
+                    "INSERT INTO file_block VALUES (?, ?, ?)",
+                    (filename_id, fsha, checksums_to_blob(block_table)),
+                )
+            elif len(block_table) > stored_blocks:
+                con.execute(
+                    """UPDATE file_block SET method_checksums = ?
+                       WHERE filename_id = ? AND fsha IS ?""",
+                    (checksums_to_blob(block_table), filename_id, fsha),
+                )
+            files_block_positions[(filename, fsha)] = block_positions
+        return files_block_positions
+
+    def fetch_or_create_dependency_sets(self, con, dependency_sets):
+        """{fingerprints_sha: id} of dependency_set rows, dependency_sets is
+        {fingerprints_sha: fingerprint ids}. The missing ones are inserted
+        with their links."""
+        dependency_set_ids = {}
+        for fingerprints_sha, fingerprint_ids in dependency_sets.items():
+            row = con.execute(
+                "SELECT id FROM dependency_set WHERE fingerprints_sha = ?",
+                (fingerprints_sha,),
+            ).fetchone()
+            if row:
+                dependency_set_ids[fingerprints_sha] = row[0]
+                continue
+            dependency_set_id = con.execute(
+                "INSERT INTO dependency_set (fingerprints_sha) VALUES (?)",
+                (fingerprints_sha,),
+            ).lastrowid
+            con.executemany(
+                "INSERT INTO dependency_set_file_fp VALUES (?, ?)",
+                (
+                    (dependency_set_id, fingerprint_id)
+                    for fingerprint_id in fingerprint_ids
+                ),
+            )
+            dependency_set_ids[fingerprints_sha] = dependency_set_id
+        return dependency_set_ids
+
+    def fetch_or_create_test_names(self, con, test_names):
+        """{test_name: id} of interned_test_name rows, the missing ones are
+        inserted"""
+        test_names = list(test_names)
+        con.executemany(
+            "INSERT OR IGNORE INTO interned_test_name (test_name) VALUES (?)",
+            ((test_name,) for test_name in test_names),
+        )
+        test_name_ids = {}
+        for start in range(0, len(test_names), SQLITE_MAX_VARIABLES):
+            chunk = test_names[start : start + SQLITE_MAX_VARIABLES]
+            in_clause = ", ".join("?" * len(chunk))
+            for row in con.execute(
+                f"""SELECT test_name, id FROM interned_test_name
+                    WHERE test_name IN ({in_clause})""",
+                chunk,
+            ):
+                test_name_ids[row[0]] = row[1]
+        return test_name_ids
 
     def _insert_test_execution(  # pylint: disable=too-many-arguments
         self,
         con,
         exec_id: int,
-        test_name: "str",
+        test_name_id: int,
         duration: "float",
         failed: "bool",
         forced: bool,
+        dependency_set_id: int,
     ) -> int:
         cursor = con.cursor()
         cursor.execute(
             f"""
                 INSERT INTO test_execution
-                ({self._test_execution_fk_column()}, test_name, duration, failed, forced)
-                VALUES (?, ?, ?, ?, ?)
+                ({self._test_execution_fk_column()}, test_name_id, duration, failed, forced, dependency_set_id)
+                VALUES (?, ?, ?, ?, ?, ?)
                 """,
             (
                 exec_id,
-                test_name,
+                test_name_id,
                 duration,
                 1 if failed else 0,
                 forced,
+                dependency_set_id,
             ),
         )
         return cursor.lastrowid
 
     def insert_test_file_fps(self, tests_deps_n_outcomes: TestExecutions, exec_id=None):
+        """Tests with the same fingerprints (e.g. parametrized ones) share a
+        dependency set. Tests stored before are updated in place, only when
+        their outcome or dependency set changed."""
         assert exec_id
         with self.con as con:
             cursor = con.cursor()
 
-            cursor.executemany(
-                f"DELETE FROM test_execution_file_fp "
-                f"WHERE test_execution_id in "
-                f"      (SELECT id FROM test_execution WHERE {self._test_execution_fk_column()}=? AND test_name=?)",
-                [(exec_id, test_name) for test_name in tests_deps_n_outcomes],
+            files_checksums = defaultdict(dict)
+            for deps_n_outcomes in tests_deps_n_outcomes.values():
+                for record in deps_n_outcomes["deps"]:
+                    files_checksums[(record["filename"], record["fsha"])].update(
+                        dict.fromkeys(record["method_checksums"])
+                    )
+            files_block_positions = self.fetch_or_extend_block_tables(
+                con, files_checksums
             )
 
-            cursor.executemany(
-                f"DELETE FROM test_execution WHERE {self._test_execution_fk_column()}=? AND test_name=?",
-                [(exec_id, test_name) for test_name in tests_deps_n_outcomes],
+            # many tests share fingerprints, each one is converted and looked up
+            # once per batch
+            bitmaps = {}
+            tests_fingerprints = {}
+            for test_name, deps_n_outcomes in tests_deps_n_outcomes.items():
+                fingerprints = tests_fingerprints[test_name] = []
+                for record in deps_n_outcomes["deps"]:
+                    file = (record["filename"], record["fsha"])
+                    checksums = tuple(record["method_checksums"])
+                    bitmap = bitmaps.get((file, checksums))
+                    if bitmap is None:
+                        bitmap = bitmaps[(file, checksums)] = checksums_to_bitmap(
+                            checksums, files_block_positions[file]
+                        )
+                    fingerprints.append((*file, bitmap))
+            fingerprint_ids_by_fingerprint = self.fetch_or_create_file_fps(
+                con,
+                {
+                    fingerprint
+                    for fingerprints in tests_fingerprints.values()
+                    for fingerprint in fingerprints
+                },
             )
 
-            test_execution_file_fps = []
+            tests_shas = {}
+            dependency_sets = {}
+            for test_name, fingerprints in tests_fingerprints.items():
+                fingerprint_ids = {
+                    fingerprint_ids_by_fingerprint[fingerprint]
+                    for fingerprint in fingerprints
+                }
+                fingerprints_sha = dependency_set_sha(fingerprint_ids)
+                tests_shas[test_name] = fingerprints_sha
+                dependency_sets[fingerprints_sha] = fingerprint_ids
+            dependency_set_ids = self.fetch_or_create_dependency_sets(
+                con, dependency_sets
+            )
+            test_name_ids = self.fetch_or_create_test_names(con, tests_deps_n_outcomes)
+
+            updated_executions = []
+            changed_files_fshas = set()
             for test_name, deps_n_outcomes in tests_deps_n_outcomes.items():
-                te_id = self._insert_test_execution(
-                    con,
-                    exec_id,
-                    test_name,
+                execution = (
                     deps_n_outcomes.get("duration", None),
-                    deps_n_outcomes.get("failed", None),
+                    1 if deps_n_outcomes.get("failed", None) else 0,
                     deps_n_outcomes.get("forced", None),
+                    dependency_set_ids[tests_shas[test_name]],
                 )
-
-                fingerprints = deps_n_outcomes["deps"]
-                files_fshas = set()
-                for record in fingerprints:
-                    fingerprint_id = self.fetch_or_create_file_fp(
-                        record["filename"],
-                        record["fsha"],
-                        checksums_to_blob(record["method_checksums"]),
+                stored_executions = cursor.execute(
+                    f"""
+                    SELECT id, duration, failed, forced, dependency_set_id
+                    FROM test_execution
+                    WHERE {self._test_execution_fk_column()} = ? AND test_name_id = ?
+                    ORDER BY id
+                    """,
+                    (exec_id, test_name_ids[test_name]),
+                ).fetchall()
+                if stored_executions:
+                    te_id, *stored_execution = stored_executions[0]
+                    self._delete_test_execution_ids(
+                        con, [row["id"] for row in stored_executions[1:]]
                     )
-
-                    test_execution_file_fps.append((te_id, fingerprint_id))
-                    files_fshas.add((record["filename"], record["fsha"]))
-            if test_execution_file_fps:
-                cursor.executemany(
-                    "INSERT INTO test_execution_file_fp VALUES (?, ?)",
-                    test_execution_file_fps,
+                    if tuple(stored_execution) == execution:
+                        continue
+                    updated_executions.append((*execution, te_id))
+                    if stored_execution[-1] == execution[-1]:
+                        continue
+                else:
+                    self._insert_test_execution(
+                        con, exec_id, test_name_ids[test_name], *execution
+                    )
+                changed_files_fshas.update(
+                    (filename, fsha)
+                    for filename, fsha, _ in tests_fingerprints[test_name]
                 )
-                self.fetch_or_create_file_fp.cache_clear()
-                self.insert_into_suite_files_fshas(con, exec_id, files_fshas)
+
+            cursor.executemany(
+                """UPDATE test_execution
+                   SET duration = ?, failed = ?, forced = ?, dependency_set_id = ?
+                   WHERE id = ?""",
+                updated_executions,
+            )
+            # files of tests whose dependency set didn't change are there already
+            self.insert_into_suite_files_fshas(con, exec_id, changed_files_fshas)
+            cursor.executemany(
+                """INSERT OR IGNORE INTO environment_file
+                   SELECT ?, id FROM interned_filename WHERE filename = ?""",
+                {(exec_id, filename) for filename, _ in changed_files_fshas},
+            )
+
+    def _delete_test_execution_ids(self, con, te_ids):
+        con.executemany(
+            "DELETE FROM test_execution WHERE id = ?", [(te_id,) for te_id in te_ids]
+        )
 
     def insert_into_suite_files_fshas(self, con, exec_id, files_fshas):
-        pass
+        # fsha IS NULL for placeholders, the unique index doesn't dedupe NULLs
+        con.executemany(
+            f"""
+            INSERT INTO suite_execution_file_fsha
+            SELECT :exec_id, n.id, :fsha
+            FROM interned_filename n
+            WHERE n.filename = :filename AND NOT EXISTS (
+                SELECT 1 FROM suite_execution_file_fsha
+                WHERE
+                    {self._test_execution_fk_column()} = :exec_id AND
+                    filename_id = n.id AND
+                    fsha IS :fsha)
+            """,
+            (
+                {"exec_id": exec_id, "filename": filename, "fsha": fsha}
+                for filename, fsha in files_fshas
+            ),
+        )
 
     def write_attribute(self, attribute, data, exec_id=None):
         dataid = f"{exec_id}:{attribute}"
@@ -355,12 +827,14 @@ class DB:  # pylint: disable=too-many-public-methods
                 CREATE TABLE test_execution (
                 id INTEGER PRIMARY KEY ASC,
                 {self._test_execution_fk_column()} INTEGER,
-                test_name TEXT,
+                test_name_id INTEGER,
                 duration FLOAT,
                 failed BIT,
                 forced BIT,
+                dependency_set_id INTEGER REFERENCES dependency_set(id),
                 FOREIGN KEY({self._test_execution_fk_column()}) REFERENCES {self._test_execution_fk_table()}(id) ON DELETE CASCADE);
-                CREATE INDEX test_execution_fk_name ON test_execution ({self._test_execution_fk_column()}, test_name);
+                CREATE INDEX test_execution_fk_name ON test_execution ({self._test_execution_fk_column()}, test_name_id);
+                CREATE INDEX test_execution_dependency_set ON test_execution (dependency_set_id);
             """
 
     def _create_temp_tables_statement(self) -> str:
@@ -368,44 +842,132 @@ class DB:  # pylint: disable=too-many-public-methods
 
     def _local_temp_tables_statement(self) -> str:
         return """
-                CREATE TEMPORARY TABLE changed_files_fshas (exec_id INTEGER, filename TEXT, fsha TEXT);
-                CREATE INDEX changed_files_fshas_mcall ON changed_files_fshas (exec_id, filename, fsha);
+                CREATE TEMPORARY TABLE changed_files_fshas (exec_id INTEGER, filename_id INTEGER, fsha TEXT);
+                CREATE INDEX changed_files_fshas_mcall ON changed_files_fshas (exec_id, filename_id, fsha);
 
-                CREATE TEMPORARY TABLE changed_files_mhashes (exec_id INTEGER, filename TEXT, mhashes BLOB);
+                CREATE TEMPORARY TABLE changed_files_mhashes (exec_id INTEGER, filename_id INTEGER, mhashes BLOB);
                 CREATE INDEX changed_files_mhashes_eid ON changed_files_mhashes (exec_id);
+
+                CREATE TEMPORARY TABLE batch_file_fp (filename TEXT, fsha TEXT, method_checksums BLOB);
+
+                CREATE TEMPORARY TABLE changed_file_blocks (exec_id INTEGER, filename_id INTEGER, fsha TEXT, present BLOB);
+                CREATE INDEX changed_file_blocks_eid ON changed_file_blocks (exec_id);
         """
 
+    def _create_interned_names_statement(self) -> str:
+        """Test names and filenames repeat in many rows, the tables refer to them
+        by id."""
+        return """
+            CREATE TABLE interned_test_name (id INTEGER PRIMARY KEY, test_name TEXT UNIQUE);
+            CREATE TABLE interned_filename (id INTEGER PRIMARY KEY, filename TEXT UNIQUE);"""
+
     def _create_file_fp_statement(self) -> str:
         return """
             CREATE TABLE file_fp
             (
                 id INTEGER PRIMARY KEY,
-                filename TEXT,
+                filename_id INTEGER,
                 method_checksums BLOB,
-                mtime FLOAT,
                 fsha TEXT,
-                UNIQUE (filename, fsha, method_checksums)
+                UNIQUE (filename_id, fsha, method_checksums)
+            );
+            -- fingerprints which might not be used any more, see vacuum_file_fp
+            CREATE TABLE file_fp_candidate (fingerprint_id INTEGER PRIMARY KEY);"""
+
+    def _create_file_block_statement(self) -> str:
+        """Checksums of the blocks of a file (at fsha) fingerprints were taken
+        from, file_fp.method_checksums is a bitmap of positions in it."""
+        return """
+            CREATE TABLE file_block
+            (
+                filename_id INTEGER,
+                fsha TEXT,
+                method_checksums BLOB,
+                PRIMARY KEY (filename_id, fsha)
+            );
+            CREATE TRIGGER file_fp_delete AFTER DELETE ON file_fp
+            WHEN NOT EXISTS (
+                SELECT 1 FROM file_fp
+                WHERE filename_id = OLD.filename_id AND fsha IS OLD.fsha)
+            BEGIN
+                DELETE FROM file_block
+                WHERE filename_id = OLD.filename_id AND fsha IS OLD.fsha;
+            END;"""
+
+    def _create_environment_file_statement(self) -> str:
+        return f"""
+            CREATE TABLE environment_file
+            (
+                {self._test_execution_fk_column()} INTEGER,
+                filename_id INTEGER,
+                PRIMARY KEY ({self._test_execution_fk_column()}, filename_id),
+                FOREIGN KEY({self._test_execution_fk_column()}) REFERENCES {self._test_execution_fk_table()}(id) ON DELETE CASCADE
+            ) WITHOUT ROWID;"""
+
+    def _create_file_stat_statement(self) -> str:
+        return """
+            CREATE TABLE file_stat
+            (
+                filename TEXT PRIMARY KEY,
+                mtime FLOAT,
+                fsize INTEGER,
+                inode INTEGER,
+                fsha TEXT
             );"""
 
-    def _create_test_execution_ffp_statement(  # pylint: disable=invalid-name
-        self,
-    ) -> str:
+    def _create_parsed_module_statement(self) -> str:
         return """
-            CREATE TABLE test_execution_file_fp (
-                test_execution_id INTEGER,
+            CREATE TABLE parsed_module
+            (
+                fsha TEXT,
+                kind TEXT,
+                spans BLOB,
+                method_checksums BLOB,
+                last_used INTEGER,
+                PRIMARY KEY (fsha, kind)
+            );
+            CREATE INDEX parsed_module_last_used ON parsed_module (last_used);"""
+
+    def _create_dependency_set_statement(self) -> str:
+        """Fingerprints tests depend on. Tests with the same fingerprints share a
+        dependency set, fingerprints_sha identifies it."""
+        return """
+            CREATE TABLE dependency_set (id INTEGER PRIMARY KEY, fingerprints_sha TEXT UNIQUE);
+            CREATE TABLE dependency_set_file_fp (
+                dependency_set_id INTEGER,
                 fingerprint_id INTEGER,
-                FOREIGN KEY(test_execution_id) REFERENCES test_execution(id) ON DELETE CASCADE,
+                FOREIGN KEY(dependency_set_id) REFERENCES dependency_set(id) ON DELETE CASCADE,
                 FOREIGN KEY(fingerprint_id) REFERENCES file_fp(id)
             );
-            CREATE INDEX test_execution_file_fp_both ON test_execution_file_fp (test_execution_id, fingerprint_id);
-            -- the following table stores the same data coarsely, but is used for faster queries
+            CREATE INDEX dependency_set_file_fp_both ON dependency_set_file_fp (dependency_set_id, fingerprint_id);
+            CREATE INDEX dependency_set_file_fp_fingerprint ON dependency_set_file_fp (fingerprint_id);
+            CREATE TRIGGER dependency_set_file_fp_unlink AFTER DELETE ON dependency_set_file_fp
+            BEGIN
+                INSERT OR IGNORE INTO file_fp_candidate VALUES (OLD.fingerprint_id);
+            END;
+            -- dependency sets which might not be used any more, see vacuum_dependency_sets
+            CREATE TABLE dependency_set_candidate (dependency_set_id INTEGER PRIMARY KEY);
+            CREATE TRIGGER test_execution_delete AFTER DELETE ON test_execution
+            WHEN OLD.dependency_set_id IS NOT NULL
+            BEGIN
+                INSERT OR IGNORE INTO dependency_set_candidate VALUES (OLD.dependency_set_id);
+            END;
+            CREATE TRIGGER test_execution_dependency_set_update
+            AFTER UPDATE OF dependency_set_id ON test_execution
+            WHEN OLD.dependency_set_id IS NOT NULL
+            BEGIN
+                INSERT OR IGNORE INTO dependency_set_candidate VALUES (OLD.dependency_set_id);
+            END;"""
+
+    def _create_suite_execution_file_fsha_statement(self) -> str:
+        return f"""
             CREATE TABLE suite_execution_file_fsha (
-                suite_execution_id INTEGER,
-                filename TEXT,
+                {self._test_execution_fk_column()} INTEGER,
+                filename_id INTEGER,
                 fsha text,
-                FOREIGN KEY(suite_execution_id) REFERENCES suite_execution(id) ON DELETE CASCADE
+                FOREIGN KEY({self._test_execution_fk_column()}) REFERENCES {self._test_execution_fk_table()}(id) ON DELETE CASCADE
                 );
-                CREATE UNIQUE INDEX sefch_suite_id_filename_sha ON suite_execution_file_fsha(suite_execution_id, filename, fsha);
+                CREATE UNIQUE INDEX sefch_suite_id_filename_sha ON suite_execution_file_fsha({self._test_execution_fk_column()}, filename_id, fsha);
             """
 
     def init_tables(self):
@@ -416,8 +978,15 @@ class DB:  # pylint: disable=too-many-public-methods
             + self._create_environment_statement()
             + self._create_test_execution_statement()
             + self._create_temp_tables_statement()
+            + self._create_interned_names_statement()
             + self._create_file_fp_statement()
-            + self._create_test_execution_ffp_statement()
+            + self._create_file_block_statement()
+            + self._create_environment_file_statement()
+            + self._create_file_stat_statement()
+            + self._create_parsed_module_statement()
+            + self._create_dependency_set_statement()
+            # the following table stores the same data coarsely, but is used for faster queries
+            + self._create_suite_execution_file_fsha_statement()
         )
 
         connection.execute(f"PRAGMA user_version = {self.version_compatibility()}")
@@ -428,18 +997,25 @@ class DB:  # pylint: disable=too-many-public-methods
         for row in self.con.execute(
             f"""
             SELECT
-                f.filename,
-                te.test_name,
+                fn.filename,
+                tn.test_name,
                 f.method_checksums,
+                fb.method_checksums AS blocks,
                 f.id,
                 te.failed,
                 te.duration
-            FROM test_execution te, test_execution_file_fp te_ffp, file_fp f
+            FROM
+                test_execution te, dependency_set_file_fp dsf, file_fp f,
+                interned_test_name tn, interned_filename fn, file_block fb
             WHERE
                 te.{self._test_execution_fk_column()} = ? AND
-                te.id = te_ffp.test_execution_id AND
-                te_ffp.fingerprint_id = f.id AND
-                f.id IN ({in_clause_questionsmarks})
+                te.dependency_set_id = dsf.dependency_set_id AND
+                dsf.fingerprint_id = f.id AND
+                f.id IN ({in_clause_questionsmarks}) AND
+                tn.id = te.test_name_id AND
+                fn.id = f.filename_id AND
+                fb.filename_id = f.filename_id AND
+                fb.fsha IS f.fsha
             """,
             [
                 exec_id,
@@ -450,7 +1026,9 @@ class DB:  # pylint: disable=too-many-public-methods
                 [
                     row["filename"],
                     row["test_name"],
-                    blob_to_checksums(row["method_checksums"]),
+                    bitmap_to_checksums(
+                        row["method_checksums"], blob_to_checksums(row["blocks"])
+                    ),
                     row["id"],
                     row["failed"],
                     row["duration"],
@@ -460,30 +1038,49 @@ class DB:  # pylint: disable=too-many-public-methods
         return result
 
     def fetch_unknown_files(
-        self, files_fshas, exec_id
+        self, files_fshas, exec_id, listed_only=False
     ) -> []:  # exec_id is environment_id in this module
+        """Files whose fsha in files_fshas (None for deleted files) differs from
+        the stored one. With listed_only files missing from files_fshas are
+        taken as unchanged."""
         with self.con as con:
             con.execute("DELETE FROM changed_files_fshas WHERE exec_id = ?", (exec_id,))
+            # files which aren't interned aren't stored anywhere either
             con.executemany(
-                "INSERT INTO changed_files_fshas VALUES (?, ?, ?)",
-                [(exec_id, file, fsha) for file, fsha in files_fshas.items()],
+                """INSERT INTO changed_files_fshas
+                   SELECT ?, id, ? FROM interned_filename WHERE filename = ?""",
+                [(exec_id, fsha, file) for file, fsha in files_fshas.items()],
+            )
+            return self._fetch_unknown_files_from_one_v(
+                con, exec_id, exec_id, listed_only
             )
-            return self._fetch_unknown_files_from_one_v(con, exec_id, exec_id)
 
-    def _fetch_unknown_files_from_one_v(self, con, exec_id, files_shas_id):
+    def _fetch_unknown_files_from_one_v(
+        self, con, exec_id, files_shas_id, listed_only=False
+    ):
+        listed_condition = ""
+        if listed_only:
+            listed_condition = """AND sefs.filename_id IN (
+                        SELECT filename_id FROM changed_files_fshas
+                        WHERE exec_id = :files_shas_id
+                    )"""
         result = []
         for row in con.execute(
             f"""
                 SELECT DISTINCT
-                    f.filename
-                FROM test_execution te, test_execution_file_fp te_ffp, file_fp f
-                LEFT OUTER JOIN changed_files_fshas chff
-                ON f.filename = chff.filename and f.fsha = chff.fsha AND chff.exec_id = :files_shas_id
+                    fn.filename
+                FROM suite_execution_file_fsha sefs
+                CROSS JOIN interned_filename fn
                 WHERE
-                    te.{self._test_execution_fk_column()} = :exec_id AND
-                    te.id = te_ffp.test_execution_id AND
-                    te_ffp.fingerprint_id = f.id AND
-                    (f.fsha IS NULL OR chff.fsha IS NULL)
+                    sefs.{self._test_execution_fk_column()} = :exec_id AND
+                    fn.id = sefs.filename_id AND
+                    (sefs.fsha IS NULL OR (NOT EXISTS (
+                        SELECT 1 FROM changed_files_fshas chff
+                        WHERE
+                            chff.exec_id = :files_shas_id AND
+                            chff.filename_id = sefs.filename_id AND
+                            chff.fsha = sefs.fsha
+                    ) {listed_condition}))
                 """,
             {"files_shas_id": files_shas_id, "exec_id": exec_id},
         ):
@@ -492,65 +1089,108 @@ class DB:  # pylint: disable=too-many-public-methods
 
     def delete_filenames(self, con):
         con.execute("DELETE FROM changed_files_mhashes")
+        con.execute("DELETE FROM changed_file_blocks")
 
     def determine_tests(self, exec_id, files_mhashes):
         with self.con as con:
             if not self._readonly:
+                # only rows of tests run last time, no rewrite of the others
                 con.execute(
-                    f"UPDATE test_execution set forced = NULL WHERE {self._test_execution_fk_column()} = ?",
+                    f"""UPDATE test_execution set forced = NULL
+                        WHERE {self._test_execution_fk_column()} = ? AND forced IS NOT NULL""",
                     [exec_id],
                 )
             self.delete_filenames(con)
             con.executemany(
-                "INSERT INTO changed_files_mhashes VALUES (?, ?, ?)",
+                """INSERT INTO changed_files_mhashes
+                   SELECT ?, id, ? FROM interned_filename WHERE filename = ?""",
                 [
-                    (exec_id, file, checksums_to_blob(mhashes) if mhashes else None)
+                    (exec_id, checksums_to_blob(mhashes) if mhashes else None, file)
                     for file, mhashes in files_mhashes.items()
                 ],
             )
 
-            results = []
-            for row in self.con.execute(
+            # blocks of the changed files at the fsha the environment's tests
+            # depend on, which of them are still there. A file can have block
+            # tables of several fshas, its checksums are hashed once.
+            files_known = {
+                filename: set(mhashes)
+                for filename, mhashes in files_mhashes.items()
+                if mhashes
+            }
+            changed_file_blocks = []
+            for row in con.execute(
                 f"""
                 SELECT
-                    f.filename,
-                    te.test_name,
-                    f.method_checksums,
-                    te.failed,
-                    te.duration
-                FROM test_execution te, test_execution_file_fp te_ffp, file_fp f, changed_files_mhashes chfm
+                    fn.filename,
+                    sefs.filename_id,
+                    sefs.fsha,
+                    fb.method_checksums
+                FROM changed_files_mhashes chfm
+                CROSS JOIN interned_filename fn
+                CROSS JOIN suite_execution_file_fsha sefs
+                LEFT JOIN file_block fb
+                    ON fb.filename_id = sefs.filename_id AND fb.fsha IS sefs.fsha
                 WHERE
-                    chfm.exec_id = ? AND
-                    te.{self._test_execution_fk_column()} = ? AND
-                    te.id = te_ffp.test_execution_id AND
-                    te_ffp.fingerprint_id = f.id AND
-                    chfm.filename = f.filename
+                    chfm.exec_id = :exec_id AND
+                    fn.id = chfm.filename_id AND
+                    sefs.{self._test_execution_fk_column()} = :exec_id AND
+                    sefs.filename_id = chfm.filename_id
                 """,
-                [exec_id, exec_id],
+                {"exec_id": exec_id},
             ):
-                results.append(
-                    [
-                        row["filename"],
-                        row["test_name"],
-                        blob_to_checksums(row["method_checksums"]),
-                    ]
+                known = files_known.get(row["filename"])
+                present = None
+                if known and row["method_checksums"] is not None:
+                    present = present_blocks(
+                        blob_to_checksums(row["method_checksums"]), known
+                    )
+                changed_file_blocks.append(
+                    (exec_id, row["filename_id"], row["fsha"], present)
                 )
+            con.executemany(
+                "INSERT INTO changed_file_blocks VALUES (?, ?, ?, ?)",
+                changed_file_blocks,
+            )
 
-            method_misses = []
-            for result in results:
-                if not check_fingerprint_db(files_mhashes, result[0], result[2]):
-                    method_misses.append(result[1])
+            # a fingerprint misses when a block it covered isn't among the
+            # blocks of the file now, or the file is gone
+            method_misses = [
+                row["test_name"]
+                for row in con.execute(
+                    f"""
+                    SELECT DISTINCT
+                        tn.test_name
+                    FROM changed_file_blocks cfb
+                    CROSS JOIN file_fp f
+                    CROSS JOIN dependency_set_file_fp dsf
+                    CROSS JOIN test_execution te
+                    CROSS JOIN interned_test_name tn
+                    WHERE
+                        cfb.exec_id = :exec_id AND
+                        f.filename_id = cfb.filename_id AND
+                        f.fsha IS cfb.fsha AND
+                        bitmap_misses(f.method_checksums, cfb.present) AND
+                        dsf.fingerprint_id = f.id AND
+                        te.dependency_set_id = dsf.dependency_set_id AND
+                        te.{self._test_execution_fk_column()} = :exec_id AND
+                        tn.id = te.test_name_id
+                    """,
+                    {"exec_id": exec_id},
+                )
+            ]
 
             failing_tests = [
                 row["test_name"]
                 for row in self.con.execute(
                     f"""
                     SELECT
-                        te.test_name
-                    FROM test_execution te
+                        tn.test_name
+                    FROM test_execution te, interned_test_name tn
                     WHERE
                         te.{self._test_execution_fk_column()} = ? AND
-                        te.failed = 1
+                        te.failed = 1 AND
+                        tn.id = te.test_name_id
                     """,
                     [exec_id],
                 )
@@ -559,21 +1199,12 @@ class DB:  # pylint: disable=too-many-public-methods
             return {"affected": method_misses, "failing": failing_tests}
 
     def delete_test_executions(self, test_names, exec_id):
-        self.con.executemany(
-            f"""
-            DELETE
-            FROM test_execution_file_fp
-            WHERE test_execution_id IN
-                (SELECT id FROM test_execution WHERE {self._test_execution_fk_column()} = ? AND test_name = ?)
-                """,
-            [(exec_id, test_name) for test_name in test_names],
-        )
         self.con.executemany(
             f"""
             DELETE
             FROM test_execution
             WHERE {self._test_execution_fk_column()} = ?
-              AND test_name = ?""",
+              AND test_name_id IN (SELECT id FROM interned_test_name WHERE test_name = ?)""",
             [(exec_id, test_name) for test_name in test_names],
         )
 
@@ -583,9 +1214,9 @@ class DB:  # pylint: disable=too-many-public-methods
             for row in self.con.execute(
                 f"""
                 SELECT
-                    test_name, duration, failed, forced
-                FROM test_execution
-                WHERE {self._test_execution_fk_column()} = ?
+                    tn.test_name, te.duration, te.failed, te.forced
+                FROM test_execution te, interned_test_name tn
+                WHERE te.{self._test_execution_fk_column()} = ? AND tn.id = te.test_name_id
                 """,
                 (exec_id,),
             )
@@ -595,13 +1226,15 @@ class DB:  # pylint: disable=too-many-public-methods
         cursor = self.con.execute(
             f"""
             SELECT DISTINCT
-                f.filename
+                fn.filename
             FROM
-                file_fp f, test_execution_file_fp te_ffp, test_execution te
+                file_fp f, dependency_set_file_fp dsf, test_execution te,
+                interned_filename fn
             WHERE
-                te.id = te_ffp.test_execution_id AND
-                te_ffp.fingerprint_id = f.id AND
-                te.{self._test_execution_fk_column()} = ?
+                te.dependency_set_id = dsf.dependency_set_id AND
+                dsf.fingerprint_id = f.id AND
+                te.{self._test_execution_fk_column()} = ? AND
+                fn.id = f.filename_id
                 """,
             (exec_id,),
         )
@@ -612,32 +1245,47 @@ class DB:  # pylint: disable=too-many-public-methods
     def all_filenames(self):
         cursor = self.con.execute(
             """
-            SELECT DISTINCT
-                f.filename
+            SELECT
+                fn.filename
             FROM
-                file_fp f
+                interned_filename fn
+            WHERE EXISTS (SELECT 1 FROM file_fp f WHERE f.filename_id = fn.id)
                 """,
         )
 
         return [row[0] for row in cursor]
 
+    def environment_filenames(self, exec_id):
+        """Files the tests of the environment depend on (maybe a few more, they
+        are removed at the end of the run)"""
+        cursor = self.con.execute(
+            f"""
+            SELECT fn.filename FROM environment_file ef, interned_filename fn
+            WHERE ef.{self._test_execution_fk_column()} = ? AND fn.id = ef.filename_id
+            """,
+            (exec_id,),
+        )
+
+        return [row[0] for row in cursor]
+
     def filenames_fingerprints(self, exec_id):
         cursor = self.con.execute(
             f"""
             SELECT DISTINCT
-                f.filename,
-                f.mtime,
+                fn.filename,
                 f.fsha,
                 f.id as fingerprint_id,
                 sum(failed)
             FROM
-                test_execution te, test_execution_file_fp te_ffp, file_fp f
+                test_execution te, dependency_set_file_fp dsf, file_fp f,
+                interned_filename fn
             WHERE
-                te.id = te_ffp.test_execution_id AND
-                te_ffp.fingerprint_id = f.id AND
-                {self._test_execution_fk_column()} = ?
+                te.dependency_set_id = dsf.dependency_set_id AND
+                dsf.fingerprint_id = f.id AND
+                {self._test_execution_fk_column()} = ? AND
+                fn.id = f.filename_id
             GROUP BY
-                f.filename, f.mtime, f.fsha, f.id
+                fn.filename, f.fsha, f.id
             """,
             (exec_id,),
         )
@@ -722,6 +1370,6 @@ class DB:  # pylint: disable=too-many-public-methods
         )
         return {
             "exec_id": exec_id,
-            "filenames": self.all_filenames(),
+            "filenames": self.environment_filenames(exec_id),
             "packages_changed": packages_changed,
         }
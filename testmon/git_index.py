@@ -0,0 +1,312 @@
+"""
+Reader of the git index file (.git/index), versions 2 to 4, including split
+index, sparse index and worktrees. See https://git-scm.com/docs/index-format
+
+It gives the blob sha of files whose stat data didn't change since git last
+looked at them, without forking git and without stat-ing the whole work tree.
+"""
+import hashlib
+import os
+import re
+import struct
+from collections import namedtuple
+
+ENTRY_STAT = struct.Struct(">10I")
+FLAGS = struct.Struct(">H")
+SHA1_SIZE = 20
+SHA256_SIZE = 32
+
+S_IFMT = 0o170000
+S_IFREG = 0o100000
+
+FLAG_EXTENDED = 0x4000
+FLAG_STAGE_MASK = 0x3000
+# IndexEntry.flags holds the extended flags in the upper 16 bits
+SKIP_WORKTREE = 0x4000 << 16
+INTENT_TO_ADD = 0x2000 << 16
+
+EMPTY_BLOB_SHAS = {
+    hashlib.sha1(b"blob 0\0").digest(),
+    hashlib.sha256(b"blob 0\0").digest(),
+}
+
+UINT32_MASK = 0xFFFFFFFF
+NS_PER_S = 1_000_000_000
+
+IndexEntry = namedtuple(
+    "IndexEntry",
+    "ctime_s ctime_ns mtime_s mtime_ns dev ino mode uid gid size sha flags",
+)
+
+
+class GitIndexError(Exception):
+    pass
+
+
+def find_git_dirs(directory):
+    """(worktree root, git dir, common git dir) of the repository containing
+    directory, or None. Handles .git files of worktrees and submodules."""
+    current_path = os.path.abspath(directory)
+    while True:
+        dot_git = os.path.join(current_path, ".git")
+        if os.path.isdir(dot_git):
+            git_dir = dot_git
+            break
+        if os.path.isfile(dot_git):
+            with open(dot_git, "r", encoding="utf8") as dot_git_file:
+                content = dot_git_file.read().strip()
+            if not content.startswith("gitdir:"):
+                raise GitIndexError(f"can't parse {dot_git}")
+            git_dir = os.path.join(current_path, content[len("gitdir:") :].strip())
+            break
+        if os.path.dirname(current_path) == current_path:
+            return None
+        current_path = os.path.dirname(current_path)
+
+    common_dir = git_dir
+    try:
+        with open(os.path.join(git_dir, "commondir"), "r", encoding="utf8") as file:
+            common_dir = os.path.join(git_dir, file.read().strip())
+    except FileNotFoundError:
+        pass
+    return current_path, os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def hash_size(common_dir):
+    try:
+        with open(os.path.join(common_dir, "config"), "r", encoding="utf8") as file:
+            config = file.read()
+    except FileNotFoundError:
+        return SHA1_SIZE
+    if re.search(r"^\s*objectformat\s*=\s*sha256\s*$", config, re.I | re.M):
+        return SHA256_SIZE
+    return SHA1_SIZE
+
+
+def decode_varint(data, pos):
+    byte = data[pos]
+    pos += 1
+    value = byte & 127
+    while byte & 128:
+        byte = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) + (byte & 127)
+    return value, pos
+
+
+def decode_ewah(data, pos):
+    """Positions of the bits set in an EWAH compressed bitmap, as written by
+    git's ewah/ewah_io.c, and the position after the bitmap."""
+    bit_size, word_count = struct.unpack_from(">II", data, pos)
+    pos += 8
+    words = struct.unpack_from(f">{word_count}Q", data, pos)
+    pos += 8 * word_count + 4  # skip the position of the last running length word
+
+    bits = []
+    bit = 0
+    i = 0
+    while i < word_count:
+        running_length_word = words[i]
+        running_length = (running_length_word >> 1) & UINT32_MASK
+        literal_words = running_length_word >> 33
+        if running_length_word & 1:
+            bits.extend(range(bit, bit + running_length * 64))
+        bit += running_length * 64
+        for literal in words[i + 1 : i + 1 + literal_words]:
+            while literal:
+                lowest = literal & -literal
+                bits.append(bit + lowest.bit_length() - 1)
+                literal ^= lowest
+            bit += 64
+        i += 1 + literal_words
+    return [bit for bit in bits if bit < bit_size], pos
+
+
+def parse_index(data, sha_size=SHA1_SIZE):
+    """[(name, (data, offset of the entry))] in index order and the split index
+    link (base sha, deleted positions, replaced positions) or None. Entries are
+    decoded by read_entry() only when needed."""
+    if data[:4] != b"DIRC":
+        raise GitIndexError("not a git index")
+    version, count = struct.unpack_from(">II", data, 4)
+    if version not in (2, 3, 4):
+        raise GitIndexError(f"unsupported index version {version}")
+
+    flags_offset = ENTRY_STAT.size + sha_size
+    entries = []
+    pos = 12
+    name = b""
+    for _ in range(count):
+        start = pos
+        (flags,) = FLAGS.unpack_from(data, pos + flags_offset)
+        pos += flags_offset + (4 if flags & FLAG_EXTENDED else 2)
+        if version == 4:
+            strip, pos = decode_varint(data, pos)
+            end = data.index(b"\0", pos)
+            name = name[: len(name) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b"\0", pos)
+            name = data[pos:end]
+            pos = start + ((end - start + 8) & ~7)
+        entries.append((name, (data, start)))
+
+    link = None
+    while pos + 8 <= len(data) - sha_size:
+        signature = data[pos : pos + 4]
+        (size,) = struct.unpack_from(">I", data, pos + 4)
+        pos += 8
+        if signature == b"link":
+            base_sha = data[pos : pos + sha_size]
+            deleted, replaced = [], []
+            if size > sha_size:
+                deleted, ewah_end = decode_ewah(data, pos + sha_size)
+                replaced, _ = decode_ewah(data, ewah_end)
+            link = (base_sha, deleted, replaced)
+        elif not b"A" <= signature[:1] <= b"Z" and signature != b"sdir":
+            raise GitIndexError(f"unsupported index extension {signature!r}")
+        pos += size
+    return entries, link
+
+
+def read_entry(location, sha_size):
+    data, pos = location
+    stat = ENTRY_STAT.unpack_from(data, pos)
+    pos += ENTRY_STAT.size
+    sha = data[pos : pos + sha_size]
+    (flags,) = FLAGS.unpack_from(data, pos + sha_size)
+    extended_flags = 0
+    if flags & FLAG_EXTENDED:
+        (extended_flags,) = FLAGS.unpack_from(data, pos + sha_size + 2)
+    return IndexEntry(*stat, sha, extended_flags << 16 | flags & FLAG_STAGE_MASK)
+
+
+def merge_split_index(base_entries, entries, deleted, replaced):
+    """Same as merge_base_index() in git's split-index.c"""
+    merged = list(base_entries)
+    for replacement, position in enumerate(replaced):
+        merged[position] = (merged[position][0], entries[replacement][1])
+    deleted = set(deleted)
+    return [
+        entry for position, entry in enumerate(merged) if position not in deleted
+    ] + entries[len(replaced) :]
+
+
+def read_index_file(index_path, git_dirs, sha_size=SHA1_SIZE):
+    try:
+        with open(index_path, "rb") as index_file:
+            entries, link = parse_index(index_file.read(), sha_size)
+        if link is None or not any(link[0]):
+            return entries
+        base_sha, deleted, replaced = link
+        for git_dir in git_dirs:
+            shared_index_path = os.path.join(git_dir, f"sharedindex.{base_sha.hex()}")
+            if os.path.exists(shared_index_path):
+                with open(shared_index_path, "rb") as index_file:
+                    base_entries, _ = parse_index(index_file.read(), sha_size)
+                return merge_split_index(base_entries, entries, deleted, replaced)
+    except (ValueError, IndexError, struct.error) as error:
+        raise GitIndexError(f"corrupt index {index_path}: {error}") from error
+    raise GitIndexError(f"shared index {base_sha.hex()} not found")
+
+
+def is_clean(entry, stat, index_mtime_ns):
+    """Stat data match, same as ie_match_stat() in git. Racily clean entries
+    (modified in the same timestamp granularity as the index) are not clean."""
+    mtime_ns = stat.st_mtime_ns
+    ctime_ns = stat.st_ctime_ns
+    if entry.mtime_s != (mtime_ns // NS_PER_S) & UINT32_MASK:
+        return False
+    if entry.ctime_s != (ctime_ns // NS_PER_S) & UINT32_MASK:
+        return False
+    # git built without nanosecond support stores 0
+    if entry.mtime_ns and entry.mtime_ns != mtime_ns % NS_PER_S:
+        return False
+    if entry.ctime_ns and entry.ctime_ns != ctime_ns % NS_PER_S:
+        return False
+    if entry.size != stat.st_size & UINT32_MASK:
+        return False
+    if entry.size == 0 and entry.sha not in EMPTY_BLOB_SHAS:
+        return False  # entry smudged by git as racy
+    if entry.ino and entry.ino != stat.st_ino & UINT32_MASK:
+        return False
+    if entry.mtime_ns:
+        return entry.mtime_s * NS_PER_S + entry.mtime_ns < index_mtime_ns
+    return entry.mtime_s < index_mtime_ns // NS_PER_S
+
+
+class WorktreeIndex:
+    """Index entries of files under directory, keyed by path relative to it."""
+
+    def __init__(self, directory, locations=None, index_mtime_ns=0, sha_size=SHA1_SIZE):
+        self.directory = directory
+        self.locations = locations or {}
+        self.index_mtime_ns = index_mtime_ns
+        self.sha_size = sha_size
+
+    def entry(self, filename):
+        """Entry of a regular, merged, checked out file, or None."""
+        location = self.locations.get(os.fsencode(filename))
+        if location is None:
+            return None
+        entry = read_entry(location, self.sha_size)
+        if (
+            entry.mode & S_IFMT != S_IFREG  # symlinks, submodules, sparse dirs
+            or entry.flags & (FLAG_STAGE_MASK | SKIP_WORKTREE | INTENT_TO_ADD)
+        ):
+            return None
+        return entry
+
+    @property
+    def entries(self):
+        entries = {}
+        for raw_name in self.locations:
+            name = os.fsdecode(raw_name)
+            entry = self.entry(name)
+            if entry:
+                entries[name] = entry
+        return entries
+
+    def clean_sha(self, filename):
+        entry = self.entry(filename)
+        if entry is None:
+            return None
+        try:
+            stat = os.lstat(os.path.join(self.directory, filename))
+        except OSError:
+            return None
+        if is_clean(entry, stat, self.index_mtime_ns):
+            return entry.sha.hex()
+        return None
+
+
+def read_worktree_index(directory):
+    git_dirs = find_git_dirs(directory)
+    if git_dirs is None:
+        return WorktreeIndex(directory)
+    worktree, git_dir, common_dir = git_dirs
+
+    index_path = os.path.join(git_dir, "index")
+    try:
+        index_mtime_ns = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return WorktreeIndex(directory)
+    sha_size = hash_size(common_dir)
+    index_entries = read_index_file(index_path, (git_dir, common_dir), sha_size)
+
+    prefix = os.path.relpath(
+        os.path.realpath(directory), os.path.realpath(worktree)
+    ).replace(os.sep, "/")
+    if prefix.startswith(".."):
+        return WorktreeIndex(directory)
+    if prefix == ".":
+        locations = dict(index_entries)
+    else:
+        prefix = os.fsencode(prefix + "/")
+        locations = {
+            name[len(prefix) :]: location
+            for name, location in index_entries
+            if name.startswith(prefix)
+        }
+    # a conflicted file has an entry per stage, any of them makes it not clean
+    return WorktreeIndex(directory, locations, index_mtime_ns, sha_size)
@@ -1,4 +1,8 @@
 import ast
+import importlib.util
+import marshal
+import os
+import sys
 import textwrap
 import zlib
 from functools import lru_cache
@@ -7,10 +11,13 @@ import hashlib
 from pathlib import Path
 from typing import Optional, Union
 from array import array
+from types import CodeType
 from subprocess import run, CalledProcessError
 
 from coverage.phystokens import source_encoding
 
+from testmon.git_index import GitIndexError, read_worktree_index
+
 CHECKUMS_ARRAY_TYPE = "i"
 
 
@@ -46,9 +53,57 @@ def checksums_to_blob(checksums: [int]) -> sqlite3.Binary:
 
 
 def blob_to_checksums(blob):
-    arr = array(CHECKUMS_ARRAY_TYPE)
-    arr.frombytes(blob)
-    return arr.tolist()
+    """Read-only sequence of the checksums, a view of blob (not a copy)"""
+    return memoryview(blob).cast(CHECKUMS_ARRAY_TYPE)
+
+
+def checksums_to_bitmap(checksums, block_positions) -> bytes:
+    """Fingerprint as a bitmap over the block table of its file: bit i is set
+    when the block at position i (block_positions is {checksum: i}) is covered"""
+    bitmap = 0
+    for checksum in checksums:
+        bitmap |= 1 << block_positions[checksum]
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+
+
+def bitmap_to_checksums(bitmap, block_table) -> [int]:
+    bits = int.from_bytes(bitmap, "little")
+    return [
+        checksum
+        for position, checksum in enumerate(block_table)
+        if bits >> position & 1
+    ]
+
+
+def present_blocks(block_table, known: set) -> bytes:
+    """Bitmap of the blocks of block_table which are among the known checksums"""
+    present = 0
+    for position, checksum in enumerate(block_table):
+        if checksum in known:
+            present |= 1 << position
+    return present.to_bytes((present.bit_length() + 7) // 8, "little")
+
+
+def bitmap_misses(bitmap, present) -> bool:
+    """Whether the fingerprint covers a block which isn't present any more"""
+    return bool(
+        int.from_bytes(bitmap, "little") & ~int.from_bytes(present, "little")
+    )
+
+
+def spans_to_blob(spans) -> sqlite3.Binary:
+    """Block spans (start, end, name) without the names, which are only used
+    for debugging."""
+    blob = array(CHECKUMS_ARRAY_TYPE)
+    for start, end, _ in spans:
+        blob.append(start)
+        blob.append(end)
+    return sqlite3.Binary(blob.tobytes())
+
+
+def blob_to_spans(blob):
+    arr = blob_to_checksums(blob)
+    return [(start, end, "") for start, end in zip(arr[::2], arr[1::2])]
 
 
 GAP_MARKS = {i: f"{i}GAP" for i in range(-1, 64)}
@@ -58,19 +113,15 @@ INVERTED_GAP_MARKS_CHECKSUMS = {
 
 
 class Block:
-    def __init__(self, start, end, code=0, name=""):
+    def __init__(self, start, end, checksum=0, name=""):
         # assert start <= end
         self.start = start
         self.end = end
         self.name = name
-        self.code = code
-
-    @property
-    def checksum(self):
-        return self.code
+        self.checksum = checksum
 
     def __repr__(self):
-        return f"{self.start}-{self.end} h: {self.checksum}, n:{self.name}, repr:{self.code}"
+        return f"{self.start}-{self.end} h: {self.checksum}, n:{self.name}"
 
     def __eq__(self, other):
         return (self.start, self.end, self.checksum, self.name) == (
@@ -108,6 +159,251 @@ def _next_lineno(nodes, i, end):
         return None
 
 
+BLOCK_OWNERS = ("AsyncFunctionDef", "FunctionDef", "Module")
+# nodes which can contain statements, and so functions
+STATEMENT_OWNERS = (ast.mod, ast.stmt, ast.excepthandler, ast.match_case)
+# number of text pieces buffered before they are fed to crc32
+CRC_CHUNK_SIZE = 2048
+MISSING = object()
+
+
+def block_counters(tree):
+    """{id(body): index} of function and module bodies in the order in which
+    their blocks are finished (post-order)."""
+    counters = {}
+
+    def visit(node):
+        for field_name, field_value in ast.iter_fields(node):
+            if isinstance(field_value, list):
+                for item in field_value:
+                    if isinstance(item, STATEMENT_OWNERS):
+                        visit(item)
+                if (
+                    field_value
+                    and field_name == "body"
+                    and node.__class__.__name__ in BLOCK_OWNERS
+                ):
+                    counters[id(field_value)] = len(counters)
+            elif isinstance(field_value, STATEMENT_OWNERS):
+                visit(field_value)
+
+    visit(tree)
+    return counters
+
+
+class BlockHasher:
+    """Splits a syntax tree into blocks: the bodies of functions and of the
+    module. The checksum of a block is the crc32 of its body represented the same
+    way as in ast.dump(tree, annotate_fields=False), except that the bodies of
+    nested functions are replaced with 'transformed_into_block' string, prefixed
+    with the index of the block. The text is fed to crc32 in chunks while walking
+    the tree, it's never built as a whole. More can be probably understood from
+    test_process_code.py examples.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.counters = block_counters(tree)
+        self.blocks = []
+        # text of the innermost block not fed to crc32 yet and crc32 of the
+        # text fed already; outer blocks wait in self.stack
+        self.pieces = []
+        self.crc = 0
+        self.stack = []
+
+    def hash_blocks(self, end):
+        self.walk(self.tree, end)
+        return self.blocks
+
+    def flush(self):
+        self.crc = zlib.crc32("".join(self.pieces).encode("UTF-8"), self.crc)
+        self.pieces.clear()
+
+    def walk(self, node, end, name="unknown", into_block=False):
+        pieces = self.pieces
+        if isinstance(node, ast.AST):
+            class_name = node.__class__.__name__
+            pieces.append(class_name + "(")
+            owns_block = class_name in BLOCK_OWNERS
+            node_name = getattr(node, "name", "unknown") if owns_block else name
+            first = True
+            for field_name in node._fields:  # same as ast.iter_fields()
+                field_value = getattr(node, field_name, MISSING)
+                if field_value is MISSING:
+                    continue
+                if first:
+                    first = False
+                else:
+                    pieces.append(", ")
+                if isinstance(field_value, (ast.AST, list)):
+                    self.walk(
+                        field_value,
+                        end,
+                        name=node_name,
+                        into_block=owns_block and field_name == "body",
+                    )
+                else:
+                    pieces.append(repr(field_value))
+            pieces.append(")")
+            if len(pieces) > CRC_CHUNK_SIZE:
+                self.flush()
+        elif isinstance(node, list):
+            into_block = into_block and node
+            if into_block:
+                self.stack.append((pieces, self.crc))
+                pieces = self.pieces = [f"{self.counters[id(node)]}:"]
+                self.crc = 0
+            for i, item in enumerate(node):
+                if i:
+                    pieces.append(", ")
+                if isinstance(item, STATEMENT_OWNERS):
+                    self.walk(item, _next_lineno(node, i, end))
+                elif isinstance(item, ast.AST):
+                    # no blocks inside, the end doesn't matter
+                    self.walk(item, None)
+                else:
+                    pieces.append(repr(item))
+            if into_block:
+                # Use last child's end_lineno only if end is not available (None)
+                if end is None:
+                    end = getattr(node[-1], "end_lineno", None)
+                self.flush()
+                self.blocks.append(
+                    Block(node[0].lineno, end, to_signed(self.crc), name=name)
+                )
+                self.pieces, self.crc = self.stack.pop()
+                self.pieces.append("transformed_into_block")
+        else:
+            pieces.append(repr(node))
+
+
+# fingerprint backends: blocks from the syntax tree or from code objects
+AST_BACKEND = "ast"
+BYTECODE_BACKEND = "bytecode"
+FINGERPRINT_BACKENDS = (AST_BACKEND, BYTECODE_BACKEND)
+BYTECODE_AVAILABLE = (
+    sys.implementation.name == "cpython" and sys.implementation.cache_tag is not None
+)
+
+CO_OPTIMIZED = 0x1
+PYC_HASH_BASED = 0x1
+PYC_HEADER_SIZE = 16
+
+
+def read_cached_code(path):
+    """Code object of the module at path from its unoptimized .pyc in
+    __pycache__ (whatever -O says, Module.code_object() compiles with
+    optimize=0), or None when there is none or it isn't valid for the source
+    (checked the way the import system does, for hash based pycs always)."""
+    try:
+        pyc_path = importlib.util.cache_from_source(path, optimization="")
+        with open(pyc_path, "rb") as pyc_file:
+            data = pyc_file.read()
+        stat = os.stat(path)
+    except (OSError, NotImplementedError, ValueError):
+        return None
+    if len(data) < PYC_HEADER_SIZE or data[:4] != importlib.util.MAGIC_NUMBER:
+        return None
+    flags = int.from_bytes(data[4:8], "little")
+    if flags & PYC_HASH_BASED:
+        try:
+            with open(path, "rb") as source_file:
+                source_hash = importlib.util.source_hash(source_file.read())
+        except OSError:
+            return None
+        if data[8:16] != source_hash:
+            return None
+    elif (
+        int.from_bytes(data[8:12], "little") != int(stat.st_mtime) & 0xFFFFFFFF
+        or int.from_bytes(data[12:16], "little") != stat.st_size & 0xFFFFFFFF
+    ):
+        return None
+    try:
+        code = marshal.loads(data[PYC_HEADER_SIZE:])
+    except (EOFError, ValueError, TypeError):
+        return None
+    return code if isinstance(code, CodeType) else None
+
+
+def canonical_repr(value):
+    """repr() of a constant which doesn't depend on PYTHONHASHSEED"""
+    if isinstance(value, frozenset):
+        return f"frozenset({{{', '.join(sorted(map(canonical_repr, value)))}}})"
+    if isinstance(value, tuple):
+        return f"({''.join(canonical_repr(item) + ', ' for item in value)})"
+    return repr(value)
+
+
+def is_function(code):
+    # class bodies aren't optimized, lambdas and comprehensions are <named>
+    return code.co_flags & CO_OPTIMIZED and not code.co_name.startswith("<")
+
+
+class CodeHasher:
+    """Blocks of a module from its code objects instead of its syntax tree.
+    Functions are blocks. Code of class bodies, lambdas and comprehensions is
+    part of the block containing it, the same as in the syntax tree, and code
+    of nested functions is replaced by 'transformed_into_block'. The checksum
+    covers bytecode, names and constants, not line numbers. Checksums differ
+    from the ones of BlockHasher and between Python versions."""
+
+    def __init__(self, code):
+        self.code = code
+        self.blocks = []
+
+    def hash_blocks(self):
+        crc, lines = self.hash_code(self.code)
+        if lines:
+            self.blocks.append(
+                Block(min(lines), max(lines), to_signed(crc), name=self.code.co_name)
+            )
+        return self.blocks
+
+    def hash_code(self, code, crc=0):
+        """crc32 of code with the code inlined into it and line numbers of all
+        the code in it, including nested functions."""
+        crc = zlib.crc32(code.co_code, crc)
+        signature = (
+            code.co_argcount,
+            code.co_posonlyargcount,
+            code.co_kwonlyargcount,
+            code.co_flags,
+            code.co_names,
+            code.co_varnames,
+            code.co_freevars,
+            code.co_cellvars,
+        )
+        crc = zlib.crc32(repr(signature).encode("UTF-8"), crc)
+        lines = {line for _, _, line in code.co_lines() if line}
+        # class bodies store their line number as __firstlineno__ (3.13+)
+        firstlineno = (
+            code.co_firstlineno if "__firstlineno__" in code.co_names else None
+        )
+        for const in code.co_consts:
+            if type(const) is int and const == firstlineno:  # not True
+                crc = zlib.crc32(b"__firstlineno__", crc)
+            elif isinstance(const, CodeType) and is_function(const):
+                lines |= self.add_block(const)
+                crc = zlib.crc32(b"transformed_into_block", crc)
+            elif isinstance(const, CodeType):
+                crc, const_lines = self.hash_code(const, crc)
+                lines |= const_lines
+            else:
+                crc = zlib.crc32(canonical_repr(const).encode("UTF-8"), crc)
+        return crc, lines
+
+    def add_block(self, code):
+        crc, lines = self.hash_code(code)
+        # the body, without the def (and decorators) line(s)
+        start = min(
+            (line for line in lines if line > code.co_firstlineno),
+            default=code.co_firstlineno,
+        )
+        end = max(lines, default=start)
+        self.blocks.append(Block(start, end, to_signed(crc), name=code.co_name))
+        return lines
+
+
 class Module:
     def __init__(  # pylint: disable=too-many-arguments
         self,
@@ -117,11 +413,12 @@ class Module:
         fs_fsha=None,
         filename=None,
         rootdir=None,
+        fingerprint_backend=AST_BACKEND,
     ):
         self.filename = filename
         self.rootdir = rootdir
+        self.fingerprint_backend = fingerprint_backend
         self._blocks = None
-        self.counter = 0
         self.mtime = mtime
         self._source_code = (
             None if source_code is None else textwrap.dedent(source_code)
@@ -131,83 +428,85 @@ class Module:
         )
         self.ext = ext
 
-    def dump_and_block(self, node, end, name="unknown", into_block=False):
-        """Frame of this method is taken from ast.dump
-        Objective is to return a representation of python source code where
-        all of the bodies of functions are replaced with 'transformed_into_block'
-        string. The rest of the syntax tree is represented in the same way as
-        in ast.dump(tree, annotate_fields=False). Of course the bodies of functions
-        are not completely thrown away, they are transformed into Block() objects
-        and appended to self.blocks. More can be probably understood from
-        (at the time rather messy) test_process_code.py examples.
-        """
+    @property
+    def checksums(self):
+        return self.method_checksums
 
-        if isinstance(node, ast.AST):
-            class_name = node.__class__.__name__
-            fields = []
-            for field_name, field_value in ast.iter_fields(node):
-                transform_into_block = (
-                    class_name in ("AsyncFunctionDef", "FunctionDef", "Module")
-                ) and field_name == "body"
-                fields.append(
-                    (
-                        field_name,
-                        self.dump_and_block(
-                            field_value,
-                            end,
-                            name=getattr(node, "name", "unknown"),
-                            into_block=transform_into_block,
-                        ),
-                    )
-                )
-            return f"{class_name}({', '.join((field_value for field_name, field_value in fields))})"
-        if isinstance(node, list):
-            representations = []
-            for i, item in enumerate(node):
-                representations.append(
-                    self.dump_and_block(item, _next_lineno(node, i, end))
-                )
-            if into_block and node:
-                # Use last child's end_lineno only if end is not available (None)
-                if end is None:
-                    last_child = node[-1]
-                    block_end = getattr(last_child, "end_lineno", None)
-                else:
-                    block_end = end
-                self._blocks.append(
-                    Block(
-                        node[0].lineno,
-                        block_end,
-                        code=str(self.counter) + ":" + ", ".join(representations),
-                        name=name,
-                    )
-                )
-                self.counter += 1
-                return "transformed_into_block"
-            return ", ".join(representations)
-        return repr(node)
+    @property
+    def parsed(self):
+        return self._blocks is not None
+
+    def load_blocks(self, spans, method_checksums):
+        """Use blocks extracted elsewhere (see parse_module())."""
+        self._blocks = [
+            Block(start, end, checksum, name)
+            for (start, end, name), checksum in zip(spans, method_checksums)
+        ]
 
     @property
-    def checksums(self):
-        return methods_to_checksums([block.checksum for block in self.blocks])
+    def uses_bytecode(self):
+        return (
+            self.ext == "py"
+            and self.fingerprint_backend == BYTECODE_BACKEND
+            and BYTECODE_AVAILABLE
+        )
+
+    @property
+    def kind(self):
+        """What the blocks depend on besides the source code."""
+        if self.uses_bytecode:
+            return f"{self.ext}:{BYTECODE_BACKEND}:{sys.implementation.cache_tag}"
+        return self.ext
+
+    @property
+    def block_spans(self):
+        return [(block.start, block.end, block.name) for block in self.blocks]
 
     @property
     def blocks(self):
+        if self._blocks is None and self.uses_bytecode:
+            code = self.code_object()
+            self._blocks = CodeHasher(code).hash_blocks() if code else []
         if self._blocks is None:
             self._blocks = []
+            if self.source_code is None:  # the file disappeared
+                return self._blocks
             lines = self.source_code.splitlines()
             if self.ext == "py":
                 try:
                     tree = ast.parse(self.source_code, filename="<unknown>")
-                    self.dump_and_block(tree, len(lines), name="<module>")
+                    self._blocks = BlockHasher(tree).hash_blocks(len(lines))
                 except SyntaxError:
                     # We can continue without blocks because no tests depending on this file will ever get executed,
                     # so no node depending on this checksum and mtime will ever be written to db.
                     pass
             else:
-                self._blocks = [Block(1, len(lines), self.source_code)]
+                checksum = methods_to_checksums([self.source_code])[0]
+                self._blocks = [Block(1, len(lines), checksum)]
         return self._blocks
 
+    def code_object(self):
+        """From the .pyc if there's a valid one, compiled otherwise. compile()
+        gives the same code objects, so checksums don't depend on pycs."""
+        path = None
+        if self.filename:
+            path = os.path.join(self.rootdir, self.filename)
+            code = read_cached_code(path)
+            if code is not None:
+                return code
+        if self.source_code is None:
+            return None
+        try:
+            return compile(
+                self.source_code,
+                path or "<unknown>",
+                "exec",
+                dont_inherit=True,
+                optimize=0,
+            )
+        except (SyntaxError, ValueError):
+            return None
+
     @property
     def source_code(self):
         if self._source_code is None:
@@ -216,7 +515,24 @@ class Module:
 
     @property
     def method_checksums(self):
-        return methods_to_checksums([block.checksum for block in self.blocks])
+        return [block.checksum for block in self.blocks]
+
+
+def parse_module(  # pylint: disable=too-many-arguments
+    source_code, filename, rootdir, ext="py", fsha=None, fingerprint_backend=None
+):
+    """Block spans and method checksums of a module, for Module.load_blocks().
+    Top level so that it can run in a process pool. Source code of files which
+    are clean in git wasn't read yet, it's read here."""
+    module = Module(
+        source_code=source_code,
+        ext=ext,
+        fs_fsha=fsha,
+        filename=filename,
+        rootdir=rootdir,
+        fingerprint_backend=fingerprint_backend or AST_BACKEND,
+    )
+    return module.block_spans, module.method_checksums
 
 
 def read_source_sha(filename: str):
@@ -232,7 +548,28 @@ def read_source_sha(filename: str):
     return source, fsha
 
 
+@lru_cache()
+def get_worktree_index(directory):
+    try:
+        return read_worktree_index(directory)
+    except (OSError, GitIndexError):
+        return None
+
+
 def noncached_get_files_shas(directory):
+    try:
+        index = read_worktree_index(directory)
+    except (OSError, GitIndexError):
+        return git_ls_files_shas(directory)
+    all_shas = {}
+    for filename in index.entries:
+        sha = index.clean_sha(filename)
+        if sha:
+            all_shas[filename] = sha
+    return all_shas
+
+
+def git_ls_files_shas(directory):
     all_shas = {}
     try:
         result = run(
@@ -264,11 +601,13 @@ def get_files_shas(directory):
 
 
 def get_source_sha(directory: "str", filename: "str"):
-    try:
-        sha = get_files_shas(directory)[filename]
+    index = get_worktree_index(directory)
+    if index is not None:
+        sha = index.clean_sha(filename)
+    else:  # index format we can't read, ask git
+        sha = get_files_shas(directory).get(filename)
+    if sha:
         return (None, sha)
-    except KeyError:
-        pass
     return read_source_sha(Path(directory) / filename)
 
 
@@ -289,18 +628,47 @@ def create_fingerprint_source(source_code, lines, ext="py"):
 
 
 def create_fingerprint(module, covered_lines) -> [int]:
-    blocks: [Block] = module.blocks
-    method_reprs = []
+    blocks = zip(module.blocks, module.method_checksums)
+    fingerprint = []
     line_index = 0
     sorted_lines = sorted(covered_lines)
 
-    for current_block in sorted(blocks, key=lambda x: x.start):
+    for current_block, checksum in sorted(blocks, key=lambda x: x[0].start):
         try:
             while sorted_lines[line_index] < current_block.start:
                 line_index += 1
             if sorted_lines[line_index] <= current_block.end:
-                method_reprs.append(current_block.code)
+                fingerprint.append(checksum)
         except IndexError:
             break
 
-    return methods_to_checksums(method_reprs)
+    return fingerprint
+
+
+def lines_to_bitmap(lines) -> int:
+    """Bit n is set when line n is among lines. It's the layout of coverage's
+    numbits read as a little-endian int."""
+    bitmap = 0
+    for line in lines:
+        bitmap |= 1 << line
+    return bitmap
+
+
+def bitmap_to_lines(lines_bitmap) -> [int]:
+    lines = []
+    while lines_bitmap:
+        lowest = lines_bitmap & -lines_bitmap
+        lines.append(lowest.bit_length() - 1)
+        lines_bitmap ^= lowest
+    return lines
+
+
+def create_fingerprint_from_bitmap(module, lines_bitmap) -> [int]:
+    """create_fingerprint() of the lines set in lines_bitmap, without a Python
+    object per line"""
+    blocks = zip(module.blocks, module.method_checksums)
+    return [
+        checksum
+        for block, checksum in sorted(blocks, key=lambda x: x[0].start)
+        if lines_bitmap >> block.start & ((1 << (block.end - block.start + 1)) - 1)
+    ]
@@ -18,16 +18,20 @@ from _pytest.terminal import TerminalReporter
 from testmon.configure import TmConf
 
 from testmon.testmon_core import (
+    BatchLimits,
     TestmonCollector,
     eval_environment,
     TestmonData,
     home_file,
     TestmonException,
+    WriteBehind,
     get_test_execution_class_name,
     get_test_execution_module_name,
     cached_relpath,
 )
-from testmon import configure
+from testmon import configure, db
+from testmon.process_code import FINGERPRINT_BACKENDS
+from testmon.tracer import TRACERS
 from testmon.common import get_logger, get_system_packages
 
 SURVEY_NOTIFICATION_INTERVAL = timedelta(days=28)
@@ -122,6 +126,75 @@ def pytest_addoption(parser):
         type="args",
         default=[],
     )
+    parser.addini(
+        "testmon_workers",
+        (
+            "Number of threads and processes used to read and parse changed files "
+            "(default: number of CPUs, at most 8; 1 disables parallelism)."
+        ),
+        default="",
+    )
+    parser.addini(
+        "testmon_fingerprint_backend",
+        (
+            "How method checksums are computed: 'ast' (default) from the syntax "
+            "tree, 'bytecode' from code objects (read from __pycache__ when "
+            "valid, faster on large code bases). Changing it reruns all tests."
+        ),
+        default="ast",
+    )
+    parser.addini(
+        "testmon_git_diff",
+        (
+            "Take the files changed since the previous run from git (commits since "
+            "then, index and work tree changes) instead of checking all files."
+        ),
+        type="bool",
+        default=False,
+    )
+    parser.addini(
+        "testmon_tracer",
+        (
+            "How the code each test runs is recorded: 'coverage' (default) by "
+            "coverage.py, 'blocks' by recording the functions (and class and "
+            "module bodies) each test enters, cheaper on CPU heavy tests, "
+            "'lines' by a sys.monitoring tool (Python 3.12+, coverage elsewhere)."
+        ),
+        default="coverage",
+    )
+    parser.addini(
+        "testmon_write_behind",
+        (
+            "Fingerprint and save test executions on a background thread while "
+            "the next tests run, instead of pausing the tests for each batch."
+        ),
+        type="bool",
+        default=False,
+    )
+    parser.addini(
+        "testmon_batch_max_lines",
+        (
+            "Save the tests' dependencies once the tests which haven't been saved "
+            "ran this many lines, summed over the tests (default: 1000000)."
+        ),
+        default="",
+    )
+    parser.addini(
+        "testmon_batch_max_memory",
+        (
+            "Save the tests' dependencies once the tests which haven't been saved "
+            "take about this many megabytes of memory (default: 64)."
+        ),
+        default="",
+    )
+    parser.addini(
+        "testmon_batch_max_seconds",
+        (
+            "Save the tests' dependencies at least every this many seconds "
+            "(default: 10)."
+        ),
+        default="",
+    )
     parser.addini("tmnet_url", "URL of the testmon.net api server.")
     parser.addini("tmnet_api_key", "testmon api key")
 
@@ -138,11 +211,34 @@ def testmon_options(config):
     return result
 
 
+def batch_limits(config):
+    limits = BatchLimits()
+    if config.getini("testmon_batch_max_lines"):
+        limits.lines = int(config.getini("testmon_batch_max_lines"))
+    if config.getini("testmon_batch_max_memory"):
+        limits.memory = int(float(config.getini("testmon_batch_max_memory")) * 2**20)
+    if config.getini("testmon_batch_max_seconds"):
+        limits.seconds = float(config.getini("testmon_batch_max_seconds"))
+    return limits
+
+
 def init_testmon_data(config: Config):
     environment = config.getoption("environment_expression") or eval_environment(
         config.getini("environment_expression")
     )
     ignore_dependencies = config.getini("testmon_ignore_dependencies")
+    workers = config.getini("testmon_workers")
+    workers = int(workers) if workers else None
+    fingerprint_backend = config.getini("testmon_fingerprint_backend")
+    if fingerprint_backend not in FINGERPRINT_BACKENDS:
+        raise ValueError(
+            f"testmon_fingerprint_backend must be one of {FINGERPRINT_BACKENDS}, "
+            f"not {fingerprint_backend!r}"
+        )
+    git_diff = config.getini("testmon_git_diff")
+    tracer = config.getini("testmon_tracer")
+    if tracer not in TRACERS:
+        raise ValueError(f"testmon_tracer must be one of {TRACERS}, not {tracer!r}")
 
     system_packages = get_system_packages(ignore=ignore_dependencies)
 
@@ -201,6 +297,10 @@ def init_testmon_data(config: Config):
             system_packages_change=system_packages_change,
             files_of_interest=files_of_interest,
             environment=environment,
+            # xdist already runs a process per CPU
+            workers=workers or 1,
+            fingerprint_backend=fingerprint_backend,
+            git_diff=git_diff,
         )
     else:
         # Initialize for local run (controller or single process)
@@ -209,6 +309,9 @@ def init_testmon_data(config: Config):
             database=rpc_proxy,
             environment=environment,
             system_packages=system_packages,
+            workers=workers,
+            fingerprint_backend=fingerprint_backend,
+            git_diff=git_diff,
         )
     testmon_data.determine_stable()
     config.testmon_data = testmon_data
@@ -237,9 +340,12 @@ def register_plugins(config, should_select, should_collect, cov_plugin):
                     config.rootdir.strpath,
                     testmon_labels=testmon_options(config),
                     cov_plugin=cov_plugin,
+                    tracer=config.getini("testmon_tracer"),
+                    batch_limits=batch_limits(config),
                 ),
                 config.testmon_data,
                 running_as=get_running_as(config),
+                write_behind=config.getini("testmon_write_behind"),
             ),
             "TestmonCollect",
         )
@@ -349,12 +455,25 @@ def pytest_unconfigure(config):
 
 
 class TestmonCollect:
-    def __init__(
-        self, testmon, testmon_data: TestmonData, running_as="single", cov_plugin=None
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        testmon,
+        testmon_data: TestmonData,
+        running_as="single",
+        cov_plugin=None,
+        write_behind=False,
     ):
         self.testmon_data: TestmonData = testmon_data
         self.testmon: TestmonCollector = testmon
         self._running_as = running_as
+        # testmon.net is written to synchronously
+        self.writer = (
+            WriteBehind(testmon_data)
+            if write_behind
+            and running_as != "worker"
+            and isinstance(testmon_data.db, db.DB)
+            else None
+        )
 
         self.reports = defaultdict(lambda: {})
         self.raw_test_names = []
@@ -413,24 +532,38 @@ class TestmonCollect:
         self.reports[report.nodeid][report.when] = report
         if report.when == "teardown" and hasattr(report, "nodes_files_lines"):
             if report.nodes_files_lines:
-                test_executions_fingerprints = self.testmon_data.get_tests_fingerprints(
-                    report.nodes_files_lines, self.reports
-                )
-                self.testmon_data.save_test_execution_file_fps(
-                    test_executions_fingerprints
-                )
-
-    def pytest_keyboard_interrupt(self, excinfo):  # pylint: disable=unused-argument
-        if self._running_as == "single":
-            nodes_files_lines = self.testmon.get_batch_coverage_data()
-
+                self.save_batch(report.nodes_files_lines)
+
+    def save_batch(self, nodes_files_lines):
+        started = time.perf_counter()
+        if self.writer:
+            # the reports of the batch are complete, later ones are still added
+            self.writer.put(
+                nodes_files_lines,
+                {name: dict(self.reports[name]) for name in nodes_files_lines},
+            )
+        else:
             test_executions_fingerprints = self.testmon_data.get_tests_fingerprints(
                 nodes_files_lines, self.reports
             )
             self.testmon_data.save_test_execution_file_fps(test_executions_fingerprints)
+        logger.debug(
+            "batch of %d tests %s in %.1fms",
+            len(nodes_files_lines),
+            "queued" if self.writer else "saved",
+            (time.perf_counter() - started) * 1000,
+        )
+
+    def pytest_keyboard_interrupt(self, excinfo):  # pylint: disable=unused-argument
+        if self._running_as == "single":
+            self.save_batch(self.testmon.get_batch_coverage_data())
+            if self.writer:
+                self.writer.close()
             self.testmon.close()
 
     def pytest_sessionfinish(self, session):  # pylint: disable=unused-argument
+        if self.writer:
+            self.writer.close()
         if self._running_as in ("single", "controller"):
             self.testmon_data.db.finish_execution(
                 self.testmon_data.exec_id,
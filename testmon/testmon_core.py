@@ -1,9 +1,18 @@
+import copy
 import hashlib
+import multiprocessing
 import os
+import queue
 import random
+import sqlite3
 import sys
 import sysconfig
 import textwrap
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
 from functools import lru_cache
 from collections import defaultdict
 from xmlrpc.client import Fault, ProtocolError
@@ -26,21 +35,53 @@ from testmon.common import (
     get_system_packages,
     drop_patch_version,
     git_current_head,
+    git_head_commit,
+    git_changed_files,
 )
 
 from testmon.process_code import (
     match_fingerprint,
-    create_fingerprint,
+    create_fingerprint_from_bitmap,
+    bitmap_to_lines,
     methods_to_checksums,
     get_source_sha,
+    get_files_shas,
+    get_worktree_index,
+    parse_module,
     Module,
+    AST_BACKEND,
 )
 
 from testmon.common import DepsNOutcomes, TestExecutions
+from testmon.tracer import COVERAGE_TRACER, make_tracer
+from testmon.watch import changed_since
 
 T = TypeVar("T")
 
-TEST_BATCH_SIZE = 250
+# a batch of tests is saved when its tests ran this many lines (summed over
+# the tests), it takes this many bytes (see TestmonCollector.batch_memory())
+# or it started this many seconds ago
+BATCH_MAX_LINES = 1_000_000
+BATCH_MAX_MEMORY = 64 * 2**20
+BATCH_MAX_SECONDS = 10
+# bytes a measured file of a test costs besides its lines: a coverage row and
+# the entries of nodes_files_lines
+MEASURED_FILE_BYTES = 200
+
+# coverage's data internals read_contexts_lines() uses raise these when they
+# changed
+COVERAGE_INTERNALS_ERRORS = (AttributeError, sqlite3.Error)
+
+# batches waiting for the write-behind thread before the tests wait for it
+WRITE_BEHIND_QUEUE_SIZE = 4
+
+# seconds; files modified this close to a scan don't get their stat stored
+RACY_MTIME_WINDOW = 2
+
+# below these numbers of files starting a pool costs more than it saves
+THREAD_POOL_MIN_FILES = 16
+PROCESS_POOL_MIN_FILES = 100
+MAX_DEFAULT_WORKERS = 8
 
 CHECKUMS_ARRAY_TYPE = "I"
 DB_FILENAME = ".testmondata"
@@ -76,41 +117,110 @@ class SourceTree:
       based on mtime, fsha)
     """
 
-    def __init__(self, rootdir, packages=None):
+    def __init__(self, rootdir, packages=None, workers=None, fingerprint_backend=None):
         self.rootdir = rootdir
         self.packages = packages
+        self.fingerprint_backend = fingerprint_backend or AST_BACKEND
+        self.workers = workers or min(os.cpu_count() or 1, MAX_DEFAULT_WORKERS)
         self.cache: dict = {}
+        self.stats: dict = {}
+
+    def get_stat(self, filename):
+        if filename not in self.stats:
+            try:
+                stat = os.stat(os.path.join(self.rootdir, filename))
+                self.stats[filename] = (stat.st_mtime, stat.st_size, stat.st_ino)
+            except OSError:
+                self.stats[filename] = None
+        return self.stats[filename]
+
+    def read_file(self, filename):
+        # stat before reading, so that a stored stat never vouches for
+        # content newer than the one we hashed
+        fs_stat = self.get_stat(filename)
+        code, fsha = get_source_sha(directory=self.rootdir, filename=filename)
+        if fsha and fs_stat:
+            return Module(
+                source_code=code,
+                mtime=fs_stat[0],
+                ext=filename.rsplit(".", 1)[1],
+                fs_fsha=fsha,
+                filename=filename,
+                rootdir=self.rootdir,
+                fingerprint_backend=self.fingerprint_backend,
+            )
+        return None
 
     def get_file(self, filename):
         if filename not in self.cache:
-            code, fsha = get_source_sha(directory=self.rootdir, filename=filename)
-            if fsha:
-                try:
-                    fs_mtime = os.path.getmtime(os.path.join(self.rootdir, filename))
-                    self.cache[filename] = Module(
-                        source_code=code,
-                        mtime=fs_mtime,
-                        ext=filename.rsplit(".", 1)[1],
-                        fs_fsha=fsha,
-                        filename=filename,
-                        rootdir=self.rootdir,
-                    )
-                except FileNotFoundError:
-                    self.cache[filename] = None
-            else:
-                self.cache[filename] = None
+            self.cache[filename] = self.read_file(filename)
         return self.cache[filename]
 
+    def get_files(self, filenames):
+        """{filename: Module or None}. Files which weren't read yet are read and
+        hashed in a thread pool (file reads and sha1 release the GIL)."""
+        missing = [filename for filename in filenames if filename not in self.cache]
+        if self.workers > 1 and len(missing) >= THREAD_POOL_MIN_FILES:
+            # read the git index (or run git) once, not in each thread
+            if get_worktree_index(self.rootdir) is None:
+                get_files_shas(self.rootdir)
+            with ThreadPoolExecutor(self.workers) as executor:
+                self.cache.update(zip(missing, executor.map(self.read_file, missing)))
+        else:
+            for filename in missing:
+                self.cache[filename] = self.read_file(filename)
+        return {filename: self.cache[filename] for filename in filenames}
+
+    def get_method_checksums(self, filenames):
+        """{filename: method checksums or None}. When there are many modules
+        to parse, blocks are extracted in a process pool. Results are the same
+        and in the same order as when parsing one by one."""
+        modules = self.get_files(filenames)
+        unparsed = [
+            module
+            for module in dict.fromkeys(modules.values())
+            if module and not module.parsed
+        ]
+        if self.workers > 1 and len(unparsed) >= PROCESS_POOL_MIN_FILES:
+            self.parse_in_processes(unparsed)
+        return {
+            filename: module.method_checksums if module else None
+            for filename, module in modules.items()
+        }
 
-def check_mtime(file_system: SourceTree, record):
-    absfilename = os.path.join(file_system.rootdir, record["filename"])
+    def parse_in_processes(self, modules):
+        try:
+            with ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                # source code of files clean in git is read by the workers
+                sources = [
+                    module._source_code  # pylint: disable=protected-access
+                    for module in modules
+                ]
+                parsed = executor.map(
+                    parse_module,
+                    sources,
+                    [module.filename for module in modules],
+                    [self.rootdir] * len(modules),
+                    [module.ext for module in modules],
+                    [module.fs_fsha for module in modules],
+                    [self.fingerprint_backend] * len(modules),
+                    chunksize=max(1, len(modules) // (self.workers * 4)),
+                )
+                for module, (spans, method_checksums) in zip(modules, parsed):
+                    module.load_blocks(spans, method_checksums)
+        except (OSError, BrokenProcessPool) as error:
+            # modules which didn't get their blocks parse them lazily
+            logger.info("parsing in a process pool failed: %s", error)
 
-    cache_module = file_system.cache.get(record["filename"], None)
-    try:
-        fs_mtime = cache_module.mtime if cache_module else os.path.getmtime(absfilename)
-    except OSError:
-        return False
-    return record["mtime"] == fs_mtime
+
+def check_mtime(file_system: SourceTree, record):
+    return file_system.get_stat(record["filename"]) == (
+        record["mtime"],
+        record["fsize"],
+        record["inode"],
+    )
 
 
 def check_fsha(file_system, record):
@@ -147,10 +257,27 @@ def should_include(cov, filename):
 
 
 def collect_mhashes(source_tree, new_changed_file_data):
-    files_mhashes = {}
-    for filename in new_changed_file_data:
-        module = source_tree.get_file(filename)
-        files_mhashes[filename] = module.method_checksums if module else None
+    return source_tree.get_method_checksums(list(new_changed_file_data))
+
+
+def load_parsed_modules(database, source_tree, filenames):
+    """Method checksums of files, taking blocks of content parsed at any previous
+    run from the DB and storing the ones parsed now."""
+    unparsed = defaultdict(list)
+    for module in source_tree.get_files(filenames).values():
+        if module and not module.parsed:
+            unparsed[(module.fs_fsha, module.kind)].append(module)
+    for key, (spans, method_checksums) in database.fetch_parsed_modules(
+        unparsed
+    ).items():
+        for module in unparsed.pop(key):
+            module.load_blocks(spans, method_checksums)
+
+    files_mhashes = source_tree.get_method_checksums(filenames)
+    database.insert_parsed_modules(
+        (fsha, kind, modules[0].block_spans, modules[0].method_checksums)
+        for (fsha, kind), modules in unparsed.items()
+    )
     return files_mhashes
 
 
@@ -162,9 +289,18 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
         rootdir,
         database=None,
         readonly=False,
-    ):
+        workers=None,
+        fingerprint_backend=None,
+        git_diff=False,
+    ):  # pylint: disable=too-many-arguments
         self.rootdir = rootdir
-        self.source_tree = SourceTree(rootdir=self.rootdir)
+        self.readonly = readonly
+        self.git_diff = git_diff
+        self.source_tree = SourceTree(
+            rootdir=self.rootdir,
+            workers=workers,
+            fingerprint_backend=fingerprint_backend,
+        )
 
         if database:
             self.db = database  # pylint: disable=invalid-name
@@ -193,8 +329,18 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
         environment=None,
         system_packages=None,
         python_version=None,
-    ):
-        instance = cls(rootdir, database=database, readonly=False)
+        workers=None,
+        fingerprint_backend=None,
+        git_diff=False,
+    ):  # pylint: disable=too-many-arguments
+        instance = cls(
+            rootdir,
+            database=database,
+            readonly=False,
+            workers=workers,
+            fingerprint_backend=fingerprint_backend,
+            git_diff=git_diff,
+        )
         instance._init_for_local_run(environment, system_packages, python_version)
         return instance
 
@@ -254,8 +400,18 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
         system_packages_change=None,
         files_of_interest=None,
         environment=None,
+        workers=None,
+        fingerprint_backend=None,
+        git_diff=False,
     ):
-        instance = cls(rootdir, database=database, readonly=True)
+        instance = cls(
+            rootdir,
+            database=database,
+            readonly=True,
+            workers=workers,
+            fingerprint_backend=fingerprint_backend,
+            git_diff=git_diff,
+        )
         instance._init_for_worker(
             exec_id, system_packages_change, files_of_interest, environment
         )
@@ -295,17 +451,25 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
 
     def get_tests_fingerprints(self, nodes_files_lines, reports) -> TestExecutions:
         test_executions_fingerprints = {}
+        self.get_method_checksums(
+            sorted(
+                {
+                    filename
+                    for files_lines in nodes_files_lines.values()
+                    for filename in files_lines
+                }
+            )
+        )
         for context in nodes_files_lines:
             deps_n_outcomes: DepsNOutcomes = {"deps": []}
 
             for filename, covered in nodes_files_lines[context].items():
                 if os.path.exists(os.path.join(self.rootdir, filename)):
                     module = self.source_tree.get_file(filename)
-                    fingerprint = create_fingerprint(module, covered)
+                    fingerprint = create_fingerprint_from_bitmap(module, covered)
                     deps_n_outcomes["deps"].append(
                         {
                             "filename": filename,
-                            "mtime": module.mtime,
                             "fsha": module.fs_fsha,
                             "method_checksums": fingerprint,
                         }
@@ -328,7 +492,6 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
                         {
                             "filename": home_file(test_name),
                             "method_checksums": methods_to_checksums(["0match"]),
-                            "mtime": None,
                             "fsha": None,
                         },
                     )
@@ -343,19 +506,113 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
         with self.db as database:
             database.delete_test_executions(to_delete, self.exec_id)
 
-    def determine_stable(self):
+    def get_files_fshas(self, filenames):
+        """fsha of each existing file. Files with the same mtime, size and inode
+        as stored at the previous run are trusted without reading them. When
+        testmon-watch runs, files it didn't see change aren't even stat-ed."""
+        scan_started = time.time()
+        local = isinstance(self.db, db.DB)
+        file_stats = self.db.fetch_file_stats() if local else {}
+        watched_changes, watch_state = None, None
+        if local and not self.readonly:
+            watched_changes, watch_state = changed_since(
+                self.rootdir,
+                self.db.fetch_attribute("watch_state", exec_id=self.exec_id),
+            )
         files_fshas = {}
-        for filename in self.files_of_interest:
-            module = self.source_tree.get_file(filename)
+        changed = []
+        for filename in filenames:
+            record = file_stats.get(filename)
+            if record and (
+                (watched_changes is not None and filename not in watched_changes)
+                or check_mtime(self.source_tree, record)
+            ):
+                files_fshas[filename] = record["fsha"]
+            else:
+                changed.append(filename)
+
+        for filename, module in self.source_tree.get_files(changed).items():
             if module:
                 files_fshas[filename] = module.fs_fsha
 
-        # Compare the fshas from disk to the fshas in the database and get files
-        # where the fsha is not in database.
-        new_changed_file_data = self.db.fetch_unknown_files(files_fshas, self.exec_id)
+        if changed and local:
+            new_mtimes = list(get_new_mtimes(self.source_tree, changed, scan_started))
+            self.db.update_mtimes(new_mtimes)
+            if watch_state:
+                # testmon-watch won't report these again, next time their stat
+                # has to be checked
+                self.db.delete_file_stats(
+                    set(changed) - {filename for filename, *_ in new_mtimes}
+                )
+        if watch_state:
+            self.db.write_attribute("watch_state", watch_state, exec_id=self.exec_id)
+        return files_fshas
+
+    def get_method_checksums(self, filenames):
+        if isinstance(self.db, db.DB):
+            return load_parsed_modules(self.db, self.source_tree, filenames)
+        return collect_mhashes(self.source_tree, filenames)
+
+    def get_git_changes(self):
+        """(files of interest which could have changed since the commit stored at
+        the previous run, git state to store for the next run). The files are
+        the ones changed in commits since then, the ones which differed from
+        that commit or from the DB then and the ones which differ from HEAD now.
+        Files git doesn't track are always included. None instead of the files
+        when git can't tell, all of them have to be checked then."""
+        if not self.git_diff or not isinstance(self.db, db.DB):
+            return None, None
+        head_commit = git_head_commit(self.rootdir)
+        index = get_worktree_index(self.rootdir)
+        if head_commit is None or index is None:
+            return None, None
+        synced = self.db.fetch_attribute("git_sync", {}, exec_id=self.exec_id)
+        changes = git_changed_files(self.rootdir, synced.get("commit"), head_commit)
+        if changes is None:
+            return None, None
+        committed, dirty = changes
+        git_state = {"commit": head_commit, "files": sorted(dirty)}
+        if committed is None:
+            return None, git_state
+        changed = committed | dirty | set(synced["files"])
+        return [
+            filename
+            for filename in self.files_of_interest
+            if filename in changed or index.entry(filename) is None
+        ], git_state
+
+    def determine_stable(self):
+        changed_files, git_state = self.get_git_changes()
+        if changed_files is None:
+            files_fshas = self.get_files_fshas(self.files_of_interest)
+
+            # Compare the fshas from disk to the fshas in the database and get files
+            # where the fsha is not in database.
+            new_changed_file_data = self.db.fetch_unknown_files(
+                files_fshas, self.exec_id
+            )
+        else:
+            # files git didn't report are the same as at the previous run
+            files_fshas = self.get_files_fshas(changed_files)
+            new_changed_file_data = self.db.fetch_unknown_files(
+                {filename: files_fshas.get(filename) for filename in changed_files},
+                self.exec_id,
+                listed_only=True,
+            )
+        if not self.readonly and isinstance(self.db, db.DB):
+            if git_state:
+                # unknown files stay unknown until their tests run, check them
+                # again
+                git_state["files"] = sorted(
+                    set(git_state["files"]).union(new_changed_file_data)
+                )
+            # a run without git state (testmon_git_diff off or git couldn't
+            # tell) changes the data in ways a later git diff can't see, the
+            # next run with it starts with all files
+            self.db.write_attribute("git_sync", git_state or {}, exec_id=self.exec_id)
 
         # Get the mhashes for the files from above
-        files_mhashes = collect_mhashes(self.source_tree, new_changed_file_data)
+        files_mhashes = self.get_method_checksums(list(new_changed_file_data))
 
         tests = self.db.determine_tests(self.exec_id, files_mhashes)
         affected_tests, self.failing_tests = tests["affected"], tests["failing"]
@@ -408,18 +665,92 @@ class TestmonData:  # pylint: disable=too-many-instance-attributes
         return self.db.fetch_saving_stats(self.exec_id, select)
 
 
-def get_new_mtimes(filesystem, hits):
-    """hits: [(filename, _, _, fingerprint_id)]"""
-    try:
-        for hit in hits:
-            module = filesystem.get_file(hit[0])
-            if module:
-                yield module.mtime, module.fs_fsha, hit[3]
-    except KeyError:
-        for hit in hits:
-            module = filesystem.get_file(hit["filename"])
-            if module:
-                yield module.mtime, module.fs_fsha, hit["fingerprint_id"]
+class WriteBehind:
+    """Fingerprints batches of test executions and saves them on a thread, with
+    its own connection to the DB and its own source tree, while the next tests
+    run. The source tree starts with the modules read before the run, so the
+    fingerprints are of the code which ran even if a test rewrites a file.
+    The queue is bounded: when the thread falls behind, put() waits for
+    it. Errors are raised on the main thread, at the next put() or at close(),
+    later batches are dropped."""
+
+    def __init__(self, testmon_data: "TestmonData", queue_size=WRITE_BEHIND_QUEUE_SIZE):
+        self.testmon_data = testmon_data
+        self.modules = dict(testmon_data.source_tree.cache)
+        self.queue = queue.Queue(queue_size)
+        self.failed = False
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, name="testmon-write-behind", daemon=True
+        )
+        self.thread.start()
+
+    def put(self, nodes_files_lines, reports):
+        self.raise_error()
+        if self.queue.full():
+            logger.debug("waiting for the write-behind thread to save a batch")
+        self.queue.put((nodes_files_lines, reports))
+
+    def run(self):
+        testmon_data = None
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.failed:
+                continue  # keep taking batches, put() mustn't block forever
+            try:
+                if testmon_data is None:
+                    testmon_data = self.writer_data()
+                testmon_data.save_test_execution_file_fps(
+                    testmon_data.get_tests_fingerprints(*batch)
+                )
+            except Exception as error:  # pylint: disable=broad-except
+                self.failed = True
+                self.error = error
+        if testmon_data:
+            testmon_data.db.con.close()
+
+    def writer_data(self):
+        """Copy of testmon_data for the thread, the objects it writes to are its
+        own"""
+        testmon_data = copy.copy(self.testmon_data)
+        database = self.testmon_data.db
+        testmon_data.db = type(database)(  # pylint: disable=invalid-name
+            database.datafile
+        )
+        source_tree = self.testmon_data.source_tree
+        testmon_data.source_tree = SourceTree(
+            source_tree.rootdir,
+            packages=source_tree.packages,
+            workers=source_tree.workers,
+            fingerprint_backend=source_tree.fingerprint_backend,
+        )
+        testmon_data.source_tree.cache.update(self.modules)
+        return testmon_data
+
+    def close(self):
+        """Wait until all the batches are saved"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+
+def get_new_mtimes(filesystem, filenames, scan_started):
+    """(filename, mtime, fsize, inode, fsha) for files read during this run.
+    Files modified shortly before the scan are skipped: a later write within
+    the same timestamp granularity would leave their stat unchanged."""
+    for filename in filenames:
+        module = filesystem.cache.get(filename)
+        fs_stat = filesystem.get_stat(filename)
+        if module and fs_stat and fs_stat[0] < scan_started - RACY_MTIME_WINDOW:
+            yield (filename, *fs_stat, module.fs_fsha)
 
 
 def get_test_execution_class_name(node_id):
@@ -437,11 +768,83 @@ def cached_relpath(path, basepath):
     return os.path.relpath(path, basepath).replace(os.sep, "/")
 
 
+def read_contexts_lines(cov_data: CoverageData):
+    """(context, measured file, bitmap of lines) of all the lines measured, in
+    one query. Coverage stores lines as numbits (bit n is set when line n ran),
+    they're kept that way instead of contexts_by_lineno() building a set of
+    contexts per line of each file. The query relies on coverage's internals
+    (6.0 to 7.x), contexts_by_lineno() is used when they aren't as expected."""
+    try:
+        rows = query_line_bits(cov_data)
+    except COVERAGE_INTERNALS_ERRORS:
+        return read_contexts_by_lineno(cov_data)
+    return [
+        (context, file, int.from_bytes(numbits, "little"))
+        for context, file, numbits in rows
+    ]
+
+
+def query_line_bits(cov_data: CoverageData):
+    """[(context, measured file, numbits)] from coverage's database"""
+    cov_data._start_using()  # pylint: disable=protected-access
+    with cov_data._connect() as con:  # pylint: disable=protected-access
+        return con.con.execute(
+            """
+            SELECT context.context, file.path, line_bits.numbits
+            FROM line_bits, context, file
+            WHERE line_bits.context_id = context.id AND line_bits.file_id = file.id
+            """
+        ).fetchall()
+
+
+def delete_line_bits(cov_data: CoverageData):
+    with cov_data._connect() as con:  # pylint: disable=protected-access
+        con.con.execute("DELETE FROM line_bits")
+
+
+def read_contexts_by_lineno(cov_data: CoverageData):
+    """read_contexts_lines() through coverage's public API"""
+    contexts_lines = defaultdict(int)
+    for file in cov_data.measured_files():
+        for line, contexts in cov_data.contexts_by_lineno(file).items():
+            for context in contexts:
+                contexts_lines[(context, file)] |= 1 << line
+    return [
+        (context, file, lines_bitmap)
+        for (context, file), lines_bitmap in contexts_lines.items()
+    ]
+
+
+def drain_contexts_lines(cov_data: CoverageData):
+    """read_contexts_lines() and delete them from cov_data, so that coverage can
+    keep measuring into it instead of being stopped and erased. Files and
+    contexts stay, coverage caches their ids. Without the expected internals
+    cov_data is erased, coverage starts over from its current context."""
+    contexts_lines = read_contexts_lines(cov_data)
+    try:
+        delete_line_bits(cov_data)
+    except COVERAGE_INTERNALS_ERRORS:
+        cov_data.erase()
+    return contexts_lines
+
+
+@dataclass
+class BatchLimits:
+    lines: int = BATCH_MAX_LINES
+    memory: int = BATCH_MAX_MEMORY
+    seconds: float = BATCH_MAX_SECONDS
+
+
 class TestmonCollector:
     coverage_stack: [Coverage] = []
 
     def __init__(
-        self, rootdir, testmon_labels=None, cov_plugin=None
+        self,
+        rootdir,
+        testmon_labels=None,
+        cov_plugin=None,
+        tracer=COVERAGE_TRACER,
+        batch_limits=None,
     ):  # TODO remove cov_plugin
         try:
             from testmon.testmon_core import (  # pylint: disable=import-outside-toplevel
@@ -456,12 +859,20 @@ class TestmonCollector:
         self.rootdir = rootdir
         self.testmon_labels = testmon_labels
         self.cov: Coverage = None
+        # used instead of coverage, it doesn't take part in the coverage_stack.
+        # Coverage takes over when it can't start.
+        self.tracer = make_tracer(tracer, rootdir)
+        self._tracer_started = False
         self.sub_cov_file = None
         self.cov_plugin: CovPlugin = cov_plugin
         self._test_name = None
         self._next_test_name = None
         self.batched_test_names = set()
-        self.check_stack = []
+        self.batch_limits = batch_limits or BatchLimits()
+        self.batch_started = None
+        self.batch_files = 0  # measured files, counted once per test
+        self.batch_lines = 0
+        self.stack_depth = None
         self.is_started = False
         self._interrupted_at = None
 
@@ -523,88 +934,153 @@ class TestmonCollector:
             TestmonCollector.coverage_stack[-1].stop()
 
         self.start_cov()
+        self.stack_depth = len(TestmonCollector.coverage_stack)
 
     def start_testmon(self, test_name, next_test_name=None):
         self._next_test_name = next_test_name
 
+        if not self.batched_test_names:
+            self.batch_started = time.perf_counter()
         self.batched_test_names.add(test_name)
+        if self.tracer and not self._tracer_started:
+            self._tracer_started = self.tracer.start()
+            if not self._tracer_started:
+                self.tracer = None
+        if self.tracer:
+            self._test_name = test_name
+            self.tracer.switch_context(test_name)
+            return
         if self.cov is None:
             self.setup_coverage()
 
-        self.start_cov()
         self._test_name = test_name
         self.cov.switch_context(test_name)
-        self.check_stack = TestmonCollector.coverage_stack.copy()
 
     def discard_current(self):
         self._interrupted_at = self._test_name
 
     def get_batch_coverage_data(self):
-        if self.check_stack != TestmonCollector.coverage_stack:
+        if self.tracer:
+            return self.get_batch_tracer_data()
+        if self.cov is None:
+            return {}
+        # coverage runs from the first test on, a test may only leave it on top
+        if (
+            len(TestmonCollector.coverage_stack) != self.stack_depth
+            or TestmonCollector.coverage_stack[-1] is not self.cov
+        ):
             pytest.exit(
                 (
                     "Exiting pytest!!!! This test corrupts Testmon.coverage_stack:"
-                    f" {self._test_name} {self.check_stack},"
-                    f" {TestmonCollector.coverage_stack}"
+                    f" {self._test_name} {TestmonCollector.coverage_stack}"
                 ),
                 returncode=3,
             )
 
         nodes_files_lines = {}
 
-        if self.cov and (
-            len(self.batched_test_names) >= TEST_BATCH_SIZE
-            or self._next_test_name is None
-            or self._interrupted_at
-        ):
-            self.cov.stop()
-            nodes_files_lines, lines_data = self.get_nodes_files_lines(
-                dont_include=self._interrupted_at
-            )
+        self.measure_test()
+        if self.batch_full():
+            nodes_files_lines, lines_data = self.flush_batch()
 
             if (
                 len(TestmonCollector.coverage_stack) > 1
                 and TestmonCollector.coverage_stack[-1] == self.cov
             ):
                 filtered_lines_data = {
-                    file: data
-                    for file, data in lines_data.items()
+                    file: bitmap_to_lines(lines_bitmap)
+                    for file, lines_bitmap in lines_data.items()
                     if should_include(TestmonCollector.coverage_stack[-2], file)
                 }
                 TestmonCollector.coverage_stack[-2].get_data().add_lines(
                     filtered_lines_data
                 )
+        return nodes_files_lines
 
-            self.cov.erase()
-            self.cov.start()
-            self.batched_test_names = set()
+    def get_batch_tracer_data(self):
+        nodes_files_lines = {}
+        if self._tracer_started:
+            self.measure_test()
+            if self.batch_full():
+                nodes_files_lines, _ = self.flush_batch()
         return nodes_files_lines
 
+    def measure_test(self):
+        """adds what the test which just ran measured to the size of the batch"""
+        if self.tracer:
+            lines = [bitmap.bit_count() for bitmap in self.tracer.current.values()]
+        else:
+            # the lines of the test, coverage flushes them on switch_context()
+            # and keeps the files with empty sets. Without the expected
+            # internals only the time and the end of the session end a batch.
+            collector = getattr(self.cov, "_collector", None)
+            collected = getattr(collector, "data", None)
+            if not isinstance(collected, dict):
+                collected = {}
+            lines = [len(file_lines) for file_lines in collected.values() if file_lines]
+        self.batch_files += len(lines)
+        self.batch_lines += sum(lines)
+
+    def batch_memory(self):
+        """estimated bytes the batch takes until it's saved"""
+        return self.batch_files * MEASURED_FILE_BYTES + self.batch_lines // 8
+
+    def batch_full(self):
+        return (
+            self._next_test_name is None
+            or self._interrupted_at
+            or self.batch_lines >= self.batch_limits.lines
+            or self.batch_memory() >= self.batch_limits.memory
+            or time.perf_counter() - self.batch_started >= self.batch_limits.seconds
+        )
+
+    def flush_batch(self):
+        started = time.perf_counter()
+        nodes_files_lines, files_lines = self.get_nodes_files_lines(
+            dont_include=self._interrupted_at
+        )
+        logger.debug(
+            "batch of %d tests (%d lines, ~%d KiB) after %.1fs, read in %.1fms",
+            len(self.batched_test_names),
+            self.batch_lines,
+            self.batch_memory() // 1024,
+            started - self.batch_started,
+            (time.perf_counter() - started) * 1000,
+        )
+        self.batched_test_names = set()
+        self.batch_files = self.batch_lines = 0
+        return nodes_files_lines, files_lines
+
+    def read_contexts_lines(self):
+        """drains what was measured, what runs until the next test starts goes
+        to the "" context instead of the last test"""
+        if self.tracer:
+            self.tracer.switch_context("")
+            return self.tracer.drain()
+        self.cov.switch_context("")
+        return drain_contexts_lines(self.cov.get_data())
+
     def get_nodes_files_lines(self, dont_include):
-        cov_data: CoverageData = self.cov.get_data()
-        files = cov_data.measured_files()
+        """({test name: {filename: bitmap of lines}}, {measured file: bitmap of
+        the lines of all the tests}), see read_contexts_lines()"""
         nodes_files_lines = {}
         files_lines = {}
-        for file in files:
+        for context, file, lines_bitmap in self.read_contexts_lines():
             relfilename = cached_relpath(file, self.rootdir)
-
-            contexts_by_lineno = cov_data.contexts_by_lineno(file)
-
-            for lineno, contexts in contexts_by_lineno.items():
-                for context in contexts:
-                    nodes_files_lines.setdefault(context, {}).setdefault(
-                        relfilename, set()
-                    ).add(lineno)
-                    files_lines.setdefault(file, set()).add(lineno)
+            nodes_files_lines.setdefault(context, {})[relfilename] = lines_bitmap
+            files_lines[file] = files_lines.get(file, 0) | lines_bitmap
         nodes_files_lines.pop(dont_include, None)
         self.batched_test_names.discard(dont_include)
         nodes_files_lines.pop("", None)
         for test_name in self.batched_test_names:
             if home_file(test_name) not in nodes_files_lines.setdefault(test_name, {}):
-                nodes_files_lines[test_name].setdefault(home_file(test_name), {1})
+                nodes_files_lines[test_name].setdefault(home_file(test_name), 1 << 1)
         return nodes_files_lines, files_lines
 
     def close(self):
+        if self._tracer_started:
+            self.tracer.stop()
+            self._tracer_started = False
         if self.cov is None:
             return
         assert self.cov in TestmonCollector.coverage_stack
@@ -0,0 +1,250 @@
+"""
+Tracers recording which code each test runs, lighter than coverage.py.
+TestmonCollector uses one instead of Coverage when testmon_tracer says so.
+
+Like read_contexts_lines(), a tracer gives (context, file, bitmap of lines)
+where context is the name of the test which ran the lines. Tracers don't use
+sys.settrace, coverage.py (pytest-cov) keeps measuring while they run.
+"""
+
+import os
+import sys
+import sysconfig
+import threading
+from collections import defaultdict
+
+from testmon.common import get_logger
+from testmon.process_code import lines_to_bitmap
+
+COVERAGE_TRACER = "coverage"
+BLOCK_TRACER = "blocks"
+LINE_TRACER = "lines"
+TRACERS = (COVERAGE_TRACER, BLOCK_TRACER, LINE_TRACER)
+
+MONITORING_AVAILABLE = hasattr(sys, "monitoring")
+# sys.monitoring tool ids which don't have a predefined purpose
+MONITORING_TOOL_IDS = (3, 4)
+
+logger = get_logger(__name__)
+
+
+def free_tool_id():
+    """a sys.monitoring tool id nobody uses, None if there's none"""
+    if MONITORING_AVAILABLE:
+        for tool_id in MONITORING_TOOL_IDS:
+            if sys.monitoring.get_tool(tool_id) is None:  # pylint: disable=no-member
+                return tool_id
+    return None
+
+
+class Tracer:
+    """Records bitmaps of lines per context and file. Files outside rootdir
+    and in the Python installation (venv included) aren't recorded, like
+    TestmonCollector.setup_coverage() configures coverage."""
+
+    def __init__(self, rootdir):
+        self.include = os.path.join(os.path.abspath(rootdir), "")
+        self.omit = tuple(
+            os.path.join(path, "")
+            for key, path in sysconfig.get_paths().items()
+            if key.endswith("lib")
+        )
+        self._files = {}  # co_filename: absolute path or None when not traced
+        self.context = ""
+        self.data = {}
+        self.current = None
+        self.switch_context("")
+
+    def traced_file(self, filename):
+        try:
+            return self._files[filename]
+        except KeyError:
+            path = os.path.abspath(filename)
+            if not path.startswith(self.include) or path.startswith(self.omit):
+                path = None
+            self._files[filename] = path
+            return path
+
+    def switch_context(self, context):
+        self.context = context
+        self.current = self.data.setdefault(context, defaultdict(int))
+
+    def drain(self):
+        """[(context, file, bitmap of lines)] recorded since the previous drain"""
+        rows = [
+            (context, file, lines_bitmap)
+            for context, files in self.data.items()
+            for file, lines_bitmap in files.items()
+        ]
+        self.data = {}
+        self.current = self.data.setdefault(self.context, defaultdict(int))
+        return rows
+
+
+class BlockTracer(Tracer):
+    """Records the code objects (function, class and module bodies) each test
+    enters, once per test. All the lines of an entered code object count as
+    run: a block is in a fingerprint when any of its lines ran, and a code
+    object which ran at all ran a line of the block it belongs to. The
+    fingerprints are a superset of coverage's, an entered code object's lines
+    can belong to blocks which didn't run (a nested function's def line lies
+    inside the outer block).
+
+    On Python 3.12+ it's a sys.monitoring tool: PY_START and PY_RESUME events
+    are disabled after their first hit and re-enabled at the next test (which
+    re-enables events other tools disabled, too). Elsewhere a sys.setprofile()
+    function sees every call and skips code objects seen in the test. It
+    replaces the profile functions set before until stop() restores them."""
+
+    def __init__(self, rootdir):
+        self._code_lines = {}  # code object: (file, bitmap of lines) or None
+        self._seen = set()
+        self._tool_id = None
+        self._previous_profiles = (None, None)
+        super().__init__(rootdir)
+
+    def code_lines(self, code):
+        try:
+            return self._code_lines[code]
+        except KeyError:
+            file = self.traced_file(code.co_filename)
+            code_lines = None
+            if file:
+                code_lines = (
+                    file,
+                    lines_to_bitmap(line for _, _, line in code.co_lines() if line),
+                )
+            self._code_lines[code] = code_lines
+            return code_lines
+
+    def record(self, code):
+        code_lines = self.code_lines(code)
+        if code_lines:
+            file, lines_bitmap = code_lines
+            self.current[file] |= lines_bitmap
+
+    def start(self):
+        """whether the tracer runs, it always does"""
+        self._tool_id = free_tool_id()
+        if self._tool_id is None:
+            self._previous_profiles = (sys.getprofile(), threading.getprofile())
+            sys.setprofile(self._profile)
+            threading.setprofile(self._profile)
+            return True
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        monitoring.use_tool_id(self._tool_id, "testmon")
+        events = monitoring.events
+        for event in (events.PY_START, events.PY_RESUME):
+            monitoring.register_callback(self._tool_id, event, self._on_start)
+        monitoring.set_events(self._tool_id, events.PY_START | events.PY_RESUME)
+        return True
+
+    def stop(self):
+        if self._tool_id is None:
+            profile, thread_profile = self._previous_profiles
+            sys.setprofile(profile)
+            threading.setprofile(thread_profile)
+            self._previous_profiles = (None, None)
+            return
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        monitoring.set_events(self._tool_id, 0)
+        for event in (monitoring.events.PY_START, monitoring.events.PY_RESUME):
+            monitoring.register_callback(self._tool_id, event, None)
+        monitoring.free_tool_id(self._tool_id)
+        self._tool_id = None
+
+    def switch_context(self, context):
+        super().switch_context(context)
+        self._seen = set()
+        if self._tool_id is not None:
+            sys.monitoring.restart_events()  # pylint: disable=no-member
+
+    def _on_start(self, code, instruction_offset):  # pylint: disable=unused-argument
+        self.record(code)
+        return sys.monitoring.DISABLE  # pylint: disable=no-member
+
+    def _profile(self, frame, event, arg):  # pylint: disable=unused-argument
+        if event == "call":
+            code = frame.f_code
+            if code not in self._seen:
+                self._seen.add(code)
+                self.record(code)
+
+
+class LineTracer(Tracer):
+    """Records the lines each test runs, like coverage does, as a sys.monitoring
+    tool (Python 3.12+). PY_START and PY_RESUME enable LINE events of the code
+    objects in traced files. Every event is disabled after its first hit and
+    re-enabled at the next test (which re-enables events other tools disabled,
+    too), so a line costs one callback per test at most."""
+
+    def __init__(self, rootdir):
+        self._code_files = {}  # code object: file or None when not traced
+        self._tool_id = None
+        super().__init__(rootdir)
+
+    def start(self):
+        """whether the tracer runs, not when another tool took the free
+        sys.monitoring tool ids since make_tracer()"""
+        self._tool_id = free_tool_id()
+        if self._tool_id is None:
+            logger.info(
+                "testmon_tracer = %s found no free sys.monitoring tool id, using"
+                " coverage",
+                LINE_TRACER,
+            )
+            return False
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        events = monitoring.events
+        monitoring.use_tool_id(self._tool_id, "testmon")
+        for event in (events.PY_START, events.PY_RESUME):
+            monitoring.register_callback(self._tool_id, event, self._on_start)
+        monitoring.register_callback(self._tool_id, events.LINE, self._on_line)
+        monitoring.set_events(self._tool_id, events.PY_START | events.PY_RESUME)
+        return True
+
+    def stop(self):
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        monitoring.set_events(self._tool_id, 0)
+        for code, file in self._code_files.items():
+            if file:
+                monitoring.set_local_events(self._tool_id, code, 0)
+        events = monitoring.events
+        for event in (events.PY_START, events.PY_RESUME, events.LINE):
+            monitoring.register_callback(self._tool_id, event, None)
+        monitoring.free_tool_id(self._tool_id)
+        self._tool_id = None
+
+    def switch_context(self, context):
+        super().switch_context(context)
+        if self._tool_id is not None:
+            sys.monitoring.restart_events()  # pylint: disable=no-member
+
+    def _on_start(self, code, instruction_offset):  # pylint: disable=unused-argument
+        if code not in self._code_files:
+            file = self.traced_file(code.co_filename)
+            self._code_files[code] = file
+            if file:
+                monitoring = sys.monitoring  # pylint: disable=no-member
+                monitoring.set_local_events(self._tool_id, code, monitoring.events.LINE)
+        return sys.monitoring.DISABLE  # pylint: disable=no-member
+
+    def _on_line(self, code, line_number):
+        self.current[self._code_files[code]] |= 1 << line_number
+        return sys.monitoring.DISABLE  # pylint: disable=no-member
+
+
+def make_tracer(name, rootdir):
+    """Tracer used instead of coverage, None for coverage"""
+    if name == BLOCK_TRACER:
+        return BlockTracer(rootdir)
+    if name == LINE_TRACER:
+        if free_tool_id() is None:
+            logger.info(
+                "testmon_tracer = %s needs a free sys.monitoring tool id (Python"
+                " 3.12+), using coverage",
+                name,
+            )
+            return None
+        return LineTracer(rootdir)
+    return None
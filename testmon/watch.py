@@ -0,0 +1,355 @@
+"""
+testmon-watch: keeps track of files changed under a rootdir (Linux inotify)
+and tells testmon which files changed since its previous session, so that
+it doesn't have to stat all of them.
+
+    testmon-watch [rootdir]
+
+The daemon keeps a journal {path: sequence number of its last change} and
+answers on a Unix socket derived from rootdir, in a directory only the user
+can access ($XDG_RUNTIME_DIR or one created in the temporary directory). A
+client sends the token and
+sequence number it got last time and receives the paths changed since. When
+the daemon can't tell (it was restarted, events were lost, the journal got
+too big), the token changes and the client has to check all files.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import select
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import uuid
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+EVENT = struct.Struct("iIII")
+PEERCRED = struct.Struct("3i")  # pid, uid, gid
+
+# directories not watched, files under them are always reported as changed
+EXCLUDED_DIRS = {".git", ".hg", ".svn", "__pycache__", ".tox", ".nox", ".venv"}
+MAX_JOURNAL_SIZE = 100000
+CLIENT_TIMEOUT = 1
+MAX_MESSAGE_SIZE = 1 << 16
+
+
+def socket_path(rootdir):
+    rootdir_hash = hashlib.sha1(os.path.realpath(rootdir).encode()).hexdigest()
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        directory = os.path.join(runtime_dir, "testmon-watch")
+    else:
+        directory = os.path.join(tempfile.gettempdir(), f"testmon-watch-{os.getuid()}")
+    return os.path.join(directory, rootdir_hash[:16])
+
+
+class WatchError(Exception):
+    pass
+
+
+def make_private_directory(directory):
+    """Create directory, accessible only by the user. An existing one has to be
+    theirs and private, otherwise another user could answer in the daemon's
+    place."""
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as error:
+        raise WatchError(f"{directory}: {error.strerror}") from error
+    dir_stat = os.lstat(directory)
+    if (
+        not stat.S_ISDIR(dir_stat.st_mode)
+        or dir_stat.st_uid != os.getuid()
+        or dir_stat.st_mode & 0o077
+    ):
+        raise WatchError(f"{directory} isn't a private directory of the user")
+
+
+def peer_uid(connection, path):
+    if hasattr(socket, "SO_PEERCRED"):
+        credentials = connection.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size
+        )
+        return PEERCRED.unpack(credentials)[1]
+    return os.stat(path).st_uid
+
+
+def is_response(response):
+    def paths(value):
+        return isinstance(value, list) and all(isinstance(path, str) for path in value)
+
+    return (
+        isinstance(response, dict)
+        and isinstance(response.get("token"), str)
+        and isinstance(response.get("seq"), int)
+        and (response.get("changed") is None or paths(response.get("changed")))
+        and paths(response.get("unwatched"))
+    )
+
+
+class Changes:
+    """Files changed according to the daemon. Paths under unwatched prefixes
+    (symlinks, excluded directories) count as changed."""
+
+    def __init__(self, changed, unwatched):
+        self.changed = set(changed)
+        self.unwatched = tuple(unwatched)
+
+    def __contains__(self, filename):
+        return filename in self.changed or filename.startswith(self.unwatched)
+
+
+def changed_since(rootdir, state):
+    """(Changes or None, new state). None when there's no daemon or it can't
+    tell what changed since state (a dict stored by the previous session).
+    Answers from a daemon of another user or not in the expected shape are
+    ignored."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None, None
+    path = socket_path(rootdir)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CLIENT_TIMEOUT)
+            client.connect(path)
+            if peer_uid(client, path) != os.getuid():
+                return None, None
+            client.sendall(json.dumps(state or {}).encode() + b"\n")
+            response = json.loads(read_message(client))
+    except (OSError, ValueError):
+        return None, None
+    if not is_response(response):
+        return None, None
+    new_state = {"token": response["token"], "seq": response["seq"]}
+    if response["changed"] is None:
+        return None, new_state
+    return Changes(response["changed"], response["unwatched"]), new_state
+
+
+def read_message(connection):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(MAX_MESSAGE_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode()
+
+
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+
+    def add_watch(self, path):
+        watch_descriptor = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if watch_descriptor < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return None  # removed in the meantime
+            raise WatchError(f"inotify_add_watch {path}: {os.strerror(error)}")
+        return watch_descriptor
+
+    def read_events(self):
+        """[(watch descriptor, mask, name)] of all the events queued"""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, MAX_MESSAGE_SIZE)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                watch_descriptor, mask, _, length = EVENT.unpack_from(data, pos)
+                pos += EVENT.size
+                name = data[pos : pos + length].rstrip(b"\0")
+                pos += length
+                events.append((watch_descriptor, mask, os.fsdecode(name)))
+
+
+class Watcher:  # pylint: disable=too-many-instance-attributes
+    def __init__(self, rootdir):
+        self.rootdir = os.path.realpath(rootdir)
+        self.inotify = Inotify()
+        self.directories = {}  # watch descriptor: directory relative to rootdir
+        self.unwatched = set()
+        self.journal = {}
+        self.token = None
+        self.seq = 0
+        self.reset()
+        self.watch_tree("")
+
+    def reset(self):
+        self.token = uuid.uuid4().hex
+        self.journal = {}
+
+    def record(self, path):
+        self.seq += 1
+        self.journal[path] = self.seq
+        if len(self.journal) > MAX_JOURNAL_SIZE:
+            self.reset()
+
+    def watch_tree(self, directory, record=False):
+        """Watch directory and its subdirectories. New files under them are
+        recorded as changed (with record), they could be written before the
+        watch was added."""
+        for dirpath, dirnames, filenames in os.walk(
+            os.path.join(self.rootdir, directory)
+        ):
+            relative = os.path.relpath(dirpath, self.rootdir).replace(os.sep, "/")
+            prefix = "" if relative == "." else relative + "/"
+            watch_descriptor = self.inotify.add_watch(dirpath)
+            if watch_descriptor is None:
+                dirnames[:] = []
+                continue
+            self.directories[watch_descriptor] = prefix
+            for dirname in list(dirnames):
+                if dirname in EXCLUDED_DIRS or os.path.islink(
+                    os.path.join(dirpath, dirname)
+                ):
+                    dirnames.remove(dirname)
+                    self.unwatched.add(prefix + dirname + "/")
+            for filename in filenames:
+                if os.path.islink(os.path.join(dirpath, filename)):
+                    self.unwatched.add(prefix + filename)
+                elif record:
+                    self.record(prefix + filename)
+
+    def process_events(self):
+        for watch_descriptor, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                self.reset()
+                continue
+            prefix = self.directories.get(watch_descriptor)
+            if prefix is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.directories[watch_descriptor]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # files under the directory are gone, we don't know which
+                self.reset()
+                continue
+            path = prefix + name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name not in EXCLUDED_DIRS:
+                    if os.path.islink(os.path.join(self.rootdir, path)):
+                        self.unwatched.add(path + "/")
+                    else:
+                        self.watch_tree(path, record=True)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self.unwatched.add(path + "/")
+                continue
+            if mask & IN_CREATE and os.path.islink(os.path.join(self.rootdir, path)):
+                self.unwatched.add(path)
+            self.record(path)
+
+    def answer(self, request):
+        self.process_events()
+        changed = None
+        if request.get("token") == self.token:
+            since = request.get("seq", 0)
+            changed = sorted(path for path, seq in self.journal.items() if seq > since)
+        return {
+            "token": self.token,
+            "seq": self.seq,
+            "changed": changed,
+            "unwatched": sorted(self.unwatched),
+        }
+
+    def serve(self, path):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.remove(path)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+        server.listen()
+        try:
+            while True:
+                readable, _, _ = select.select([self.inotify.fd, server], [], [])
+                if self.inotify.fd in readable:
+                    self.process_events()
+                if server in readable:
+                    self.handle(server)
+        finally:
+            server.close()
+            os.remove(path)
+
+    def handle(self, server):
+        connection, _ = server.accept()
+        with connection:
+            connection.settimeout(CLIENT_TIMEOUT)
+            try:
+                request = json.loads(read_message(connection) or "{}")
+                connection.sendall(json.dumps(self.answer(request)).encode() + b"\n")
+            except (OSError, ValueError):
+                pass
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    rootdir = argv[0] if argv else os.getcwd()
+    if not sys.platform.startswith("linux"):
+        sys.exit("testmon-watch needs Linux (inotify)")
+    try:
+        watcher = Watcher(rootdir)
+    except WatchError as error:
+        sys.exit(f"testmon-watch: {error}")
+    path = socket_path(rootdir)
+    try:
+        make_private_directory(os.path.dirname(path))
+    except WatchError as error:
+        sys.exit(f"testmon-watch: {error}")
+    print(f"testmon-watch: watching {watcher.rootdir} on {path}")
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        watcher.serve(path)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
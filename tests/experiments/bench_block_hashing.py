@@ -0,0 +1,88 @@
+"""
+Compares BlockHasher with building the text of blocks the way
+Module.dump_and_block did (legacy_blocks() in test_process_code.py).
+Parsing, which is the same for both, isn't measured.
+
+    python tests/experiments/bench_block_hashing.py [number of classes]
+"""
+
+import ast
+import os
+import sys
+import textwrap
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from test_process_code import BLOCK_HASHER_SAMPLES, legacy_blocks
+from testmon.process_code import BlockHasher, methods_to_checksums
+
+
+GENERATED_CLASS = """
+class Model{i}(Base):
+    fields = {{"id": int, "name": str, "value{i}": float}}
+
+    def to_dict(self, include=None):
+        result = {{}}
+        for key, kind in self.fields.items():
+            if include is None or key in include:
+                result[key] = kind(getattr(self, key, {i}))
+        return result
+"""
+
+
+def generated_module(classes):
+    """A large module like the ones generated by protobuf, swagger etc."""
+    return "".join(GENERATED_CLASS.format(i=i) for i in range(classes))
+
+
+def legacy(tree, end):
+    return methods_to_checksums([code for *_, code in legacy_blocks(tree, end)])
+
+
+def block_hasher(tree, end):
+    return [block.checksum for block in BlockHasher(tree).hash_blocks(end)]
+
+
+def measure(function, source_code, repeat):
+    """Average duration and peak memory of computing checksums of an already
+    parsed module."""
+    source_code = textwrap.dedent(source_code)
+    tree = ast.parse(source_code)
+    end = len(source_code.splitlines())
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = function(tree, end)
+    duration = (time.perf_counter() - started) / repeat
+
+    tracemalloc.start()
+    function(tree, end)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def main():
+    classes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    inputs = [
+        ("test_process_code samples", "\n".join(BLOCK_HASHER_SAMPLES[:-1]), 200),
+        ("test_process_code.py", BLOCK_HASHER_SAMPLES[-1], 5),
+        (f"generated, {classes} classes", generated_module(classes), 1),
+    ]
+    print(f"{'input':<30} {'implementation':<15} {'time':>10} {'peak memory':>12}")
+    for name, source_code, repeat in inputs:
+        results = []
+        for implementation in (legacy, block_hasher):
+            result, duration, peak = measure(implementation, source_code, repeat)
+            results.append(result)
+            print(
+                f"{name:<30} {implementation.__name__:<15}"
+                f" {duration * 1000:>8.2f}ms {peak / 2**20:>10.1f}MB"
+            )
+        assert results[0] == results[1], "checksums differ"
+
+
+if __name__ == "__main__":
+    main()
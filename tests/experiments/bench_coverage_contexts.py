@@ -0,0 +1,91 @@
+"""
+Compares reading which lines each test ran from coverage data with
+read_contexts_lines() (one query, lines kept as bitmaps) and with the
+contexts_by_lineno() loop TestmonCollector.get_nodes_files_lines used, on
+generated data of a batch of BATCH_TESTS tests.
+
+    python tests/experiments/bench_coverage_contexts.py [number of files]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+# pylint: disable=wrong-import-position
+from coverage import CoverageData
+
+from testmon.testmon_core import read_contexts_lines
+
+BATCH_TESTS = 250
+FILES_PER_TEST = 0.3
+LINES_PER_FILE = 200
+
+
+def generate(files):
+    random.seed(0)
+    cov_data = CoverageData(no_disk=True)
+    filenames = [f"/project/src/m{i}.py" for i in range(files)]
+    for test in range(BATCH_TESTS):
+        cov_data.set_context(f"tests/test_m.py::test_{test}")
+        cov_data.add_lines(
+            {
+                filename: random.sample(range(1, LINES_PER_FILE), 40)
+                for filename in random.sample(filenames, int(files * FILES_PER_TEST))
+            }
+        )
+    return cov_data
+
+
+def legacy(cov_data):
+    nodes_files_lines = {}
+    files_lines = {}
+    for file in cov_data.measured_files():
+        contexts_by_lineno = cov_data.contexts_by_lineno(file)
+        for lineno, contexts in contexts_by_lineno.items():
+            for context in contexts:
+                nodes_files_lines.setdefault(context, {}).setdefault(file, set()).add(
+                    lineno
+                )
+                files_lines.setdefault(file, set()).add(lineno)
+    return nodes_files_lines, files_lines
+
+
+def bulk(cov_data):
+    nodes_files_lines = {}
+    files_lines = {}
+    for context, file, lines_bitmap in read_contexts_lines(cov_data):
+        nodes_files_lines.setdefault(context, {})[file] = lines_bitmap
+        files_lines[file] = files_lines.get(file, 0) | lines_bitmap
+    return nodes_files_lines, files_lines
+
+
+def measure(function, cov_data, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(cov_data)
+        best = min(best, time.perf_counter() - started)
+    return result, best
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    cov_data = generate(files)
+    (legacy_nodes, _), legacy_duration = measure(legacy, cov_data)
+    (bulk_nodes, _), bulk_duration = measure(bulk, cov_data)
+    assert {
+        context: {
+            file: sum(1 << line for line in lines) for file, lines in files.items()
+        }
+        for context, files in legacy_nodes.items()
+    } == bulk_nodes, "results differ"
+    print(f"{BATCH_TESTS} tests x {int(files * FILES_PER_TEST)} of {files} files")
+    print(f"contexts_by_lineno loop  {legacy_duration * 1000:>8.1f}ms")
+    print(f"read_contexts_lines      {bulk_duration * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measures DB.insert_test_file_fps() on batches like the ones pytest_testmon
+writes (BATCH_TESTS tests), into an empty DB and again into one which
+already has them (a rerun with the same dependencies), with the number of
+rows changed per batch (temporary tables included).
+
+    python tests/experiments/bench_insert_fingerprints.py [dependencies per test]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+# pylint: disable=wrong-import-position
+from testmon.db import DB
+
+BATCH_TESTS = 250
+FILES = 2000
+FINGERPRINTS_PER_FILE = 5
+BATCHES = 4
+
+
+def generate_batches(deps_per_test):
+    random.seed(0)
+    blocks = {
+        f"src/m{i}.py": random.sample(range(-(2**31), 2**31), 30) for i in range(FILES)
+    }
+    fingerprints = {
+        filename: [random.sample(checksums, 10) for _ in range(FINGERPRINTS_PER_FILE)]
+        for filename, checksums in blocks.items()
+    }
+    batches = []
+    for batch in range(BATCHES):
+        tests = {}
+        for i in range(BATCH_TESTS):
+            filenames = random.sample(list(fingerprints), deps_per_test)
+            tests[f"tests/test_{batch}.py::test_{i}"] = {
+                "deps": [
+                    {
+                        "filename": filename,
+                        "fsha": f"sha-{filename}",
+                        "method_checksums": random.choice(fingerprints[filename]),
+                    }
+                    for filename in filenames
+                ],
+                "duration": 0.01,
+                "failed": False,
+                "forced": None,
+            }
+        batches.append(tests)
+    return batches
+
+
+def main():
+    deps_per_test = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batches = generate_batches(deps_per_test)
+    with tempfile.TemporaryDirectory() as directory:
+        database = DB(os.path.join(directory, ".testmondata"))
+        exec_id, _ = database.fetch_or_create_environment("default", "", "3.11")
+        for run in ("first run", "rerun"):
+            durations = []
+            changes = database.con.total_changes
+            for batch in batches:
+                started = time.perf_counter()
+                database.insert_test_file_fps(batch, exec_id)
+                durations.append(time.perf_counter() - started)
+            changes = (database.con.total_changes - changes) // len(batches)
+            print(
+                f"{run:<10} {BATCH_TESTS} tests x {deps_per_test} deps:"
+                f" {sum(durations) / len(durations) * 1000:>8.1f}ms per batch,"
+                f" {changes:>7} rows changed"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Measures the fixed cost TestmonCollector adds to each test: start_testmon()
+and get_batch_coverage_data() around a test which calls one function, with
+the coverage session kept running (drained per batch, BatchLimits decide
+when) and with the stop/erase/start cycle every BATCH_TESTS tests and the
+coverage_stack copies it replaced.
+
+    python tests/experiments/bench_test_overhead.py [number of tests]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+# pylint: disable=wrong-import-position,protected-access
+import pytest
+
+from testmon.process_code import bitmap_to_lines
+from testmon.testmon_core import TestmonCollector, read_contexts_lines
+
+BATCH_TESTS = 250
+SOURCE = "def f(x):\n    return x + 1\n"
+
+
+class LegacyCollector(TestmonCollector):
+    def start_testmon(self, test_name, next_test_name=None):
+        self._next_test_name = next_test_name
+        self.batched_test_names.add(test_name)
+        if self.cov is None:
+            self.setup_coverage()
+        self.start_cov()
+        self._test_name = test_name
+        self.cov.switch_context(test_name)
+        self.check_stack = TestmonCollector.coverage_stack.copy()
+
+    def get_batch_coverage_data(self):
+        if self.check_stack != TestmonCollector.coverage_stack:
+            pytest.exit("coverage_stack corrupted", returncode=3)
+        nodes_files_lines = {}
+        if self.cov and (
+            len(self.batched_test_names) >= BATCH_TESTS
+            or self._next_test_name is None
+        ):
+            self.cov.stop()
+            nodes_files_lines, _ = self.get_nodes_files_lines(dont_include=None)
+            self.cov.erase()
+            self.cov.start()
+            self.batched_test_names = set()
+        return nodes_files_lines
+
+    def read_contexts_lines(self):
+        return read_contexts_lines(self.cov.get_data())
+
+
+def run(collector_class, rootdir, function, tests):
+    collector = collector_class(rootdir)
+    stored = {}
+    started = time.perf_counter()
+    try:
+        for i in range(tests):
+            collector.start_testmon(
+                f"test_m.py::test_{i}",
+                f"test_m.py::test_{i + 1}" if i + 1 < tests else None,
+            )
+            function(i)
+            stored.update(collector.get_batch_coverage_data())
+    finally:
+        collector.close()
+    return stored, time.perf_counter() - started
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    with tempfile.TemporaryDirectory() as rootdir:
+        with open(os.path.join(rootdir, "m.py"), "w", encoding="utf-8") as file:
+            file.write(SOURCE)
+        sys.path.insert(0, rootdir)
+        import m  # pylint: disable=import-outside-toplevel,import-error
+
+        started = time.perf_counter()
+        for i in range(tests):
+            m.f(i)
+        bare = time.perf_counter() - started
+        legacy, legacy_duration = run(LegacyCollector, rootdir, m.f, tests)
+        session, session_duration = run(TestmonCollector, rootdir, m.f, tests)
+    assert {
+        test_name: {file: bitmap_to_lines(lines) for file, lines in files.items()}
+        for test_name, files in legacy.items()
+    } == {
+        test_name: {file: bitmap_to_lines(lines) for file, lines in files.items()}
+        for test_name, files in session.items()
+    }, "results differ"
+    print(f"{tests} tests")
+    for name, duration in (
+        ("no testmon", bare),
+        ("stop/erase/start", legacy_duration),
+        ("running session", session_duration),
+    ):
+        print(f"{name:<18} {duration / tests * 1e6:>8.1f}us per test")
+
+
+if __name__ == "__main__":
+    main()
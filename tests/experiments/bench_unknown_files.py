@@ -0,0 +1,138 @@
+"""
+Compares finding files whose fsha changed (DB.fetch_unknown_files) through
+suite_execution_file_fsha with the join over test_execution,
+dependency_set_file_fp and file_fp it replaced, on a generated DB.
+
+    python tests/experiments/bench_unknown_files.py [number of tests]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
+
+# pylint: disable=wrong-import-position
+from testmon.db import DB
+
+SOURCE_FILES = 5000
+TEST_FILES = 2000
+DEPS_PER_TEST = 10
+CHANGED_FILES = 20
+
+LEGACY_QUERY = """
+    SELECT DISTINCT
+        fn.filename
+    FROM test_execution te, dependency_set_file_fp dsf, interned_filename fn, file_fp f
+    LEFT OUTER JOIN changed_files_fshas chff
+    ON f.filename_id = chff.filename_id and f.fsha = chff.fsha AND chff.exec_id = :exec_id
+    WHERE
+        te.environment_id = :exec_id AND
+        te.dependency_set_id = dsf.dependency_set_id AND
+        dsf.fingerprint_id = f.id AND
+        fn.id = f.filename_id AND
+        (f.fsha IS NULL OR chff.fsha IS NULL)
+"""
+
+
+def generate(database, tests):
+    """Fills the tables directly, insert_test_file_fps() would take minutes.
+    Every file has 3 fingerprints (sets of covered blocks), every test its
+    own dependency set."""
+    exec_id, _ = database.fetch_or_create_environment("default", "", "3.11")
+    random.seed(0)
+    filenames = [f"src/m{i}.py" for i in range(SOURCE_FILES)]
+    filenames += [f"tests/test_{i}.py" for i in range(TEST_FILES)]
+    with database.con as con:
+        con.executemany(
+            "INSERT INTO interned_filename VALUES (?, ?)", enumerate(filenames)
+        )
+        con.executemany(
+            "INSERT INTO file_fp (id, filename_id, method_checksums, fsha) VALUES (?, ?, ?, ?)",
+            (
+                (i * 3 + variant, i, bytes([variant]), f"sha{i}")
+                for i, filename in enumerate(filenames)
+                for variant in range(3)
+            ),
+        )
+        con.executemany(
+            "INSERT INTO interned_test_name VALUES (?, ?)",
+            ((i, f"tests/test_{i % TEST_FILES}.py::test_{i}") for i in range(tests)),
+        )
+        con.executemany(
+            "INSERT INTO dependency_set (id, fingerprints_sha) VALUES (?, ?)",
+            ((i, f"set{i}") for i in range(tests)),
+        )
+        con.executemany(
+            "INSERT INTO test_execution (id, environment_id, test_name_id, dependency_set_id)"
+            " VALUES (?, ?, ?, ?)",
+            ((i, exec_id, i, i) for i in range(tests)),
+        )
+        con.executemany(
+            "INSERT INTO dependency_set_file_fp VALUES (?, ?)",
+            (
+                (i, fingerprint_id)
+                for i in range(tests)
+                for fingerprint_id in {
+                    (SOURCE_FILES + i % TEST_FILES) * 3,
+                    *(
+                        random.randrange(SOURCE_FILES) * 3 + random.randrange(3)
+                        for _ in range(DEPS_PER_TEST - 1)
+                    ),
+                }
+            ),
+        )
+        # what insert_into_suite_files_fshas() would have written
+        con.execute(
+            """INSERT INTO suite_execution_file_fsha
+               SELECT DISTINCT te.environment_id, f.filename_id, f.fsha
+               FROM test_execution te, dependency_set_file_fp dsf, file_fp f
+               WHERE te.dependency_set_id = dsf.dependency_set_id AND
+                     dsf.fingerprint_id = f.id"""
+        )
+    files_fshas = {filename: f"sha{i}" for i, filename in enumerate(filenames)}
+    for filename in random.sample(filenames, CHANGED_FILES):
+        files_fshas[filename] = "changed"
+    return exec_id, files_fshas
+
+
+def measure(function, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - started)
+    return result, best
+
+
+def main():
+    tests = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        database = DB(os.path.join(directory, ".testmondata"))
+        started = time.perf_counter()
+        exec_id, files_fshas = generate(database, tests)
+        print(f"generated {tests} tests in {time.perf_counter() - started:.1f}s")
+
+        new, new_duration = measure(
+            lambda: database.fetch_unknown_files(files_fshas, exec_id)
+        )
+        legacy, legacy_duration = measure(
+            lambda: [
+                row[0]
+                for row in database.con.execute(LEGACY_QUERY, {"exec_id": exec_id})
+            ]
+        )
+        assert sorted(new) == sorted(legacy), "results differ"
+        _, vacuum_duration = measure(
+            lambda: database.vacuum_suite_files_fshas(database.con, exec_id), 1
+        )
+        print(f"unknown files: {len(new)}")
+        print(f"legacy join                  {legacy_duration * 1000:>8.1f}ms")
+        print(f"suite_execution_file_fsha    {new_duration * 1000:>8.1f}ms")
+        print(f"vacuum (end of run)          {vacuum_duration * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
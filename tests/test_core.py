@@ -0,0 +1,1112 @@
+import os
+import shutil
+import sqlite3
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import pytest
+from coverage import Coverage, CoverageData
+
+from testmon import db, process_code, testmon_core, tracer, watch
+from testmon.common import drop_patch_version, get_system_packages
+from testmon.process_code import bitmap_to_lines, create_fingerprint
+from testmon.testmon_core import SourceTree, TestmonData
+
+pytest_plugins = ("pytester",)
+
+
+def make_old(path, age=60):
+    timestamp = time.time() - age
+    os.utime(path, (timestamp, timestamp))
+
+
+class TestStatFastPath:
+    def test_unchanged_stat_is_not_read(self, testdir, monkeypatch):
+        make_old(testdir.makepyfile(a="def f(): pass"))
+        rootdir = testdir.tmpdir.strpath
+
+        fshas = TestmonData.for_local_run(rootdir).get_files_fshas(["a.py"])
+
+        def fail(*args, **kwargs):
+            raise AssertionError("file with unchanged stat was read")
+
+        monkeypatch.setattr(testmon_core, "get_source_sha", fail)
+        assert TestmonData.for_local_run(rootdir).get_files_fshas(["a.py"]) == fshas
+
+    def test_changed_stat_is_read(self, testdir):
+        make_old(testdir.makepyfile(a="def f(): pass"))
+        rootdir = testdir.tmpdir.strpath
+        fshas = TestmonData.for_local_run(rootdir).get_files_fshas(["a.py"])
+
+        make_old(testdir.makepyfile(a="def f(): return 1"), age=30)
+        assert TestmonData.for_local_run(rootdir).get_files_fshas(["a.py"]) != fshas
+
+    def test_recently_modified_stat_is_not_stored(self, testdir):
+        testdir.makepyfile(a="def f(): pass")
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+
+        testmon_data.get_files_fshas(["a.py"])
+        assert testmon_data.db.fetch_file_stats() == {}
+
+
+class TestParallel:
+    def test_same_as_serial(self, testdir, monkeypatch, caplog):
+        monkeypatch.setattr(testmon_core, "THREAD_POOL_MIN_FILES", 2)
+        monkeypatch.setattr(testmon_core, "PROCESS_POOL_MIN_FILES", 2)
+        testdir.makepyfile(
+            **{
+                f"m{i}": f"def f():\n    return {i}\n\nclass A:\n    def g(self): pass\n"
+                for i in range(4)
+            }
+        )
+        filenames = [f"m{i}.py" for i in range(4)] + ["missing.py"]
+        serial = SourceTree(testdir.tmpdir.strpath, workers=1)
+        parallel = SourceTree(testdir.tmpdir.strpath, workers=2)
+
+        assert parallel.get_method_checksums(filenames) == serial.get_method_checksums(
+            filenames
+        )
+        assert "process pool failed" not in caplog.text
+        for filename in filenames[:4]:
+            assert create_fingerprint(
+                parallel.get_file(filename), {2, 5}
+            ) == create_fingerprint(serial.get_file(filename), {2, 5})
+
+
+class TestParsedModuleCache:
+    def test_known_content_is_not_parsed(self, testdir, monkeypatch):
+        testdir.makepyfile(a="def f():\n    return 1\n")
+        rootdir = testdir.tmpdir.strpath
+        testmon_data = TestmonData.for_local_run(rootdir)
+        parsed = testmon_data.get_method_checksums(["a.py"])
+        fingerprint = create_fingerprint(testmon_data.source_tree.get_file("a.py"), {2})
+
+        def fail(*args, **kwargs):
+            raise AssertionError("known content was parsed")
+
+        monkeypatch.setattr(process_code.BlockHasher, "walk", fail)
+        testmon_data = TestmonData.for_local_run(rootdir)
+        assert testmon_data.get_method_checksums(["a.py"]) == parsed
+        module = testmon_data.source_tree.get_file("a.py")
+        assert create_fingerprint(module, {2}) == fingerprint
+
+    def test_least_recently_used_are_evicted(self, testdir, monkeypatch):
+        monkeypatch.setattr(db, "PARSED_MODULE_CACHE_SIZE", 2)
+        database = TestmonData.for_local_run(testdir.tmpdir.strpath).db
+        database.insert_parsed_modules(
+            (f"sha{i}", "py", [(1, 2, "f")], [i]) for i in range(3)
+        )
+        database.con.execute(
+            "UPDATE parsed_module SET last_used = 0 WHERE fsha = 'sha1'"
+        )
+
+        with database.con as con:
+            database.evict_parsed_modules(con)
+        parsed_modules = database.fetch_parsed_modules(
+            [("sha0", "py"), ("sha1", "py"), ("sha2", "py")]
+        )
+        assert {
+            key: (spans, list(checksums))
+            for key, (spans, checksums) in parsed_modules.items()
+        } == {("sha0", "py"): ([(1, 2, "")], [0]), ("sha2", "py"): ([(1, 2, "")], [2])}
+
+
+class TestReadContextsLines:
+    def test_same_lines_as_contexts_by_lineno(self):
+        cov_data = CoverageData(no_disk=True)
+        cov_data.set_context("test_a")
+        cov_data.add_lines({"/r/a.py": [1, 3], "/r/b.py": [70]})
+        cov_data.set_context("test_b")
+        cov_data.add_lines({"/r/a.py": [3, 4]})
+
+        expected = set()
+        for file in cov_data.measured_files():
+            for line, contexts in cov_data.contexts_by_lineno(file).items():
+                expected.update((context, file, line) for context in contexts)
+        assert {
+            (context, file, line)
+            for context, file, lines_bitmap in testmon_core.read_contexts_lines(
+                cov_data
+            )
+            for line in process_code.bitmap_to_lines(lines_bitmap)
+        } == expected
+        assert sorted(testmon_core.read_contexts_by_lineno(cov_data)) == sorted(
+            testmon_core.read_contexts_lines(cov_data)
+        )
+
+
+def deps(*filenames):
+    return {
+        "deps": [
+            {"filename": filename, "fsha": "sha", "method_checksums": [1]}
+            for filename in filenames
+        ]
+    }
+
+
+def stored_links(con):
+    """sorted (test name, filename) of the fingerprints tests depend on"""
+    return sorted(
+        tuple(row)
+        for row in con.execute(
+            """SELECT tn.test_name, fn.filename
+               FROM
+                   test_execution te, dependency_set_file_fp dsf, file_fp f,
+                   interned_test_name tn, interned_filename fn
+               WHERE
+                   te.dependency_set_id = dsf.dependency_set_id AND
+                   dsf.fingerprint_id = f.id AND
+                   tn.id = te.test_name_id AND
+                   fn.id = f.filename_id"""
+        )
+    )
+
+
+class TestEnvironmentFiles:
+    def test_files_of_other_environments_are_not_of_interest(self, testdir):
+        rootdir = testdir.tmpdir.strpath
+        first = TestmonData.for_local_run(rootdir, environment="first")
+        first.save_test_execution_file_fps(
+            {"test_a.py::test_a": deps("test_a.py", "a.py"), "t.py::t": deps("t.py")}
+        )
+        second = TestmonData.for_local_run(rootdir, environment="second")
+        second.save_test_execution_file_fps({"test_b.py::test_b": deps("b.py")})
+
+        first = TestmonData.for_local_run(rootdir, environment="first")
+        assert sorted(first.files_of_interest) == ["a.py", "t.py", "test_a.py"]
+        second = TestmonData.for_local_run(rootdir, environment="second")
+        assert second.files_of_interest == ["b.py"]
+
+    def test_files_without_tests_are_removed(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_a": deps("test_a.py", "a.py")}
+        )
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_a": deps("test_a.py")}
+        )
+        testmon_data.db.finish_execution(testmon_data.exec_id)
+        assert testmon_data.db.environment_filenames(testmon_data.exec_id) == [
+            "test_a.py"
+        ]
+
+
+class TestSuiteFilesFshas:
+    def fetch_summary(self, database):
+        return sorted(
+            tuple(row)
+            for row in database.con.execute(
+                """SELECT fn.filename, sefs.fsha
+                   FROM suite_execution_file_fsha sefs, interned_filename fn
+                   WHERE fn.id = sefs.filename_id"""
+            )
+        )
+
+    def test_kept_current(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        database, exec_id = testmon_data.db, testmon_data.exec_id
+        placeholder = {"filename": "test_b.py", "fsha": None, "method_checksums": [0]}
+        for _ in range(2):
+            testmon_data.save_test_execution_file_fps(
+                {
+                    "test_a.py::test_a": deps("test_a.py", "a.py"),
+                    "test_b.py::test_b": {"deps": [placeholder]},
+                }
+            )
+        assert self.fetch_summary(database) == [
+            ("a.py", "sha"),
+            ("test_a.py", "sha"),
+            ("test_b.py", None),
+        ]
+        assert sorted(
+            database.fetch_unknown_files({"a.py": "sha", "test_a.py": "new"}, exec_id)
+        ) == ["test_a.py", "test_b.py"]
+
+        testmon_data.save_test_execution_file_fps(
+            {"test_b.py::test_b": deps("test_b.py")}
+        )
+        database.delete_test_executions(["test_a.py::test_a"], exec_id)
+        database.finish_execution(exec_id)
+        assert self.fetch_summary(database) == [("test_b.py", "sha")]
+        assert database.fetch_unknown_files({"test_b.py": "sha"}, exec_id) == []
+
+
+class TestInsertTestFileFps:
+    def test_fingerprints_are_stored_once(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        placeholder = {"filename": "test_b.py", "fsha": None, "method_checksums": [0]}
+        for _ in range(2):
+            testmon_data.save_test_execution_file_fps(
+                {
+                    "test_a.py::test_a": deps("test_a.py", "a.py"),
+                    "test_a.py::test_b": deps("a.py"),
+                    "test_b.py::test_b": {"deps": [placeholder]},
+                }
+            )
+        con = testmon_data.db.con
+        assert con.execute("SELECT count(*) FROM file_fp").fetchone()[0] == 3
+        assert stored_links(con) == [
+            ("test_a.py::test_a", "a.py"),
+            ("test_a.py::test_a", "test_a.py"),
+            ("test_a.py::test_b", "a.py"),
+            ("test_b.py::test_b", "test_b.py"),
+        ]
+
+    def test_unchanged_tests_are_updated_in_place(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        con = testmon_data.db.con
+        testmon_data.save_test_execution_file_fps(
+            {
+                "test_a.py::test_a": deps("test_a.py", "a.py"),
+                "test_a.py::test_b": deps("test_a.py"),
+            }
+        )
+        ids = dict(con.execute("SELECT test_name_id, id FROM test_execution"))
+        links_query = "SELECT rowid, * FROM dependency_set_file_fp ORDER BY rowid"
+        links = [tuple(row) for row in con.execute(links_query)]
+
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_a": deps("test_a.py", "a.py")}
+        )
+        assert [tuple(row) for row in con.execute(links_query)] == links
+
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_b": {**deps("b.py"), "failed": True}}
+        )
+        assert dict(con.execute("SELECT test_name_id, id FROM test_execution")) == ids
+        assert stored_links(con) == [
+            ("test_a.py::test_a", "a.py"),
+            ("test_a.py::test_a", "test_a.py"),
+            ("test_a.py::test_b", "b.py"),
+        ]
+        executions = testmon_data.db.all_test_executions(testmon_data.exec_id)
+        assert executions["test_a.py::test_b"]["failed"] == 1
+
+    def test_tests_with_the_same_fingerprints_share_a_dependency_set(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        database, con = testmon_data.db, testmon_data.db.con
+        testmon_data.save_test_execution_file_fps(
+            {f"test_a.py::test_a[{i}]": deps("test_a.py", "a.py") for i in range(3)}
+        )
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_a[3]": deps("a.py", "test_a.py")}
+        )
+        assert con.execute("SELECT count(*) FROM dependency_set").fetchone()[0] == 1
+        assert con.execute("SELECT count(*) FROM dependency_set_file_fp").fetchone()[0] == 2
+
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_a[0]": deps("test_a.py")}
+        )
+        database.delete_test_executions(
+            ["test_a.py::test_a[1]", "test_a.py::test_a[2]", "test_a.py::test_a[3]"],
+            testmon_data.exec_id,
+        )
+        database.finish_execution(testmon_data.exec_id)
+        assert con.execute("SELECT count(*) FROM dependency_set").fetchone()[0] == 1
+        assert stored_links(con) == [("test_a.py::test_a[0]", "test_a.py")]
+        assert con.execute("SELECT count(*) FROM file_fp").fetchone()[0] == 1
+
+    def test_test_names_are_interned_in_chunks(self, testdir):
+        database = TestmonData.for_local_run(testdir.tmpdir.strpath).db
+        known = database.fetch_or_create_test_names(database.con, ["test_a.py::test_a"])
+        test_names = [f"test_a.py::test_a[{i}]" for i in range(db.SQLITE_MAX_VARIABLES)]
+        test_name_ids = database.fetch_or_create_test_names(
+            database.con, test_names + ["test_a.py::test_a"]
+        )
+        assert test_name_ids["test_a.py::test_a"] == known["test_a.py::test_a"]
+        assert len(set(test_name_ids.values())) == db.SQLITE_MAX_VARIABLES + 1
+
+
+class TestVacuumFileFp:
+    def test_unlinked_fingerprints_are_removed(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        database, exec_id = testmon_data.db, testmon_data.exec_id
+        testmon_data.save_test_execution_file_fps(
+            {
+                "test_a.py::test_a": deps("a.py", "shared.py"),
+                "test_a.py::test_b": deps("b.py", "shared.py"),
+                "test_a.py::test_c": deps("c.py"),
+            }
+        )
+        database.delete_test_executions(["test_a.py::test_b"], exec_id)
+        testmon_data.save_test_execution_file_fps(
+            {"test_a.py::test_a": {"deps": [{**deps("a.py")["deps"][0], "fsha": "2"}]}}
+        )
+        with database.con as con:
+            # links removed by the foreign key cascade
+            con.execute(
+                """DELETE FROM test_execution WHERE test_name_id IN (
+                    SELECT id FROM interned_test_name
+                    WHERE test_name = 'test_a.py::test_c')"""
+            )
+        database.finish_execution(exec_id)
+
+        fingerprints = database.con.execute("SELECT filename_id, fsha FROM file_fp")
+        assert [row["fsha"] for row in fingerprints] == ["2"]
+        candidates = database.con.execute("SELECT count(*) FROM file_fp_candidate")
+        assert candidates.fetchone()[0] == 0
+        block_tables = database.con.execute("SELECT fsha FROM file_block")
+        assert [row["fsha"] for row in block_tables] == ["2"]
+
+
+class TestDetermineTests:
+    def test_tests_with_a_missing_block_are_affected(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        testmon_data.save_test_execution_file_fps(
+            {
+                f"test_m.py::test_{name}": {
+                    "deps": [
+                        {"filename": "m.py", "fsha": "sha", "method_checksums": blocks}
+                    ]
+                }
+                for name, blocks in {"a": [1, 2], "b": [2, 3], "c": []}.items()
+            }
+        )
+        database, exec_id = testmon_data.db, testmon_data.exec_id
+
+        changed = database.determine_tests(exec_id, {"m.py": [1, 2, 4]})
+        assert changed["affected"] == ["test_m.py::test_b"]
+        deleted = database.determine_tests(exec_id, {"m.py": None})
+        assert sorted(deleted["affected"]) == [
+            "test_m.py::test_a",
+            "test_m.py::test_b",
+            "test_m.py::test_c",
+        ]
+
+    def test_block_table_grows_with_later_batches(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        for name, blocks in {"a": [1, 2], "b": [3, 1]}.items():
+            record = {"filename": "m.py", "fsha": "sha", "method_checksums": blocks}
+            testmon_data.save_test_execution_file_fps(
+                {f"test_m.py::test_{name}": {"deps": [record]}}
+            )
+        database, exec_id = testmon_data.db, testmon_data.exec_id
+
+        assert database.determine_tests(exec_id, {"m.py": [1, 2]})["affected"] == [
+            "test_m.py::test_b"
+        ]
+        assert database.determine_tests(exec_id, {"m.py": [3, 1]})["affected"] == [
+            "test_m.py::test_a"
+        ]
+
+
+DATA_VERSION_14_SCHEMA = """
+    CREATE TABLE metadata (dataid TEXT PRIMARY KEY, data TEXT);
+    CREATE TABLE environment (
+        id INTEGER PRIMARY KEY ASC,
+        environment_name TEXT,
+        system_packages TEXT,
+        python_version TEXT,
+        UNIQUE (environment_name, system_packages, python_version));
+    CREATE TABLE test_execution (
+        id INTEGER PRIMARY KEY ASC,
+        environment_id INTEGER,
+        test_name TEXT,
+        duration FLOAT,
+        failed BIT,
+        forced BIT,
+        FOREIGN KEY(environment_id) REFERENCES environment(id) ON DELETE CASCADE);
+    CREATE INDEX test_execution_fk_name ON test_execution (environment_id, test_name);
+    CREATE TABLE file_fp (
+        id INTEGER PRIMARY KEY,
+        filename TEXT,
+        method_checksums BLOB,
+        mtime FLOAT,
+        fsha TEXT,
+        UNIQUE (filename, fsha, method_checksums));
+    CREATE TABLE test_execution_file_fp (
+        test_execution_id INTEGER,
+        fingerprint_id INTEGER,
+        FOREIGN KEY(test_execution_id) REFERENCES test_execution(id) ON DELETE CASCADE,
+        FOREIGN KEY(fingerprint_id) REFERENCES file_fp(id));
+    CREATE INDEX test_execution_file_fp_both
+        ON test_execution_file_fp (test_execution_id, fingerprint_id);
+    CREATE TABLE suite_execution_file_fsha (
+        suite_execution_id INTEGER,
+        filename TEXT,
+        fsha text,
+        FOREIGN KEY(suite_execution_id) REFERENCES suite_execution(id) ON DELETE CASCADE);
+    CREATE UNIQUE INDEX sefch_suite_id_filename_sha
+        ON suite_execution_file_fsha(suite_execution_id, filename, fsha);
+
+    INSERT INTO metadata VALUES ('1:run_saved_time', '10');
+    INSERT INTO environment VALUES (1, 'default', '', '3.11');
+    INSERT INTO test_execution VALUES
+        (1, 1, 'test_a.py::test_a', 0.5, 0, NULL),
+        (2, 1, 'test_a.py::test_b', 0.1, 1, NULL),
+        (3, 1, 'test_a.py::test_c', 0.1, 0, NULL);
+    INSERT INTO file_fp VALUES
+        (1, 'test_a.py', X'01000000', NULL, 'sha_test_a'),
+        (2, 'a.py', X'0100000002000000', NULL, 'sha_a'),
+        (3, 'a.py', X'03000000', NULL, 'sha_a'),
+        (4, 'a.py', X'0300000003000000', NULL, 'sha_a'),
+        (5, 'b.py', X'01000000', NULL, 'sha_b');
+    INSERT INTO test_execution_file_fp VALUES
+        (1, 1), (1, 2), (2, 1), (2, 3), (3, 3), (3, 4);
+    INSERT INTO suite_execution_file_fsha VALUES (7, 'x.py', 'stale');
+    PRAGMA user_version = 14;
+"""
+
+
+# .testmondata written by pytest-testmon 2.2.0 (version 14) running
+# V14_TEST_A_PY, the passing tests are deselected after the migration
+DATA_VERSION_14_DUMP = """
+CREATE TABLE environment (
+                id INTEGER PRIMARY KEY ASC,
+                environment_name TEXT,
+                system_packages TEXT,
+                python_version TEXT,
+                UNIQUE (environment_name, system_packages, python_version)
+            );
+INSERT INTO "environment" VALUES(1,'default','Pygments 2.21, coverage 7.16, iniconfig 2.3, packaging 26.3, pip 23.2, pluggy 1.6, pytest 9.1, setuptools 65.5','3.11.7');
+CREATE TABLE file_fp
+            (
+                id INTEGER PRIMARY KEY,
+                filename TEXT,
+                method_checksums BLOB,
+                mtime FLOAT,
+                fsha TEXT,
+                UNIQUE (filename, fsha, method_checksums)
+            );
+INSERT INTO "file_fp" VALUES(2,'test_a.py',X'7E6DFA56EA551DF8',NULL,'3ddbf054b7810433d9807a000cd117f6a33dd5a7');
+INSERT INTO "file_fp" VALUES(3,'a.py',X'A74DDB61FACEF5D0',NULL,'3b474e9d911ed7058eef423005391eb0f01ed523');
+INSERT INTO "file_fp" VALUES(4,'test_a.py',X'7E6DFA56B127BFD2',NULL,'3ddbf054b7810433d9807a000cd117f6a33dd5a7');
+INSERT INTO "file_fp" VALUES(5,'a.py',X'A74DDB6152B59FE8',NULL,'3b474e9d911ed7058eef423005391eb0f01ed523');
+INSERT INTO "file_fp" VALUES(6,'test_a.py',X'7E6DFA56CEC14A00',NULL,'3ddbf054b7810433d9807a000cd117f6a33dd5a7');
+CREATE TABLE metadata (dataid TEXT PRIMARY KEY, data TEXT);
+INSERT INTO "metadata" VALUES('None:time_saved','0.00231586600057199');
+INSERT INTO "metadata" VALUES('None:time_all','0.0101249459994506');
+INSERT INTO "metadata" VALUES('None:tests_saved','2');
+INSERT INTO "metadata" VALUES('None:tests_all','6');
+CREATE TABLE suite_execution_file_fsha (
+                suite_execution_id INTEGER,
+                filename TEXT,
+                fsha text,
+                FOREIGN KEY(suite_execution_id) REFERENCES suite_execution(id) ON DELETE CASCADE
+                );
+CREATE TABLE test_execution (
+                id INTEGER PRIMARY KEY ASC,
+                environment_id INTEGER,
+                test_name TEXT,
+                duration FLOAT,
+                failed BIT,
+                forced BIT,
+                FOREIGN KEY(environment_id) REFERENCES environment(id) ON DELETE CASCADE);
+INSERT INTO "test_execution" VALUES(1,1,'test_a.py::test_add',1.6547110008104937151e-03,0,NULL);
+INSERT INTO "test_execution" VALUES(2,1,'test_a.py::test_subtract',6.61154999761492945253e-04,0,NULL);
+INSERT INTO "test_execution" VALUES(3,1,'test_a.py::test_fails',3.17592699957458535209e-03,1,0);
+CREATE TABLE test_execution_file_fp (
+                test_execution_id INTEGER,
+                fingerprint_id INTEGER,
+                FOREIGN KEY(test_execution_id) REFERENCES test_execution(id) ON DELETE CASCADE,
+                FOREIGN KEY(fingerprint_id) REFERENCES file_fp(id)
+            );
+INSERT INTO "test_execution_file_fp" VALUES(1,2);
+INSERT INTO "test_execution_file_fp" VALUES(1,3);
+INSERT INTO "test_execution_file_fp" VALUES(2,4);
+INSERT INTO "test_execution_file_fp" VALUES(2,5);
+INSERT INTO "test_execution_file_fp" VALUES(3,6);
+INSERT INTO "test_execution_file_fp" VALUES(3,3);
+CREATE INDEX test_execution_fk_name ON test_execution (environment_id, test_name);
+CREATE INDEX test_execution_file_fp_both ON test_execution_file_fp (test_execution_id, fingerprint_id);
+CREATE UNIQUE INDEX sefch_suite_id_filename_sha ON suite_execution_file_fsha(suite_execution_id, filename, fsha);
+PRAGMA user_version = 14;
+"""
+
+V14_A_PY = """\
+def add(a, b):
+    return a + b
+
+
+def subtract(a, b):
+    return a - b
+"""
+
+V14_TEST_A_PY = """\
+from a import add, subtract
+
+
+def test_add():
+    assert add(1, 2) == 3
+
+
+def test_subtract():
+    assert subtract(3, 2) == 1
+
+
+def test_fails():
+    assert add(1, 1) == 3
+"""
+
+
+class TestMigration:
+    def test_version_14_is_converted_in_place(self, tmp_path):
+        datafile = str(tmp_path / ".testmondata")
+        connection = db.connect(datafile)
+        connection.executescript(DATA_VERSION_14_SCHEMA)
+        connection.close()
+
+        database = db.DB(datafile)
+        assert not database.file_created
+        assert database.fetch_attribute("run_saved_time", exec_id=1) == 10
+        assert database.all_test_executions(1) == {
+            "test_a.py::test_a": {"duration": 0.5, "failed": 0, "forced": None},
+            "test_a.py::test_b": {"duration": 0.1, "failed": 1, "forced": None},
+            "test_a.py::test_c": {"duration": 0.1, "failed": 0, "forced": None},
+        }
+        # the fingerprints with checksums [3] and [3, 3] are merged, the one of
+        # b.py no test depends on is dropped
+        assert stored_links(database.con) == [
+            ("test_a.py::test_a", "a.py"),
+            ("test_a.py::test_a", "test_a.py"),
+            ("test_a.py::test_b", "a.py"),
+            ("test_a.py::test_b", "test_a.py"),
+            ("test_a.py::test_c", "a.py"),
+        ]
+        assert sorted(database.environment_filenames(1)) == ["a.py", "test_a.py"]
+        assert database.fetch_unknown_files(
+            {"test_a.py": "sha_test_a", "a.py": "new"}, 1
+        ) == ["a.py"]
+        assert database.determine_tests(1, {"a.py": [1, 3]})["affected"] == [
+            "test_a.py::test_a"
+        ]
+        assert sorted(database.determine_tests(1, {"a.py": [1, 2]})["affected"]) == [
+            "test_a.py::test_b",
+            "test_a.py::test_c",
+        ]
+        database.finish_execution(1)
+        assert sorted(database.all_filenames()) == ["a.py", "test_a.py"]
+        assert database.con.execute("PRAGMA foreign_key_check").fetchall() == []
+        # the same tables and columns as in a new file
+        schema = """SELECT m.name, c.name FROM sqlite_master m, pragma_table_info(m.name) c
+                    WHERE m.type = 'table' ORDER BY m.name, c.cid"""
+        new_database = db.DB(str(tmp_path / "new"))
+        assert (
+            database.con.execute(schema).fetchall()
+            == new_database.con.execute(schema).fetchall()
+        )
+        assert [
+            column["name"]
+            for column in database.con.execute("PRAGMA table_info(file_fp)")
+        ] == ["id", "filename_id", "method_checksums", "fsha"]
+
+    @pytest.mark.skipif(
+        sys.version_info >= (3, 12),
+        reason="the module checksums in the file are of Python < 3.12 syntax trees",
+    )
+    def test_version_14_file_keeps_selecting(self, testdir):
+        testdir.makepyfile(a=V14_A_PY, test_a=V14_TEST_A_PY)
+        connection = db.connect(str(testdir.tmpdir / ".testmondata"))
+        connection.executescript(DATA_VERSION_14_DUMP)
+        # the environment the file was written in
+        connection.execute(
+            "UPDATE environment SET system_packages = ?, python_version = ?",
+            (
+                drop_patch_version(get_system_packages()),
+                ".".join(str(part) for part in sys.version_info[:3]),
+            ),
+        )
+        connection.commit()
+        connection.close()
+
+        result = testdir.runpytest_inprocess("--testmon")
+        result.assert_outcomes(failed=1, deselected=2)
+        result = testdir.runpytest_inprocess("--testmon")
+        result.assert_outcomes(failed=1, deselected=2)
+
+    def test_unknown_version_is_discarded(self, tmp_path):
+        datafile = str(tmp_path / ".testmondata")
+        connection = db.connect(datafile)
+        connection.executescript(DATA_VERSION_14_SCHEMA + "PRAGMA user_version = 13;")
+        connection.close()
+
+        database = db.DB(datafile)
+        assert database.file_created
+        assert database.all_test_executions(1) == {}
+
+    def test_failing_migration_discards_data(self, tmp_path):
+        datafile = str(tmp_path / ".testmondata")
+        connection = db.connect(datafile)
+        connection.executescript(
+            DATA_VERSION_14_SCHEMA + "DROP TABLE test_execution_file_fp;"
+        )
+        connection.close()
+
+        database = db.DB(datafile)
+        assert database.file_created
+        assert database.all_test_executions(1) == {}
+
+
+class TestGitDiff:
+    @pytest.fixture
+    def checked(self, testdir, monkeypatch):
+        for variable in ("GIT_AUTHOR", "GIT_COMMITTER"):
+            monkeypatch.setenv(f"{variable}_NAME", "testmon")
+            monkeypatch.setenv(f"{variable}_EMAIL", "testmon@example.com")
+        testdir.makeini("[pytest]\ntestmon_git_diff = true\n")
+        testdir.makepyfile(
+            a="def f(): return 1",
+            b="def g(): return 2",
+            test_a="import a\ndef test_a(): assert a.f() == 1",
+            test_b="import b\ndef test_b(): assert b.g() == 2",
+        )
+        testdir.makefile(".gitignore", ".testmondata*\n")
+        self.git(testdir, "init", "-q")
+        self.git(testdir, "add", ".")
+        self.git(testdir, "commit", "-qm", "init")
+        testdir.runpytest("--testmon").assert_outcomes(passed=2)
+
+        checked = []
+        get_files_fshas = TestmonData.get_files_fshas
+
+        def record(testmon_data, filenames):
+            checked.append(sorted(filenames))
+            return get_files_fshas(testmon_data, filenames)
+
+        monkeypatch.setattr(TestmonData, "get_files_fshas", record)
+        return checked
+
+    @staticmethod
+    def git(testdir, *args):
+        subprocess.run(["git", *args], cwd=testdir.tmpdir.strpath, check=True)
+
+    def test_committed_change(self, testdir, checked):
+        testdir.makepyfile(a="def f(): return 1 + 0")
+        self.git(testdir, "commit", "-qam", "change")
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+        assert checked == [["a.py"]]
+
+    def test_work_tree_change_and_revert(self, testdir, checked):
+        testdir.makepyfile(b="def g(): return 2 + 0")
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+        self.git(testdir, "checkout", "-q", "b.py")
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+        testdir.runpytest("--testmon").assert_outcomes()
+        testdir.runpytest("--testmon").assert_outcomes()
+        # the revert made b.py unknown, it's checked once more after its tests ran
+        assert checked == [["b.py"], ["b.py"], ["b.py"], []]
+
+    def test_run_without_git_diff_in_between(self, testdir, checked):
+        testdir.makepyfile(b="def g(): return 2 + 0")
+        testdir.runpytest("--testmon", "-o", "testmon_git_diff=false").assert_outcomes(
+            passed=1
+        )
+        self.git(testdir, "checkout", "-q", "b.py")
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+        assert checked[-1] == ["a.py", "b.py", "test_a.py", "test_b.py"]
+
+
+class TestCollectorBatches:
+    def run_tests(self, testdir, monkeypatch, **kwargs):
+        """[nodes_files_lines] returned after each of 3 tests which call f()"""
+        testdir.makepyfile(traced="def f(): return 1\ndef g(): return 2\n")
+        monkeypatch.syspath_prepend(testdir.tmpdir.strpath)
+        import traced  # pylint: disable=import-outside-toplevel,import-error
+
+        collector = testmon_core.TestmonCollector(testdir.tmpdir.strpath, **kwargs)
+        test_names = ["test_a.py::test_1", "test_a.py::test_2", "test_a.py::test_3"]
+        batches = []
+        try:
+            for test_name, next_test_name in zip(test_names, test_names[1:] + [None]):
+                collector.start_testmon(test_name, next_test_name)
+                traced.f()
+                batches.append(collector.get_batch_coverage_data())
+                traced.g()  # runs between the tests, e.g. in a conftest.py hook
+        finally:
+            collector.close()
+        return batches
+
+    @pytest.mark.parametrize("name", [tracer.COVERAGE_TRACER, tracer.BLOCK_TRACER])
+    def test_batches_are_drained(self, testdir, monkeypatch, name):
+        batches = self.run_tests(
+            testdir,
+            monkeypatch,
+            tracer=name,
+            batch_limits=testmon_core.BatchLimits(lines=2),
+        )
+        assert [sorted(batch) for batch in batches] == [
+            [],
+            ["test_a.py::test_1", "test_a.py::test_2"],
+            ["test_a.py::test_3"],
+        ]
+        assert bitmap_to_lines(batches[1]["test_a.py::test_2"]["traced.py"]) == [1]
+        assert bitmap_to_lines(batches[2]["test_a.py::test_3"]["traced.py"]) == [1]
+
+    @pytest.mark.parametrize("name", [tracer.COVERAGE_TRACER, tracer.BLOCK_TRACER])
+    def test_memory_estimate(self, testdir, monkeypatch, name):
+        batches = self.run_tests(
+            testdir,
+            monkeypatch,
+            tracer=name,
+            batch_limits=testmon_core.BatchLimits(
+                memory=2 * testmon_core.MEASURED_FILE_BYTES
+            ),
+        )
+        assert [len(batch) for batch in batches] == [0, 2, 1]
+
+    @pytest.mark.parametrize(
+        "limits", [{"memory": 1}, {"seconds": 0}], ids=["memory", "seconds"]
+    )
+    def test_limits(self, testdir, monkeypatch, limits):
+        batches = self.run_tests(
+            testdir, monkeypatch, batch_limits=testmon_core.BatchLimits(**limits)
+        )
+        assert [sorted(batch) for batch in batches] == [
+            ["test_a.py::test_1"],
+            ["test_a.py::test_2"],
+            ["test_a.py::test_3"],
+        ]
+
+    def test_without_coverage_internals(self, testdir, monkeypatch):
+        def changed(*args, **kwargs):
+            raise sqlite3.OperationalError("no such table: line_bits")
+
+        monkeypatch.setattr(testmon_core, "query_line_bits", changed)
+        monkeypatch.setattr(testmon_core, "delete_line_bits", changed)
+        batches = self.run_tests(
+            testdir, monkeypatch, batch_limits=testmon_core.BatchLimits(seconds=0)
+        )
+        assert [
+            {test_name: bitmap_to_lines(files["traced.py"])}
+            for batch in batches
+            for test_name, files in batch.items()
+        ] == [
+            {"test_a.py::test_1": [1]},
+            {"test_a.py::test_2": [1]},
+            {"test_a.py::test_3": [1]},
+        ]
+
+        collector = testmon_core.TestmonCollector(testdir.tmpdir.strpath)
+        collector.cov = types.SimpleNamespace()
+        collector.measure_test()
+        assert collector.batch_lines == 0
+
+    def test_limits_from_ini(self, testdir):
+        testdir.makeini("[pytest]\ntestmon_batch_max_lines = 1\n")
+        testdir.makepyfile(
+            test_a="def test_1(): pass\ndef test_2(): pass\ndef test_3(): pass\n"
+        )
+        testdir.runpytest("--testmon").assert_outcomes(passed=3)
+        testdir.runpytest("--testmon").assert_outcomes()
+
+
+class TestBlockTracer:
+    def test_code_entered_by_each_test(self, testdir, monkeypatch):
+        testdir.makepyfile(
+            traced="def f():\n    return 1\n\ndef g():\n    yield 1\n    yield 2\n"
+        )
+        monkeypatch.syspath_prepend(testdir.tmpdir.strpath)
+        import traced  # pylint: disable=import-outside-toplevel,import-error
+
+        block_tracer = tracer.BlockTracer(testdir.tmpdir.strpath)
+        block_tracer.start()
+        try:
+            block_tracer.switch_context("test_f")
+            traced.f()
+            generator = traced.g()
+            next(generator)
+            block_tracer.switch_context("test_g")
+            next(generator)
+        finally:
+            block_tracer.stop()
+        assert {
+            (context, os.path.basename(file), tuple(bitmap_to_lines(lines_bitmap)))
+            for context, file, lines_bitmap in block_tracer.drain()
+        } == {
+            ("test_f", "traced.py", (1, 2, 4, 5, 6)),
+            ("test_g", "traced.py", (4, 5, 6)),
+        }
+
+    def test_profile_functions_are_restored(self, testdir, monkeypatch):
+        monkeypatch.setattr(tracer, "free_tool_id", lambda: None)
+
+        def profile(frame, event, arg):  # pylint: disable=unused-argument
+            pass
+
+        block_tracer = tracer.BlockTracer(testdir.tmpdir.strpath)
+        previous = sys.getprofile(), threading.getprofile()
+        sys.setprofile(profile)
+        threading.setprofile(profile)
+        try:
+            block_tracer.start()
+            assert sys.getprofile() is not profile
+            block_tracer.stop()
+            assert sys.getprofile() is profile
+            assert threading.getprofile() is profile
+        finally:
+            sys.setprofile(previous[0])
+            threading.setprofile(previous[1])
+
+    def test_same_fingerprints_as_coverage(self, testdir):
+        testdir.makepyfile(
+            a="def f():\n    return 1\n\ndef g():\n    return 2\n",
+            test_a="import a\ndef test_f(): assert a.f()\ndef test_g(): assert a.g()",
+        )
+        fingerprints = {}
+        for name in tracer.TRACERS:
+            testdir.runpytest("--testmon", "-o", f"testmon_tracer={name}")
+            database = db.DB(testdir.tmpdir.join(".testmondata").strpath)
+            fingerprints[name] = database.filenames_fingerprints(1)
+            os.remove(testdir.tmpdir.join(".testmondata").strpath)
+        assert (
+            fingerprints["blocks"] == fingerprints["lines"] == fingerprints["coverage"]
+        )
+
+    def test_selection(self, testdir):
+        testdir.makeini("[pytest]\ntestmon_tracer = blocks\n")
+        testdir.makepyfile(
+            a="def f():\n    return 1\n\ndef g():\n    return 2\n",
+            test_a="import a\ndef test_f(): assert a.f()\ndef test_g(): assert a.g()",
+        )
+        testdir.runpytest("--testmon").assert_outcomes(passed=2)
+        testdir.runpytest("--testmon").assert_outcomes()
+        make_old(
+            testdir.makepyfile(a="def f():\n    return 1\n\ndef g():\n    return 3\n")
+        )
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+
+
+@pytest.mark.skipif(
+    not tracer.MONITORING_AVAILABLE, reason="sys.monitoring is new in Python 3.12"
+)
+class TestLineTracer:
+    def test_lines_run_by_each_test(self, testdir, monkeypatch):
+        testdir.makepyfile(
+            traced="def f(x):\n    if x:\n        return 1\n    return 2\n"
+        )
+        monkeypatch.syspath_prepend(testdir.tmpdir.strpath)
+        import traced  # pylint: disable=import-outside-toplevel,import-error
+
+        line_tracer = tracer.make_tracer(tracer.LINE_TRACER, testdir.tmpdir.strpath)
+        line_tracer.start()
+        try:
+            line_tracer.switch_context("test_1")
+            traced.f(1)
+            line_tracer.switch_context("test_0")
+            traced.f(0)
+            traced.f(1)
+        finally:
+            line_tracer.stop()
+        assert {
+            (context, os.path.basename(file), tuple(bitmap_to_lines(lines_bitmap)))
+            for context, file, lines_bitmap in line_tracer.drain()
+        } == {("test_1", "traced.py", (2, 3)), ("test_0", "traced.py", (2, 3, 4))}
+
+    def test_coverage_keeps_measuring(self, testdir, monkeypatch):
+        testdir.makepyfile(traced="def f():\n    return 1\n")
+        monkeypatch.syspath_prepend(testdir.tmpdir.strpath)
+        import traced  # pylint: disable=import-outside-toplevel,import-error
+
+        cov = Coverage(include=[testdir.tmpdir.join("*").strpath], data_file=None)
+        line_tracer = tracer.LineTracer(testdir.tmpdir.strpath)
+        cov.start()
+        line_tracer.start()
+        try:
+            line_tracer.switch_context("test_f")
+            traced.f()
+        finally:
+            line_tracer.stop()
+            cov.stop()
+        assert "testmon" not in map(
+            sys.monitoring.get_tool,  # pylint: disable=no-member
+            tracer.MONITORING_TOOL_IDS,
+        )
+        assert [bitmap_to_lines(row[2]) for row in line_tracer.drain()] == [[2]]
+        assert cov.get_data().lines(traced.__file__) == [2]
+
+    def test_coverage_measures_when_the_tool_ids_were_taken(self, testdir):
+        testdir.makepyfile(traced="def f():\n    return 1\n")
+        collector = testmon_core.TestmonCollector(
+            testdir.tmpdir.strpath, tracer=tracer.LINE_TRACER
+        )
+        monitoring = sys.monitoring  # pylint: disable=no-member
+        taken = [
+            tool_id
+            for tool_id in tracer.MONITORING_TOOL_IDS
+            if monitoring.get_tool(tool_id) is None
+        ]
+        for tool_id in taken:
+            monitoring.use_tool_id(tool_id, "other")
+        try:
+            collector.start_testmon("test_a.py::test_a")
+            assert collector.tracer is None
+            assert collector.cov is not None
+        finally:
+            collector.close()
+            for tool_id in taken:
+                monitoring.free_tool_id(tool_id)
+
+
+class TestWriteBehind:
+    @staticmethod
+    def batch(*test_names):
+        report = types.SimpleNamespace(outcome="passed", duration=0.1)
+        return (
+            {test_name: {"test_a.py": 1 << 1} for test_name in test_names},
+            {test_name: {"call": report} for test_name in test_names},
+        )
+
+    def test_batches_are_saved_under_backpressure(self, testdir):
+        testdir.makepyfile(test_a="def test_a(): pass")
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        testmon_data.determine_stable()
+
+        writer = testmon_core.WriteBehind(testmon_data, queue_size=1)
+        for i in range(5):
+            writer.put(*self.batch(f"test_a.py::test_{i}"))
+        writer.close()
+        assert sorted(testmon_data.all_tests) == [
+            f"test_a.py::test_{i}" for i in range(5)
+        ]
+
+    def test_errors_are_raised_on_the_main_thread(self, testdir, monkeypatch):
+        testdir.makepyfile(test_a="def test_a(): pass")
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        testmon_data.determine_stable()
+
+        def fail(*args):
+            raise ValueError("disk full")
+
+        monkeypatch.setattr(TestmonData, "save_test_execution_file_fps", fail)
+        writer = testmon_core.WriteBehind(testmon_data, queue_size=1)
+        with pytest.raises(ValueError, match="disk full"):
+            for i in range(3):
+                writer.put(*self.batch(f"test_a.py::test_{i}"))
+            writer.close()
+        writer.close()
+
+    def test_writer_has_its_own_db_and_source_tree(self, testdir):
+        testmon_data = TestmonData.for_local_run(testdir.tmpdir.strpath)
+        writer = testmon_core.WriteBehind(testmon_data)
+        writer.close()
+
+        writer_data = writer.writer_data()
+        assert writer_data.db.datafile == testmon_data.db.datafile
+        assert writer_data.db.con is not testmon_data.db.con
+        assert writer_data.source_tree is not testmon_data.source_tree
+        assert writer_data.source_tree.rootdir == testmon_data.source_tree.rootdir
+        writer_data.db.con.close()
+
+    def test_file_rewritten_during_the_run(self, testdir):
+        testdir.makeini("[pytest]\ntestmon_write_behind = true\n")
+        testdir.makepyfile(
+            a="def add(a, b): return a + b",
+            test_a="import a\ndef test_add(): assert a.add(1, 2) == 3",
+        )
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+        make_old(testdir.makepyfile(a="def add(a, b): return b + a"))
+        testdir.makepyfile(
+            test_b="""
+            import pathlib
+
+            def test_rewrite():
+                pathlib.Path("a.py").write_text("def add(a, b):\\n    return a - b\\n")
+            """
+        )
+        testdir.runpytest("--testmon").assert_outcomes(passed=2)
+        testdir.runpytest("--testmon").assert_outcomes(failed=1)
+
+    def test_selection(self, testdir):
+        testdir.makeini("[pytest]\ntestmon_write_behind = true\n")
+        testdir.makepyfile(
+            a="def f(): return 1",
+            test_a="import a\ndef test_a(): assert a.f() == 1\ndef test_b(): pass",
+        )
+        testdir.runpytest("--testmon").assert_outcomes(passed=2)
+        testdir.runpytest("--testmon").assert_outcomes()
+        make_old(testdir.makepyfile(a="def f(): return 1 + 0"))
+        testdir.runpytest("--testmon").assert_outcomes(passed=1)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+class TestWatch:
+    @pytest.fixture
+    def watcher(self, testdir, monkeypatch):
+        # short, socket paths are limited to ~100 characters
+        socket_dir = tempfile.mkdtemp(prefix="tmw")
+        path = os.path.join(socket_dir, "socket")
+        monkeypatch.setattr(watch, "socket_path", lambda rootdir: path)
+        watcher = watch.Watcher(testdir.tmpdir.strpath)
+        threading.Thread(target=watcher.serve, args=(path,), daemon=True).start()
+        while watch.changed_since(testdir.tmpdir.strpath, {})[1] is None:
+            time.sleep(0.01)
+        yield watcher
+        shutil.rmtree(socket_dir)
+
+    def test_only_changed_files_are_checked(self, testdir, watcher, monkeypatch):
+        make_old(testdir.makepyfile(a="def f(): pass"))
+        make_old(testdir.makepyfile(b="def g(): pass"))
+        rootdir = testdir.tmpdir.strpath
+        fshas = TestmonData.for_local_run(rootdir).get_files_fshas(["a.py", "b.py"])
+
+        make_old(testdir.makepyfile(b="def g(): return 1"), age=30)
+        checked = []
+        check_mtime = testmon_core.check_mtime
+
+        def record_check(file_system, record):
+            checked.append(record["filename"])
+            return check_mtime(file_system, record)
+
+        monkeypatch.setattr(testmon_core, "check_mtime", record_check)
+        new_fshas = TestmonData.for_local_run(rootdir).get_files_fshas(["a.py", "b.py"])
+        assert checked == ["b.py"]
+        assert new_fshas["a.py"] == fshas["a.py"]
+        assert new_fshas["b.py"] != fshas["b.py"]
+
+    def test_unknown_state(self, testdir, watcher):
+        testdir.makepyfile(a="def f(): pass")
+        changes, state = watch.changed_since(testdir.tmpdir.strpath, {"token": "x"})
+        assert changes is None
+        assert state["token"] == watcher.token
+
+        testdir.makepyfile(b="def g(): pass")
+        changes, _ = watch.changed_since(testdir.tmpdir.strpath, state)
+        assert "b.py" in changes
+        assert "a.py" not in changes
+
+    def test_answers_of_other_users_are_ignored(self, testdir, watcher, monkeypatch):
+        monkeypatch.setattr(watch, "peer_uid", lambda *args: os.getuid() + 1)
+        assert watch.changed_since(testdir.tmpdir.strpath, {}) == (None, None)
+
+    @pytest.mark.parametrize(
+        "answer",
+        [
+            b"[]\n",
+            b'{"token": "x"}\n',
+            b'{"token": "x", "seq": 1, "changed": [1], "unwatched": []}\n',
+        ],
+    )
+    def test_malformed_answer(self, testdir, monkeypatch, answer):
+        socket_dir = tempfile.mkdtemp(prefix="tmw")
+        path = os.path.join(socket_dir, "socket")
+        monkeypatch.setattr(watch, "socket_path", lambda rootdir: path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(path)
+            server.listen()
+
+            def answer_once():
+                connection, _ = server.accept()
+                with connection:
+                    watch.read_message(connection)
+                    connection.sendall(answer)
+
+            thread = threading.Thread(target=answer_once, daemon=True)
+            thread.start()
+            assert watch.changed_since(testdir.tmpdir.strpath, {}) == (None, None)
+            thread.join()
+        shutil.rmtree(socket_dir)
+
+    def test_socket_directory_is_private(self, testdir):
+        directory = testdir.tmpdir.join("sockets").strpath
+        watch.make_private_directory(directory)
+        assert os.stat(directory).st_mode & 0o777 == 0o700
+        watch.make_private_directory(directory)
+
+        os.chmod(directory, 0o755)
+        with pytest.raises(watch.WatchError):
+            watch.make_private_directory(directory)
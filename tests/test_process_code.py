@@ -1,17 +1,41 @@
 #  -- coding:utf8 --
+import ast
+import os
+import py_compile
+import random
+import sys
+import textwrap
+import time
 from pathlib import Path
 from subprocess import run
 
 import pytest
 
+from testmon import process_code
 from testmon.process_code import (
+    BLOCK_OWNERS,
+    BYTECODE_AVAILABLE,
     Module,
+    _next_lineno,
+    bitmap_misses,
+    bitmap_to_checksums,
+    bitmap_to_lines,
+    blob_to_checksums,
+    checksums_to_bitmap,
+    checksums_to_blob,
+    present_blocks,
+    methods_to_checksums,
     read_source_sha,
+    create_fingerprint,
+    create_fingerprint_from_bitmap,
+    lines_to_bitmap,
+    match_fingerprint,
     match_fingerprint_source,
     create_fingerprint_source,
     get_source_sha,
     noncached_get_files_shas,
 )
+from testmon.git_index import read_worktree_index
 from testmon.testmon_core import SourceTree
 
 try:
@@ -475,6 +499,294 @@ class TestCodeToBlocks:
         ]
 
 
+def legacy_blocks(tree, end):
+    """(start, end, name, text) of blocks, the text built the way
+    Module.dump_and_block did before blocks were hashed while walking the tree."""
+    blocks = []
+
+    def dump_and_block(node, end, name="unknown", into_block=False):
+        if isinstance(node, ast.AST):
+            class_name = node.__class__.__name__
+            fields = [
+                dump_and_block(
+                    field_value,
+                    end,
+                    name=getattr(node, "name", "unknown"),
+                    into_block=class_name in BLOCK_OWNERS and field_name == "body",
+                )
+                for field_name, field_value in ast.iter_fields(node)
+            ]
+            return f"{class_name}({', '.join(fields)})"
+        if isinstance(node, list):
+            representations = [
+                dump_and_block(item, _next_lineno(node, i, end))
+                for i, item in enumerate(node)
+            ]
+            if into_block and node:
+                if end is None:
+                    end = getattr(node[-1], "end_lineno", None)
+                code = f"{len(blocks)}:" + ", ".join(representations)
+                blocks.append((node[0].lineno, end, name, code))
+                return "transformed_into_block"
+            return ", ".join(representations)
+        return repr(node)
+
+    dump_and_block(tree, end)
+    return blocks
+
+
+BLOCK_HASHER_SAMPLES = [
+    """
+    def a():
+        return 1
+
+    async def b(x, *args, y=2, **kwargs):
+        await x
+        return [i for i in args]
+    """,
+    """
+    import os
+
+    class A(object):
+        \"\"\"Docstring with ünicode\"\"\"
+        attr = {"key": (1, 2.5, None, b"bytes")}
+
+        @staticmethod
+        def method(self) -> int:
+            def nested():
+                return lambda y: y * 2
+            return nested()
+    """,
+    """
+    def f(command):
+        match command:
+            case [x, y]:
+                def g():
+                    pass
+                return g
+            case {"k": v} if v > 0:
+                return f"{v!r:>10}"
+            case _:
+                try:
+                    pass
+                except ValueError:
+                    def h():
+                        pass
+    """,
+    """
+    X = 1
+    Y = X + 2  # comment
+    """,
+    "",
+    Path(__file__).read_text(encoding="utf8"),
+]
+
+
+class TestBlockHasher:
+    @pytest.mark.parametrize("source_code", BLOCK_HASHER_SAMPLES)
+    @pytest.mark.parametrize("chunk_size", [1, 2048])
+    def test_same_as_ast_dump(self, source_code, chunk_size, monkeypatch):
+        monkeypatch.setattr(process_code, "CRC_CHUNK_SIZE", chunk_size)
+        module = Module(source_code)
+        source_code = textwrap.dedent(source_code)
+        expected = legacy_blocks(ast.parse(source_code), len(source_code.splitlines()))
+
+        assert [(b.start, b.end, b.name) for b in module.blocks] == [
+            (start, end, name) for start, end, name, _ in expected
+        ]
+        assert module.method_checksums == methods_to_checksums(
+            [code for _, _, _, code in expected]
+        )
+
+    def test_other_than_python(self):
+        module = Module("hello\nworld\n", ext="txt")
+        assert module.method_checksums == methods_to_checksums(["hello\nworld\n"])
+
+
+BYTECODE_SAMPLE = """\
+import os
+
+
+@decorator
+def a(x):
+    def nested():
+        return [i for i in x]
+
+    return nested
+
+
+class A:
+    attr = {"a", "b"}
+
+    def method(self):
+        return lambda: 1
+"""
+
+
+@pytest.mark.skipif(not BYTECODE_AVAILABLE, reason="no bytecode")
+class TestBytecodeBackend:
+    def blocks(self, source_code, **kwargs):
+        module = Module(source_code, fingerprint_backend="bytecode", **kwargs)
+        return {block.name: block for block in module.blocks}
+
+    def test_blocks(self):
+        blocks = self.blocks(BYTECODE_SAMPLE)
+        assert {name: (b.start, b.end) for name, b in blocks.items()} == {
+            "<module>": (1, 16),
+            "a": (6, 9),
+            "nested": (7, 7),
+            "method": (16, 16),
+        }
+
+    def test_moved_code_same_checksums(self):
+        blocks = self.blocks(BYTECODE_SAMPLE)
+        moved = self.blocks("\n\n" + BYTECODE_SAMPLE)
+        assert [b.checksum for b in blocks.values()] == [
+            b.checksum for b in moved.values()
+        ]
+
+    def test_change_in_nested_function(self):
+        blocks = self.blocks(BYTECODE_SAMPLE)
+        changed = self.blocks(BYTECODE_SAMPLE.replace("i for i", "i * 2 for i"))
+        assert [name for name in blocks if blocks[name] != changed[name]] == ["nested"]
+
+    def test_change_in_class_body_and_lambda(self):
+        blocks = self.blocks(BYTECODE_SAMPLE)
+        changed = self.blocks(
+            BYTECODE_SAMPLE.replace('"b"', '"c"').replace("lambda: 1", "lambda: 2")
+        )
+        assert [name for name in blocks if blocks[name] != changed[name]] == [
+            "method",
+            "<module>",
+        ]
+
+    def test_roundtrip(self):
+        fingerprint = create_fingerprint(
+            Module(BYTECODE_SAMPLE, fingerprint_backend="bytecode"), {9}
+        )
+        changed = Module(
+            BYTECODE_SAMPLE.replace("lambda: 1", "lambda: 2"),
+            fingerprint_backend="bytecode",
+        )
+        assert match_fingerprint(changed, fingerprint)
+        changed = Module(
+            BYTECODE_SAMPLE.replace("return nested", "return None"),
+            fingerprint_backend="bytecode",
+        )
+        assert not match_fingerprint(changed, fingerprint)
+
+    @pytest.mark.parametrize(
+        "invalidation_mode",
+        [
+            py_compile.PycInvalidationMode.TIMESTAMP,
+            py_compile.PycInvalidationMode.CHECKED_HASH,
+        ],
+    )
+    def test_valid_pyc_is_used(self, testdir, monkeypatch, invalidation_mode):
+        path = testdir.makepyfile(a=BYTECODE_SAMPLE)
+        py_compile.compile(str(path), invalidation_mode=invalidation_mode)
+        expected = self.blocks(BYTECODE_SAMPLE)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("compiled despite a valid pyc")
+
+        monkeypatch.setattr(process_code, "compile", fail, raising=False)
+        blocks = self.blocks(
+            None, filename="a.py", rootdir=testdir.tmpdir.strpath, fs_fsha="-"
+        )
+        assert blocks == expected
+
+    def test_unoptimized_pyc_is_used_with_optimize(self, testdir):
+        path = testdir.makepyfile(a=BYTECODE_SAMPLE)
+        py_compile.compile(str(path), optimize=0)
+        result = run(
+            [
+                sys.executable,
+                "-O",
+                "-c",
+                "import sys; from testmon.process_code import read_cached_code;"
+                " print(read_cached_code(sys.argv[1]) is not None)",
+                str(path),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout.strip() == "True"
+
+    @pytest.mark.parametrize(
+        "invalidation_mode",
+        [
+            py_compile.PycInvalidationMode.TIMESTAMP,
+            py_compile.PycInvalidationMode.CHECKED_HASH,
+        ],
+    )
+    def test_stale_pyc_is_ignored(self, testdir, invalidation_mode):
+        path = testdir.makepyfile(a=BYTECODE_SAMPLE)
+        py_compile.compile(str(path), invalidation_mode=invalidation_mode)
+        changed_source = BYTECODE_SAMPLE.replace("lambda: 1", "lambda: 12")
+        testdir.makepyfile(a=changed_source)
+
+        blocks = self.blocks(
+            None, filename="a.py", rootdir=testdir.tmpdir.strpath, fs_fsha="-"
+        )
+        assert blocks == self.blocks(changed_source)
+
+
+class TestBitmaps:
+    def test_round_trip(self):
+        block_table = [7, -3, 12, 5]
+        positions = {checksum: i for i, checksum in enumerate(block_table)}
+        bitmap = checksums_to_bitmap([-3, 5], positions)
+        assert bitmap == bytes([0b1010])
+        assert bitmap_to_checksums(bitmap, block_table) == [-3, 5]
+        assert checksums_to_bitmap([], positions) == b""
+
+    def test_wide_table(self):
+        block_table = list(range(100))
+        positions = {checksum: checksum for checksum in block_table}
+        bitmap = checksums_to_bitmap([0, 99], positions)
+        assert len(bitmap) == 13
+        assert bitmap_to_checksums(bitmap, block_table) == [0, 99]
+
+    @pytest.mark.parametrize(
+        "checksums, misses",
+        [
+            ([7, -3, 12, 5], [False, False, False]),
+            ([7, 5, 100], [False, True, False]),
+            ([100], [True, True, False]),
+        ],
+    )
+    def test_misses(self, checksums, misses):
+        block_table = [7, -3, 12, 5]
+        positions = {checksum: i for i, checksum in enumerate(block_table)}
+        present = present_blocks(
+            blob_to_checksums(checksums_to_blob(block_table)), set(checksums)
+        )
+        fingerprints = [[7], [7, -3], []]
+        assert [
+            bitmap_misses(checksums_to_bitmap(fingerprint, positions), present)
+            for fingerprint in fingerprints
+        ] == misses
+
+
+class TestLinesBitmaps:
+    def test_round_trip(self):
+        assert lines_to_bitmap([1, 3, 64]) == 0b1010 | 1 << 64
+        assert bitmap_to_lines(lines_to_bitmap([64, 1, 3])) == [1, 3, 64]
+        assert bitmap_to_lines(0) == []
+
+    def test_same_fingerprint_as_from_lines(self):
+        module = Module(source_code=BYTECODE_SAMPLE)
+        lines = len(BYTECODE_SAMPLE.splitlines())
+        random.seed(0)
+        for _ in range(50):
+            covered = random.sample(range(1, lines + 1), random.randint(0, 5))
+            assert create_fingerprint_from_bitmap(
+                module, lines_to_bitmap(covered)
+            ) == create_fingerprint(module, covered)
+
+
 class TestModule:
     def test_read_source(self, testdir):
         testdir.makepyfile(
@@ -497,3 +809,130 @@ def test_noncached_get_files_shas(testdir):
     testdir.run("git", "commit", "-m", "Initial commit")
 
     assert isinstance(noncached_get_files_shas(testdir.tmpdir.strpath), dict)
+
+
+def git_ls_files_stage(directory):
+    result = run(
+        ["git", "ls-files", "--stage"],
+        cwd=directory,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    shas = {}
+    for line in result.stdout.splitlines():
+        mode_sha_stage, filename = line.split("\t", 1)
+        shas[filename] = mode_sha_stage.split(" ")[1]
+    return shas
+
+
+def refresh_index(directory):
+    # files written in the same timestamp tick as the index are racily clean
+    time.sleep(0.01)
+    run(["git", "update-index", "--really-refresh"], cwd=directory, check=True)
+
+
+class TestGitIndex:
+    @pytest.fixture
+    def repo(self, testdir, monkeypatch):
+        for variable in ("GIT_AUTHOR", "GIT_COMMITTER"):
+            monkeypatch.setenv(f"{variable}_NAME", "testmon")
+            monkeypatch.setenv(f"{variable}_EMAIL", "testmon@example.com")
+        testdir.makepyfile(a="pass", b="import a")
+        testdir.mkpydir("pkg").join("c.py").write("print(1)")
+        run(["git", "init", "-b", "main"], check=True)
+        run(["git", "add", "."], check=True)
+        run(["git", "commit", "-m", "Reasonable commit message"], check=True)
+        return testdir.tmpdir.strpath
+
+    @pytest.mark.parametrize(
+        "update_index",
+        [
+            ["--index-version", "2"],
+            ["--index-version", "3"],
+            ["--index-version", "4"],
+            ["--split-index"],
+        ],
+    )
+    def test_same_as_git(self, repo, update_index):
+        run(["git", "update-index", *update_index], check=True)
+        refresh_index(repo)
+
+        assert noncached_get_files_shas(repo) == git_ls_files_stage(repo)
+
+    def test_split_index_with_changes(self, repo, testdir):
+        run(["git", "update-index", "--split-index"], check=True)
+        testdir.makepyfile(a="pass  # changed", d="pass")
+        run(["git", "rm", "-q", "b.py"], check=True)
+        run(["git", "add", "a.py", "d.py"], check=True)
+
+        entries = read_worktree_index(repo).entries
+        assert {name: entry.sha.hex() for name, entry in entries.items()} == (
+            git_ls_files_stage(repo)
+        )
+
+    def test_modified_file(self, repo, testdir):
+        refresh_index(repo)
+        testdir.makepyfile(a="pass  # changed")
+
+        shas = noncached_get_files_shas(repo)
+        assert "a.py" not in shas
+        assert "b.py" in shas
+
+    def test_subdirectory(self, repo):
+        refresh_index(repo)
+        assert noncached_get_files_shas(os.path.join(repo, "pkg")) == {
+            "__init__.py": "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391",
+            "c.py": git_ls_files_stage(repo)["pkg/c.py"],
+        }
+
+    def test_worktree(self, repo, testdir):
+        worktree = os.path.join(testdir.tmpdir.dirname, "worktree")
+        run(["git", "worktree", "add", "-q", worktree], check=True)
+        refresh_index(worktree)
+
+        assert noncached_get_files_shas(worktree) == git_ls_files_stage(repo)
+
+    @pytest.mark.parametrize(
+        "sparse_checkout",
+        [["set", "--no-cone", "/*.py"], ["set", "--cone", "--sparse-index"]],
+    )
+    def test_sparse_checkout(self, repo, sparse_checkout):
+        run(["git", "sparse-checkout", *sparse_checkout], check=True)
+        refresh_index(repo)
+
+        assert noncached_get_files_shas(repo) == {
+            name: sha
+            for name, sha in git_ls_files_stage(repo).items()
+            if "/" not in name
+        }
+
+    def test_submodule(self, repo, testdir):
+        submodule = testdir.mkdir("submodule_origin")
+        run(["git", "init", "-b", "main"], cwd=submodule, check=True)
+        submodule.join("s.py").write("pass")
+        run(["git", "add", "."], cwd=submodule, check=True)
+        run(["git", "commit", "-m", "sub"], cwd=submodule, check=True)
+        run(
+            [
+                "git",
+                "-c",
+                "protocol.file.allow=always",
+                "submodule",
+                "add",
+                "-q",
+                str(submodule),
+                "sub",
+            ],
+            check=True,
+        )
+        refresh_index(os.path.join(repo, "sub"))
+
+        assert "sub" not in noncached_get_files_shas(repo)
+        assert noncached_get_files_shas(os.path.join(repo, "sub")) == (
+            git_ls_files_stage(os.path.join(repo, "sub"))
+        )
+
+    def test_no_repository(self, testdir):
+        testdir.makepyfile(a="pass")
+        assert read_worktree_index(testdir.tmpdir.strpath).entries == {}